@@ -0,0 +1,271 @@
+import os, sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import argparse
+import datetime
+import time
+from random import randint
+from typing import Callable, Iterator
+from knowledge_base.dtd import FareRecord, FlowRecord, TicketType, TimetableLocation, TimetableLocationType
+from knowledge_base.dtd import TIPLOC, TrainTimetable, State, entry_parser_for_file
+from knowledge_base.feeds import Record, date_to_sql, time_to_sql
+from knowledge_base.feeds import parse_date_ddmmyyyy, parse_date_yymmdd, parse_time
+
+def fixed_width_entry(length: int, fields: dict[int, str]) -> str:
+    entry = [' '] * length
+    for start, value in fields.items():
+        entry[start:start + len(value)] = value
+    return ''.join(entry).rstrip()
+
+def time_str(minutes: int) -> str:
+    return f'{ (minutes // 60) % 24:02}{ minutes % 60:02}'
+
+def synthetic_mca_entries(train_count: int) -> Iterator[str]:
+    for i in range(train_count):
+        yield fixed_width_entry(80, { 0: 'TI', 2: f'TIP{ i % 2000:04}', 53: 'ABC', 56: 'SOME STATION' })
+
+    for i in range(train_count):
+        departure = randint(0, 60 * 20)
+        yield fixed_width_entry(80, { 0: 'BSN', 3: f'C{ i:05}', 9: '220101', 15: '221231', 21: '1111100', 28: 'N' })
+        yield fixed_width_entry(80, { 0: 'BX', 11: 'SN', 14: 'SN123400' })
+        yield fixed_width_entry(80, { 0: 'LO', 2: 'TIP0000', 10: time_str(departure), 15: time_str(departure),
+                                      19: '1', 39: 'TB' })
+        for stop in range(1, 11):
+            at = departure + stop * 5
+            yield fixed_width_entry(80, { 0: 'LI', 2: f'TIP{ stop:04}', 10: time_str(at), 15: time_str(at + 1),
+                                          25: time_str(at), 29: time_str(at + 1), 33: '2', 42: 'T' })
+        arrival = departure + 60
+        yield fixed_width_entry(80, { 0: 'LT', 2: 'TIP0011', 10: time_str(arrival), 15: time_str(arrival),
+                                      19: '3', 25: 'TF' })
+
+def synthetic_ffl_entries(flow_count: int) -> Iterator[str]:
+    for i in range(flow_count):
+        end_date = '31122999' if i % 4 else '01012000'
+        yield fixed_width_entry(49, { 0: 'RF', 2: 'AAAA', 6: 'BBBB', 19: 'R', 20: end_date,
+                                      28: '01012020', 36: 'TOC', 42: f'{ i:07}' })
+    for i in range(flow_count):
+        for ticket in ['SDS', 'SOS', 'CDR', 'SVR', 'FOS']:
+            yield fixed_width_entry(20, { 0: 'RT', 2: f'{ i:07}', 9: ticket, 12: f'{ randint(0, 99999):08}' })
+
+def synthetic_tty_entries(ticket_count: int) -> Iterator[str]:
+    for i in range(ticket_count):
+        yield fixed_width_entry(113, { 0: 'R', 1: f'{ i % 1000:03}', 4: '31122999', 12: '01012020',
+                                       28: 'ANYTIME DAY S', 43: '2', 44: 'S', 45: 'S',
+                                       54: '009001009001004000', 72: 'NNN', 75: '00', 98: 'N',
+                                       99: 'SOS', 103: '00', 105: '0', 106: 'Y', 107: 'N',
+                                       108: '100', 111: '01' })
+
+# NOTE: The parsers as they were before the record decoders were compiled from
+#       field specs, slicing and parsing every field of every line, kept as a baseline
+def baseline_has_entry_expired(start: datetime.date, end: datetime.date) -> bool:
+    if datetime.date.today() < start:
+        return True
+    if end.year >= 2999:
+        return False
+    return datetime.date.today() > end
+
+def baseline_record_for_ffl_entry(entry: str, state: State) -> list[Record]:
+    entry_type = entry[:2]
+    if entry_type == 'RF':
+        flow_id = int(entry[42:49])
+        end_date = parse_date_ddmmyyyy(entry[20:28])
+        start_date = parse_date_ddmmyyyy(entry[28:36])
+        if baseline_has_entry_expired(start_date, end_date):
+            state.expired_flow_ids.add(flow_id)
+            return []
+
+        return [(FlowRecord, dict(
+            flow_id = flow_id,
+            origin_code = entry[2:6],
+            destination_code = entry[6:10],
+            direction = entry[19],
+            toc = entry[36:39],
+            end_date = end_date,
+            start_date = start_date))]
+
+    if entry_type == 'RT':
+        flow_id = int(entry[2:9])
+        if flow_id in state.expired_flow_ids:
+            return []
+
+        return [(FareRecord, dict(
+            flow_id = flow_id,
+            ticket_code = entry[9:12],
+            fare = int(entry[12:20])))]
+    return []
+
+def baseline_record_for_tty_entry(entry: str, _: State) -> list[Record]:
+    if entry[:1] == 'R':
+        end_date = parse_date_ddmmyyyy(entry[4:12])
+        start_date = parse_date_ddmmyyyy(entry[12:20])
+        if baseline_has_entry_expired(start_date, end_date):
+            return []
+
+        return [(TicketType, dict(
+            ticket_code = entry[1:4],
+            description = entry[28:43].strip(),
+            tkt_class = int(entry[43]),
+            tkt_type = entry[44],
+            tkt_group = entry[45],
+            max_passengers = int(entry[54:57]),
+            min_passengers = int(entry[57:60]),
+            max_adults = int(entry[60:63]),
+            min_adults = int(entry[63:66]),
+            max_children = int(entry[66:69]),
+            min_children = int(entry[69:72]),
+            restricted_by_date = entry[72] == 'Y',
+            restricted_by_train = entry[73] == 'Y',
+            restricted_by_area = entry[74] == 'Y',
+            validity_code = entry[75:77],
+            reservation_required = entry[98],
+            capri_code = entry[99:102],
+            uts_code = entry[103:105],
+            time_restriction = int(entry[105]),
+            free_pass_lul = entry[106] == 'Y',
+            package_mkr = entry[107],
+            fare_multiplier = int(entry[108:111]),
+            discount_category = entry[111:113]))]
+    return []
+
+def baseline_record_for_mca_entry(entry: str, state: State) -> list[Record]:
+    entry_type = entry[:2]
+    if entry_type == 'BS':
+        state.reset()
+
+        train_uid = entry[3:9]
+        if train_uid in state.duplicate_trains:
+            return []
+
+        days_run = entry[21:28]
+        state.duplicate_trains.add(train_uid)
+        state.current_train = dict(
+            train_uid = train_uid,
+            date_runs_from = date_to_sql(parse_date_yymmdd(entry[9:15])),
+            date_runs_to = date_to_sql(parse_date_yymmdd(entry[15:21])),
+            monday = days_run[0] == '1',
+            tuesday = days_run[1] == '1',
+            wednesday = days_run[2] == '1',
+            thursday = days_run[3] == '1',
+            friday = days_run[4] == '1',
+            saturday = days_run[5] == '1',
+            sunday = days_run[6] == '1',
+            bank_holiday_running = (entry[28] == 'Y'))
+        return []
+
+    if entry_type == 'BX':
+        if state.current_train is None:
+            return []
+
+        state.has_extra_details_record = True
+        state.current_train['rsid'] = entry[14:22]
+        state.current_train['toc'] = entry[11:13]
+        return []
+
+    if entry_type == 'LO':
+        if state.current_train is None or not state.has_extra_details_record:
+            return []
+
+        state.train_route_index += 1
+        return [(TimetableLocation, dict(
+            train_uid = state.current_train['train_uid'],
+            train_route_index = state.train_route_index - 1,
+            location_type = TimetableLocationType.Origin,
+            location = entry[2:10].strip(),
+            scheduled_departure_time = time_to_sql(parse_time(entry[10:15])),
+            public_departure = parse_time(entry[15:19]),
+            platform = entry[19:22].strip(),
+            line = entry[22:25].strip(),
+            engineering_allowance = entry[25:27].strip(),
+            pathing_allowance = entry[27:29].strip(),
+            activity = entry[39:41].strip(),
+            performance_allowance = entry[41:43].strip()))]
+
+    if entry_type == 'LI':
+        if state.current_train is None or not state.has_extra_details_record:
+            return []
+
+        # Ignore stations we don't stop at
+        if len(entry[20:25].strip()) != 0:
+            return []
+
+        state.train_route_index += 1
+        return [(TimetableLocation, dict(
+            train_uid = state.current_train['train_uid'],
+            train_route_index = state.train_route_index - 1,
+            location_type = TimetableLocationType.Intermediate,
+            location = entry[2:10].strip(),
+            scheduled_arrival_time = time_to_sql(parse_time(entry[10:15])),
+            scheduled_departure_time = time_to_sql(parse_time(entry[15:20])),
+            public_arrival = parse_time(entry[25:29]),
+            public_departure = parse_time(entry[29:33]),
+            platform = entry[33:36].strip(),
+            line = entry[36:39].strip(),
+            path = entry[39:42].strip(),
+            activity = entry[42:54].strip(),
+            engineering_allowance = entry[54:56].strip(),
+            pathing_allowance = entry[56:58].strip(),
+            performance_allowance = entry[58:60].strip()))]
+
+    if entry_type == 'LT':
+        if state.current_train is None or not state.has_extra_details_record:
+            return []
+
+        state.has_terminated = True
+        return [
+            (TrainTimetable, state.current_train),
+            (TimetableLocation, dict(
+                train_uid = state.current_train['train_uid'],
+                train_route_index = state.train_route_index,
+                location_type = TimetableLocationType.Terminating,
+                location = entry[2:10].strip(),
+                scheduled_arrival_time = time_to_sql(parse_time(entry[10:15])),
+                public_arrival = parse_time(entry[15:19]),
+                platform = entry[19:22].strip(),
+                path = entry[22:25].strip(),
+                activity = entry[25:37].strip()))
+        ]
+
+    if entry_type == 'TI':
+        return [(TIPLOC, dict(
+            tiploc_code = entry[2:9].strip(),
+            crs_code = entry[53:56],
+            description = entry[56:72].strip()))]
+    return []
+
+BASELINE_PARSERS: dict[str, Callable[[str, State], list[Record]]] = {
+    'MCA': baseline_record_for_mca_entry,
+    'FFL': baseline_record_for_ffl_entry,
+    'TTY': baseline_record_for_tty_entry,
+}
+
+def benchmark(entry_parser: Callable[[str, State], list[Record]], entries: list[str]) -> float:
+    state = State()
+    start = time.perf_counter()
+    for entry in entries:
+        entry_parser(entry, state)
+    return len(entries) / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the DTD feed entry parsers against the old per field decoding')
+    parser.add_argument('--count', '-c', help='Number of trains, flows and tickets to generate', default=20_000)
+    args = parser.parse_args()
+
+    count = int(args.count)
+    synthetic_files = [
+        ('SYNTHETIC.MCA', list(synthetic_mca_entries(count))),
+        ('SYNTHETIC.FFL', list(synthetic_ffl_entries(count))),
+        ('SYNTHETIC.TTY', list(synthetic_tty_entries(count))),
+    ]
+
+    for file, entries in synthetic_files:
+        entry_parser = entry_parser_for_file(file)
+        assert not entry_parser is None
+
+        baseline_lines_per_second = benchmark(BASELINE_PARSERS[file[-3:]], entries)
+        lines_per_second = benchmark(entry_parser, entries)
+        print(f'{ file }: { len(entries) } lines, baseline { int(baseline_lines_per_second) } lines/sec, '
+              f'now { int(lines_per_second) } lines/sec '
+              f'({ round(lines_per_second / baseline_lines_per_second, 2) }x)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+import os, sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import argparse
+import datetime
+import math
+import tempfile
+import time
+import config
+from typing import Callable
+from knowledge_base.dtd import TIPLOC, TimetableLink, TimetableLocation, TimetableLocationType, TrainTimetable
+from knowledge_base.dtd import TrainCalendar, running_days_bitmap
+from knowledge_base.feeds import Base, connect_database
+from knowledge_base.kb import Station
+from reasoning_engine.batch import route_batch
+from reasoning_engine.station_graph import load_station_coordinates, load_station_graph
+from reasoning_engine.raptor import find_journeys_raptor, route_timetable_for_date
+from reasoning_engine.routeing import RouteAndJourneys, filter_best_journeys, find_journeys_from_crs
+from reasoning_engine.routeing import SearchProgress, crs_to_tiplocs, search_paths_and_expansions
+from reasoning_engine.transfer_patterns import compile_transfer_patterns, find_journeys_transfer_patterns
+from sqlalchemy import create_engine
+from sqlalchemy.orm.session import Session, sessionmaker
+
+BENCHMARK_DATE = datetime.date(2022, 1, 4)
+BENCHMARK_TIME = datetime.time(8, 0)
+
+DATABASE_PAIRS = [
+    ('BTN', 'PRP'),
+    ('BTN', 'VIC'),
+    ('KGX', 'EDB'),
+    ('EUS', 'MAN'),
+    ('PAD', 'BRI'),
+    ('LST', 'NRW'),
+]
+
+def crs_for_index(index: int) -> str:
+    return ''.join([chr(ord('A') + (index // 26**i) % 26) for i in range(3)])
+
+def synthetic_station(line: int, position: int, stations_per_line: int, hub_count: int) -> str:
+    # NOTE: Every line starts at the same station, and crosses another at a hub half way along
+    if position == 0:
+        return 'CENTRAL'
+    if position == stations_per_line // 2:
+        return f'HUB{ line % hub_count }'
+    return f'L{ line:02}S{ position:02}'
+
+def synthetic_position(line: int, position: int, line_count: int,
+                       stations_per_line: int, hub_count: int) -> tuple[float, float]:
+    # NOTE: Lines run out from the centre like spokes, about 3km between stations,
+    #       with each hub sat on the first line through it
+    if position == 0:
+        return 51.5, -0.1
+    if position == stations_per_line // 2:
+        line = line % hub_count
+    angle = 2 * math.pi * line / line_count
+    return 51.5 + position * 0.027 * math.sin(angle), -0.1 + position * 0.043 * math.cos(angle)
+
+def synthetic_timetable(line_count: int, stations_per_line: int, hub_count: int,
+                        database_file: str = '') -> Session:
+    engine = create_engine('sqlite://' + ('' if database_file == '' else '/' + database_file))
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind = engine)()
+
+    stations: list[str] = []
+    positions: dict[str, tuple[float, float]] = {}
+    links: set[tuple[str, str]] = set()
+    trains, stops = [], []
+    for line in range(line_count):
+        line_stations = [synthetic_station(line, position, stations_per_line, hub_count)
+            for position in range(stations_per_line)]
+        stations += [station for station in line_stations if not station in stations]
+        for position, station in enumerate(line_stations):
+            positions.setdefault(station, synthetic_position(line, position, line_count, stations_per_line, hub_count))
+
+        for direction, route in enumerate([line_stations, list(reversed(line_stations))]):
+            links.update(zip(route, route[1:]))
+            for index, departure in enumerate(range(6*60 + line, 22*60, 30)):
+                train_uid = f'{ line:02}{ direction }{ index:03}'
+                trains.append(dict(train_uid = train_uid,
+                    date_runs_from = 20220101, date_runs_to = 20221231,
+                    monday = True, tuesday = True, wednesday = True, thursday = True,
+                    friday = True, saturday = True, sunday = True,
+                    bank_holiday_running = False, toc = 'SN'))
+
+                for i, location in enumerate(route):
+                    minutes = departure + i*3
+                    sql_time = (minutes // 60)*100 + minutes % 60
+                    public_time = datetime.time(minutes // 60, minutes % 60)
+                    location_type = TimetableLocationType.Intermediate
+                    if i == 0:
+                        location_type = TimetableLocationType.Origin
+                    elif i == len(route) - 1:
+                        location_type = TimetableLocationType.Terminating
+
+                    stops.append(dict(train_uid = train_uid, train_route_index = i,
+                        location_type = location_type, location = location,
+                        scheduled_arrival_time = None if i == 0 else sql_time,
+                        scheduled_departure_time = None if i == len(route) - 1 else sql_time,
+                        public_arrival = public_time, public_departure = public_time))
+
+    db.bulk_insert_mappings(TIPLOC, [dict(tiploc_code = station, crs_code = crs_for_index(i))
+        for i, station in enumerate(stations)])
+    db.bulk_insert_mappings(Station, [dict(crs_code = crs_for_index(i), name = station,
+        latitude = positions[station][0], longitude = positions[station][1])
+        for i, station in enumerate(stations)])
+    db.bulk_insert_mappings(TimetableLink, [dict(from_location = from_location, to_location = to_location)
+        for from_location, to_location in links])
+    db.bulk_insert_mappings(TrainTimetable, trains)
+    db.bulk_insert_mappings(TrainCalendar, [dict(train_uid = train['train_uid'],
+        first_date = train['date_runs_from'], running_days = running_days_bitmap(train, train['date_runs_to']))
+        for train in trains])
+    db.bulk_insert_mappings(TimetableLocation, stops)
+    db.commit()
+    return db
+
+def synthetic_pairs(db: Session, line_count: int, stations_per_line: int, hub_count: int) -> list[tuple[str, str]]:
+    def crs(line: int, position: int) -> str:
+        return db.query(TIPLOC.crs_code)\
+            .filter(TIPLOC.tiploc_code == synthetic_station(line, position, stations_per_line, hub_count))\
+            .scalar()
+
+    last = stations_per_line - 1
+    return [
+        (crs(0, 1), crs(0, 2)),
+        (crs(0, last), crs(1, last)),
+        (crs(0, last), crs(hub_count, last)),
+        (crs(2, last - 1), crs(line_count - 1, 1)),
+    ]
+
+def time_query(find: Callable[[], list[RouteAndJourneys]]) -> tuple[float, int]:
+    start = time.perf_counter()
+    route_journeys = list(find())
+    duration = time.perf_counter() - start
+    return duration, sum([len(journeys) for _, journeys in route_journeys])
+
+def compare_path_search(db: Session, from_crs: str, to_crs: str):
+    from_loc, to_loc = crs_to_tiplocs(db, from_crs)[0], crs_to_tiplocs(db, to_crs)[0]
+    results = []
+    for name, prune_detours in [('bfs', False), ('detour', True)]:
+        start = time.perf_counter()
+        paths, expansions = search_paths_and_expansions(db, 4, from_loc, to_loc,
+            prune_detours = prune_detours)
+        duration = time.perf_counter() - start
+        results.append(f'{ name } { round(duration * 1000, 1) }ms '
+            f'({ expansions } expanded, { len(paths) } paths)')
+    print(f'{ from_crs } -> { to_crs }: ' + ', '.join(results))
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the RAPTOR planner against path search and transfer pattern routing, or time batch routing')
+    parser.add_argument('--synthetic', '-s', action='store_true', help='Route over a generated network instead of the database')
+    parser.add_argument('--lines', '-l', help='Number of lines in the generated network', default=12)
+    parser.add_argument('--search', action='store_true', help='Compare detour pruned path search against plain BFS')
+    parser.add_argument('--batch', '-b', help='Route every pair over this many days with the batch router', default=0)
+    parser.add_argument('--budget', help='Seconds path search routing is given for each pair', default=None)
+    args = parser.parse_args()
+
+    database_file = config.DATABASE_FILE
+    if args.synthetic:
+        line_count, stations_per_line, hub_count = int(args.lines), 20, 4
+        database_file = os.path.join(tempfile.mkdtemp(), 'synthetic.db') if int(args.batch) > 0 else ''
+        db = synthetic_timetable(line_count, stations_per_line, hub_count, database_file)
+        pairs = synthetic_pairs(db, line_count, stations_per_line, hub_count)
+    else:
+        db = connect_database()
+        pairs = DATABASE_PAIRS
+
+    if args.search:
+        load_station_coordinates(db, load_station_graph(db))
+        for from_crs, to_crs in pairs:
+            compare_path_search(db, from_crs, to_crs)
+        return
+
+    if int(args.batch) > 0:
+        queries = [(from_crs, to_crs, BENCHMARK_DATE + datetime.timedelta(days=day))
+            for day in range(int(args.batch))
+            for from_crs, to_crs in pairs]
+        for _ in route_batch(queries, database_file = database_file):
+            pass
+        return
+
+    start = time.perf_counter()
+    route_timetable_for_date(db, BENCHMARK_DATE)
+    print(f'RAPTOR timetable built in { int((time.perf_counter() - start) * 1000) }ms')
+
+    start = time.perf_counter()
+    pattern_count = compile_transfer_patterns(db, BENCHMARK_DATE)
+    print(f'{ pattern_count } transfer patterns built in { int((time.perf_counter() - start) * 1000) }ms')
+
+    for from_crs, to_crs in pairs:
+        progress = SearchProgress(budget_seconds = None if args.budget is None else float(args.budget))
+        paths_time, paths_count = time_query(lambda: filter_best_journeys(
+            find_journeys_from_crs(db, from_crs, to_crs, BENCHMARK_DATE, progress)))
+        patterns_time, patterns_count = time_query(lambda: filter_best_journeys(
+            find_journeys_transfer_patterns(db, from_crs, to_crs, BENCHMARK_DATE)))
+        raptor_time, raptor_count = time_query(lambda:
+            find_journeys_raptor(db, from_crs, to_crs, BENCHMARK_DATE, BENCHMARK_TIME))
+
+        print(f'{ from_crs } -> { to_crs }: '
+              f'paths { round(paths_time * 1000, 1) }ms ({ paths_count } journeys'
+              f'{ "" if progress.complete else ", out of time" }), '
+              f'patterns { round(patterns_time * 1000, 1) }ms ({ patterns_count } journeys), '
+              f'raptor { round(raptor_time * 1000, 1) }ms ({ raptor_count } journeys)')
+
+if __name__ == '__main__':
+    main()
@@ -20,12 +20,44 @@ DOWNLOAD_CHUNK_SIZE = 1024 * 1024 # 1MB
 MAX_NUMBER_OF_QUEUED_BATCH_STATEMENTS = 5
 RECORD_CHUNK_SIZE = 1_00_000
 SQL_BATCH_SIZE = 10_00_000
+BULK_LOAD_CACHE_SIZE = -1024 * 1024 # 1GB, in KiB
 MAX_QUEUE_SIZE = int(SQL_BATCH_SIZE / RECORD_CHUNK_SIZE) * MAX_NUMBER_OF_QUEUED_BATCH_STATEMENTS
 
 DISABLE_DOWNLOAD = False
+SHADOW_BUILD_FEEDS = True
+SHADOW_MIN_ROW_RATIO = 0.5
+DELTA_UPDATE_FEEDS = True
+BACKGROUND_FEED_REFRESH = True
+FEED_REFRESH_RETRY_SECONDS = 60
+STREAM_DTD_FEEDS_FROM_ZIP = True
+PARALLEL_DTD_PARSE = True
+DTD_PARSE_PROCESS_COUNT = None # Use all cores
+DTD_PARSE_BLOCK_SIZE = 16 * 1024 * 1024 # 16MB
 BACKUP_DOWNLOADED_TO_LOCAL = False
 LOCAL_FEED_STORAGE_BASE = './dtd_storage'
 
+ROUTING_ENGINE = 'csa' # Either 'csa', 'raptor' or 'paths'
+ROUTE_JOURNEY_COUNT = 8
+PROFILE_WINDOW_MINUTES = 24*60
+RAPTOR_MAX_TRIPS = 5
+MIN_CHANGE_MINUTES = 1
+PATH_SEARCH_DETOUR_FACTOR = 1.5 # None searches in every direction
+PATH_SEARCH_MIN_DETOUR_KM = 10
+PATH_SEARCH_BUDGET_SHARE = 0.5 # Of the route search budget, the rest is left for finding trains
+ROUTE_SEARCH_BUDGET_SECONDS = 2.0 # None searches for as long as it takes
+ROUTE_SEARCH_STATS_FILE = None # Path to append each query's search counters to, for tuning the budget
+TIMETABLE_CACHE_SIZE = 8
+SERVICE_CALENDAR_HORIZON_DAYS = 366
+ROUTE_CACHE_SIZE = 1024
+ROUTE_CACHE_BUCKET_MINUTES = 15
+TIMETABLE_SNAPSHOT = True
+BATCH_ROUTING_PROCESS_COUNT = None # Use all cores
+BATCH_ROUTING_SHARD_SIZE = 64
+TRANSFER_PATTERNS = False # Built after each timetable refresh, from the busiest stations
+TRANSFER_PATTERN_HUB_COUNT = 40
+TRANSFER_PATTERN_SAMPLE_MINUTES = 60
+TRANSFER_PATTERN_PROCESS_COUNT = None # Use all cores
+
 STANDARD_DATE_FORMAT = '%A %B %m %Y'
 STANDARD_TIME_FORMAT = '%I:%M %p'
 STANDARD_DATE_TIME_FORMAT = '%c'
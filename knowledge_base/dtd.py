@@ -1,21 +1,29 @@
 import time
-import os
 import datetime
+import os
+import io
 import enum
+import uuid
+import config
+import multiprocessing
+import numpy as np
 from zipfile import ZipFile
-from sqlalchemy.orm.util import aliased
 from queue import Queue
-from typing import Callable, Iterable, Union
-from concurrent.futures import Executor, Future
+from collections import deque
+from typing import BinaryIO, Callable, Iterable, Iterator, Union
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
 from dataclasses import dataclass, field
-from sqlalchemy.orm.session import Session
 from sqlalchemy.sql.schema import Column, ForeignKey
-from sqlalchemy.sql.sqltypes import Boolean, Integer, String, Text
+from sqlalchemy.sql.sqltypes import Boolean, Integer, LargeBinary, String, Text
 from sqlalchemy.sql.sqltypes import Date, Enum, Time
-from knowledge_base.feeds import Base, Feed, Record, RecordChunkGenerator, RecordSet
-from knowledge_base.feeds import date_to_sql, time_to_sql
-from knowledge_base.feeds import parse_date_ddmmyyyy, parse_date_yymmdd, parse_time
+from knowledge_base.feeds import Base, ByteCountingReader, Feed, Record, RecordChunkGenerator, RecordSet
+from knowledge_base.feeds import record_from_dict, table_column_names
+from knowledge_base.feeds import date_from_sql, date_to_sql
+from knowledge_base.fixed_width import Field, FieldKind, RecordSpec
+from knowledge_base.fixed_width import compile_record_decoder, today_to_sql
 from knowledge_base.progress import Progress
+from knowledge_base.snapshot import write_snapshot
+from sqlalchemy.orm.session import Session
 
 class LocationRecord(Base):
     __tablename__ = 'location_record'
@@ -99,6 +107,30 @@ class TrainTimetable(Base):
         ]
         return day_index[day]
 
+class TrainCalendar(Base):
+    __tablename__ = 'train_calendar'
+    train_uid = Column(String(6), ForeignKey('train_timetable.train_uid'), primary_key=True)
+
+    # Little endian bitmap, where bit i is set if the train runs on first_date + i days
+    first_date = Column(Integer)
+    running_days = Column(LargeBinary)
+
+class TimetableSnapshot(Base):
+    __tablename__ = 'timetable_snapshot'
+    build_id = Column(String(32), primary_key=True)
+
+class TransferPattern(Base):
+    __tablename__ = 'transfer_pattern'
+    weekday = Column(Integer, primary_key=True)
+    from_location = Column(String(7), index=True, primary_key=True)
+    to_location = Column(String(7), index=True, primary_key=True)
+
+    # Stations changed at along the way, separated by spaces, or empty for a direct train
+    interchanges = Column(Text, primary_key=True)
+
+    # Hubs have patterns to everywhere, other stations only as far as the first hub
+    from_hub = Column(Boolean)
+
 class TimetableLocationType(enum.Enum):
     Origin = enum.auto()
     Intermediate = enum.auto()
@@ -126,6 +158,8 @@ class TimetableLink(Base):
     __tablename__ = 'timetable_link'
     from_location = Column(String(7), index=True, primary_key=True)
     to_location = Column(String(7), index=True, primary_key=True)
+    service_count = Column(Integer)
+    min_run_time = Column(Integer)
 
 class TIPLOC(Base):
     __tablename__ = 'tiploc'
@@ -161,6 +195,63 @@ class RouteLink(Base):
     map_code = Column(String(2), primary_key=True)
 """
 
+DAYS_OF_WEEK_COLUMNS = [
+    'monday', 'tuesday', 'wednesday', 'thursday',
+    'friday', 'saturday', 'sunday']
+
+def running_days_bitmap(train: dict, horizon: int) -> bytes:
+    first_date = date_from_sql(train['date_runs_from'])
+    last_date = date_from_sql(min(train['date_runs_to'], horizon))
+    day_count = (last_date - first_date).days + 1
+    if day_count <= 0:
+        return b''
+
+    week = 0
+    for i in range(7):
+        if train[DAYS_OF_WEEK_COLUMNS[(first_date.weekday() + i) % 7]]:
+            week |= 1 << i
+
+    # NOTE: Repeat the week pattern by multiplying with 0b0000001 ... 0000001
+    week_count = (day_count + 6) // 7
+    repeat = ((1 << (7 * week_count)) - 1) // 0b1111111
+    bitmap = (week * repeat) & ((1 << day_count) - 1)
+    return bitmap.to_bytes((day_count + 7) // 8, 'little')
+
+def calendar_horizon(today: int) -> int:
+    horizon = date_from_sql(today) + datetime.timedelta(days=config.SERVICE_CALENDAR_HORIZON_DAYS)
+    return date_to_sql(horizon)
+
+# Number of services for each run time in minutes, keyed by (from, to) location
+Links = dict[tuple[str, str], dict[int, int]]
+
+def run_time_minutes(departure_time: int, arrival_time: int) -> int:
+    departure = (departure_time // 100)*60 + departure_time % 100
+    arrival = (arrival_time // 100)*60 + arrival_time % 100
+    return (arrival - departure) % (24 * 60)
+
+def add_link(links: Links, from_location: str, to_location: str,
+             run_time: int, service_count: int = 1):
+    run_times = links.setdefault((from_location, to_location), {})
+    run_times[run_time] = run_times.get(run_time, 0) + service_count
+    if run_times[run_time] == 0:
+        del run_times[run_time]
+    if len(run_times) == 0:
+        del links[(from_location, to_location)]
+
+def merge_links(links: Links, other: Links):
+    for (from_location, to_location), run_times in other.items():
+        for run_time, service_count in run_times.items():
+            add_link(links, from_location, to_location, run_time, service_count)
+
+def records_for_links(links: Links) -> list[Record]:
+    return [
+        record_from_dict(TimetableLink, dict(
+            from_location = from_location,
+            to_location = to_location,
+            service_count = sum(run_times.values()),
+            min_run_time = min(run_times.keys())))
+        for (from_location, to_location), run_times in links.items()]
+
 @dataclass
 class State:
     current_train: Union[dict, None] = None
@@ -168,121 +259,229 @@ class State:
     has_terminated: bool = False
     has_extra_details_record: bool = False
     last_route_id: int = 0
+    today: int = field(default_factory=today_to_sql)
+    horizon: int = field(init=False)
+
+    # Location and departure time of the last stop
+    last_stop: Union[tuple[str, int], None] = None
+    links: Links = field(default_factory=dict)
 
     expired_flow_ids: set[int] = field(default_factory=set)
     duplicate_trains: set[str] = field(default_factory=set)
 
+    def __post_init__(self):
+        self.horizon = calendar_horizon(self.today)
+
     def reset(self):
         self.current_train = None
         self.train_route_index = 0
         self.has_terminated = False
         self.has_extra_details_record = False
-
-def record_for_loc_entry(entry: str, _: State) -> list[Record]:
-    entry_type = entry[:2]
-    if entry_type == 'RL':
-        end_date = parse_date_ddmmyyyy(entry[9:17])
-        start_date = parse_date_ddmmyyyy(entry[17:25])
-        if has_entry_expired(start_date, end_date):
+        self.last_stop = None
+
+    def stop_at(self, location: str, arrival_time: int, departure_time: Union[int, None]):
+        if not self.last_stop is None:
+            last_location, last_departure_time = self.last_stop
+            add_link(self.links, last_location, location,
+                run_time_minutes(last_departure_time, arrival_time))
+
+        if not departure_time is None:
+            self.last_stop = (location, departure_time)
+
+decode_rl_entry = compile_record_decoder(RecordSpec(
+    valid_to = 9, valid_from = 17,
+    fields = [
+        Field('uic_code', 2, 9),
+        Field('ncl_code', 36, 40),
+        Field('crs_code', 56, 59),
+    ]),
+    table_column_names(LocationRecord))
+
+decode_rf_entry = compile_record_decoder(RecordSpec(
+    valid_to = 20, valid_from = 28,
+    fields = [
+        Field('flow_id', 42, 49, FieldKind.Int),
+        Field('origin_code', 2, 6),
+        Field('destination_code', 6, 10),
+        Field('direction', 19, 20),
+        Field('toc', 36, 39),
+        Field('end_date', 20, 28, FieldKind.DateDDMMYYYY),
+        Field('start_date', 28, 36, FieldKind.DateDDMMYYYY),
+    ]),
+    table_column_names(FlowRecord))
+
+decode_rt_entry = compile_record_decoder(RecordSpec(
+    fields = [
+        Field('flow_id', 2, 9, FieldKind.Int),
+        Field('ticket_code', 9, 12),
+        Field('fare', 12, 20, FieldKind.Int),
+    ]),
+    table_column_names(FareRecord))
+
+decode_fsc_entry = compile_record_decoder(RecordSpec(
+    valid_to = 9, valid_from = 17,
+    fields = [
+        Field('cluster_id', 1, 5),
+        Field('location_nlc', 5, 9),
+    ]),
+    table_column_names(StationCluster))
+
+decode_r_entry = compile_record_decoder(RecordSpec(
+    valid_to = 4, valid_from = 12,
+    fields = [
+        Field('ticket_code', 1, 4),
+        Field('description', 28, 43, FieldKind.Stripped),
+        Field('tkt_class', 43, 44, FieldKind.Int),
+        Field('tkt_type', 44, 45),
+        Field('tkt_group', 45, 46),
+        Field('max_passengers', 54, 57, FieldKind.Int),
+        Field('min_passengers', 57, 60, FieldKind.Int),
+        Field('max_adults', 60, 63, FieldKind.Int),
+        Field('min_adults', 63, 66, FieldKind.Int),
+        Field('max_children', 66, 69, FieldKind.Int),
+        Field('min_children', 69, 72, FieldKind.Int),
+        Field('restricted_by_date', 72, 73, FieldKind.YesFlag),
+        Field('restricted_by_train', 73, 74, FieldKind.YesFlag),
+        Field('restricted_by_area', 74, 75, FieldKind.YesFlag),
+        Field('validity_code', 75, 77),
+        Field('reservation_required', 98, 99),
+        Field('capri_code', 99, 102),
+        Field('uts_code', 103, 105),
+        Field('time_restriction', 105, 106, FieldKind.Int),
+        Field('free_pass_lul', 106, 107, FieldKind.YesFlag),
+        Field('package_mkr', 107, 108),
+        Field('fare_multiplier', 108, 111, FieldKind.Int),
+        Field('discount_category', 111, 113),
+    ]),
+    table_column_names(TicketType))
+
+decode_bs_entry = compile_record_decoder(RecordSpec(
+    fields = [
+        Field('train_uid', 3, 9),
+        Field('date_runs_from', 9, 15, FieldKind.SQLDateYYMMDD),
+        Field('date_runs_to', 15, 21, FieldKind.SQLDateYYMMDD),
+        Field('monday', 21, 22, FieldKind.DayFlag),
+        Field('tuesday', 22, 23, FieldKind.DayFlag),
+        Field('wednesday', 23, 24, FieldKind.DayFlag),
+        Field('thursday', 24, 25, FieldKind.DayFlag),
+        Field('friday', 25, 26, FieldKind.DayFlag),
+        Field('saturday', 26, 27, FieldKind.DayFlag),
+        Field('sunday', 27, 28, FieldKind.DayFlag),
+        Field('bank_holiday_running', 28, 29, FieldKind.YesFlag),
+    ]))
+
+decode_bx_entry = compile_record_decoder(RecordSpec(
+    fields = [
+        Field('rsid', 14, 22),
+        Field('toc', 11, 13),
+    ]))
+
+decode_lo_entry = compile_record_decoder(RecordSpec(
+    arguments = ('train_uid', 'train_route_index'),
+    constants = { 'location_type': TimetableLocationType.Origin },
+    fields = [
+        Field('location', 2, 10, FieldKind.Stripped),
+        Field('scheduled_departure_time', 10, 15, FieldKind.SQLTime),
+        Field('public_departure', 15, 19, FieldKind.Time),
+        Field('platform', 19, 22, FieldKind.Stripped),
+        Field('line', 22, 25, FieldKind.Stripped),
+        Field('engineering_allowance', 25, 27, FieldKind.Stripped),
+        Field('pathing_allowance', 27, 29, FieldKind.Stripped),
+        Field('activity', 39, 41, FieldKind.Stripped),
+        Field('performance_allowance', 41, 43, FieldKind.Stripped),
+    ]),
+    table_column_names(TimetableLocation))
+
+decode_li_entry = compile_record_decoder(RecordSpec(
+    arguments = ('train_uid', 'train_route_index'),
+    constants = { 'location_type': TimetableLocationType.Intermediate },
+    fields = [
+        Field('location', 2, 10, FieldKind.Stripped),
+        Field('scheduled_arrival_time', 10, 15, FieldKind.SQLTime),
+        Field('scheduled_departure_time', 15, 20, FieldKind.SQLTime),
+        Field('public_arrival', 25, 29, FieldKind.Time),
+        Field('public_departure', 29, 33, FieldKind.Time),
+        Field('platform', 33, 36, FieldKind.Stripped),
+        Field('line', 36, 39, FieldKind.Stripped),
+        Field('path', 39, 42, FieldKind.Stripped),
+        Field('activity', 42, 54, FieldKind.Stripped),
+        Field('engineering_allowance', 54, 56, FieldKind.Stripped),
+        Field('pathing_allowance', 56, 58, FieldKind.Stripped),
+        Field('performance_allowance', 58, 60, FieldKind.Stripped),
+    ]),
+    table_column_names(TimetableLocation))
+
+decode_lt_entry = compile_record_decoder(RecordSpec(
+    arguments = ('train_uid', 'train_route_index'),
+    constants = { 'location_type': TimetableLocationType.Terminating },
+    fields = [
+        Field('location', 2, 10, FieldKind.Stripped),
+        Field('scheduled_arrival_time', 10, 15, FieldKind.SQLTime),
+        Field('public_arrival', 15, 19, FieldKind.Time),
+        Field('platform', 19, 22, FieldKind.Stripped),
+        Field('path', 22, 25, FieldKind.Stripped),
+        Field('activity', 25, 37, FieldKind.Stripped),
+    ]),
+    table_column_names(TimetableLocation))
+
+decode_ti_entry = compile_record_decoder(RecordSpec(
+    fields = [
+        Field('tiploc_code', 2, 9, FieldKind.Stripped),
+        Field('crs_code', 53, 56),
+        Field('description', 56, 72, FieldKind.Stripped),
+    ]),
+    table_column_names(TIPLOC))
+
+TRAIN_UID = table_column_names(TimetableLocation).index('train_uid')
+TRAIN_ROUTE_INDEX = table_column_names(TimetableLocation).index('train_route_index')
+LOCATION = table_column_names(TimetableLocation).index('location')
+SCHEDULED_ARRIVAL_TIME = table_column_names(TimetableLocation).index('scheduled_arrival_time')
+SCHEDULED_DEPARTURE_TIME = table_column_names(TimetableLocation).index('scheduled_departure_time')
+
+def record_for_loc_entry(entry: str, state: State) -> list[Record]:
+    if entry[:2] == 'RL':
+        row = decode_rl_entry(entry, state.today)
+        if row is None or len(entry[56:59].strip()) == 0:
             return []
 
-        crs_code = entry[56:59]
-        if len(crs_code.strip()) == 0:
-            return []
-
-        return [(LocationRecord, dict(
-            uic_code = entry[2:9],
-            ncl_code = entry[36:40], 
-            crs_code = crs_code))]
+        return [(LocationRecord, row)]
     return []
 
-def has_entry_expired(start: datetime.date, end: datetime.date) -> bool:
-    if datetime.date.today() < start:
-        return True
-
-    # NOTE: This means there is no end date
-    if end.year >= 2999:
-        return False
-    if datetime.date.today() > end:
-        return True
-    return False
-
 def record_for_ffl_entry(entry: str, state: State) -> list[Record]:
     entry_type = entry[:2]
     if entry_type == 'RF':
-        flow_id = int(entry[42:49])
-        end_date = parse_date_ddmmyyyy(entry[20:28])
-        start_date = parse_date_ddmmyyyy(entry[28:36])
-        if has_entry_expired(start_date, end_date):
-            state.expired_flow_ids.add(flow_id)
+        row = decode_rf_entry(entry, state.today)
+        if row is None:
+            state.expired_flow_ids.add(int(entry[42:49]))
             return []
 
-        return [(FlowRecord, dict(
-            flow_id = flow_id,
-            origin_code = entry[2:6],
-            destination_code = entry[6:10],
-            direction = entry[19],
-            toc = entry[36:39],
-            end_date = end_date,
-            start_date = start_date))]
+        return [(FlowRecord, row)]
 
     if entry_type == 'RT':
-        flow_id = int(entry[2:9])
-        if flow_id in state.expired_flow_ids:
+        if int(entry[2:9]) in state.expired_flow_ids:
             return []
 
-        return [(FareRecord, dict(
-            flow_id = flow_id,
-            ticket_code = entry[9:12],
-            fare = int(entry[12:20])))]
+        return [(FareRecord, decode_rt_entry(entry))]
 
     return []
 
-def record_for_fsc_entry(entry: str, _: State) -> list[Record]:
+def record_for_fsc_entry(entry: str, state: State) -> list[Record]:
     if len(entry) == 0 or entry[0] == '/':
         return []
 
-    end_date = parse_date_ddmmyyyy(entry[9:17])
-    start_date = parse_date_ddmmyyyy(entry[17:25])
-    if has_entry_expired(start_date, end_date):
+    row = decode_fsc_entry(entry, state.today)
+    if row is None:
         return []
 
-    return [(StationCluster, dict(
-        cluster_id = entry[1:5],
-        location_nlc = entry[5:9]))]
+    return [(StationCluster, row)]
 
-def record_for_tty_entry(entry: str, _: State) -> list[Record]:
-    entry_type = entry[:1]
-    if entry_type == 'R':
-        end_date = parse_date_ddmmyyyy(entry[4:12])
-        start_date = parse_date_ddmmyyyy(entry[12:20])
-        if has_entry_expired(start_date, end_date):
+def record_for_tty_entry(entry: str, state: State) -> list[Record]:
+    if entry[:1] == 'R':
+        row = decode_r_entry(entry, state.today)
+        if row is None:
             return []
 
-        return [(TicketType, dict(
-            ticket_code = entry[1:4],
-            description = entry[28:43].strip(),
-            tkt_class = int(entry[43]),
-            tkt_type = entry[44],
-            tkt_group = entry[45],
-            max_passengers = int(entry[54:57]),
-            min_passengers = int(entry[57:60]),
-            max_adults = int(entry[60:63]),
-            min_adults = int(entry[63:66]),
-            max_children = int(entry[66:69]),
-            min_children = int(entry[69:72]),
-            restricted_by_date = entry[72] == 'Y',
-            restricted_by_train = entry[73] == 'Y',
-            restricted_by_area = entry[74] == 'Y',
-            validity_code = entry[75:77],
-            reservation_required = entry[98],
-            capri_code = entry[99:102],
-            uts_code = entry[103:105],
-            time_restriction = int(entry[105]),
-            free_pass_lul = entry[106] == 'Y',
-            package_mkr = entry[107],
-            fare_multiplier = int(entry[108:111]),
-            discount_category = entry[111:113]))]
+        return [(TicketType, row)]
 
     return []
 
@@ -295,20 +494,8 @@ def record_for_mca_entry(entry: str, state: State) -> list[Record]:
         if train_uid in state.duplicate_trains:
             return []
 
-        days_run = entry[21:28]
         state.duplicate_trains.add(train_uid)
-        state.current_train = dict(
-            train_uid = train_uid,
-            date_runs_from = date_to_sql(parse_date_yymmdd(entry[9:15])),
-            date_runs_to = date_to_sql(parse_date_yymmdd(entry[15:21])),
-            monday = days_run[0] == '1',
-            tuesday = days_run[1] == '1',
-            wednesday = days_run[2] == '1',
-            thursday = days_run[3] == '1',
-            friday = days_run[4] == '1',
-            saturday = days_run[5] == '1',
-            sunday = days_run[6] == '1',
-            bank_holiday_running = (entry[28] == 'Y'))
+        state.current_train = decode_bs_entry(entry)
         return []
 
     if entry_type == 'BX':
@@ -317,8 +504,7 @@ def record_for_mca_entry(entry: str, state: State) -> list[Record]:
 
         assert not state.has_extra_details_record
         state.has_extra_details_record = True
-        state.current_train['rsid'] = entry[14:22]
-        state.current_train['toc'] = entry[11:13]
+        state.current_train.update(decode_bx_entry(entry))
         return []
 
     if entry_type == 'LO':
@@ -327,19 +513,10 @@ def record_for_mca_entry(entry: str, state: State) -> list[Record]:
 
         assert not state.has_terminated
         state.train_route_index += 1
-        return [(TimetableLocation, dict(
-            train_uid = state.current_train['train_uid'],
-            train_route_index = state.train_route_index - 1,
-            location_type = TimetableLocationType.Origin,
-            location = entry[2:10].strip(),
-            scheduled_departure_time = time_to_sql(parse_time(entry[10:15])),
-            public_departure = parse_time(entry[15:19]),
-            platform = entry[19:22].strip(),
-            line = entry[22:25].strip(),
-            engineering_allowance = entry[25:27].strip(),
-            pathing_allowance = entry[27:29].strip(),
-            activity = entry[39:41].strip(),
-            performance_allowance = entry[41:43].strip()))]
+        row = decode_lo_entry(entry,
+            state.current_train['train_uid'], state.train_route_index - 1)
+        state.last_stop = (row[LOCATION], row[SCHEDULED_DEPARTURE_TIME])
+        return [(TimetableLocation, row)]
 
     if entry_type == 'LI':
         if state.current_train is None or not state.has_extra_details_record:
@@ -352,22 +529,10 @@ def record_for_mca_entry(entry: str, state: State) -> list[Record]:
 
         assert not state.has_terminated
         state.train_route_index += 1
-        return [(TimetableLocation, dict(
-            train_uid = state.current_train['train_uid'],
-            train_route_index = state.train_route_index - 1,
-            location_type = TimetableLocationType.Intermediate,
-            location = entry[2:10].strip(),
-            scheduled_arrival_time = time_to_sql(parse_time(entry[10:15])),
-            scheduled_departure_time = time_to_sql(parse_time(entry[15:20])),
-            public_arrival = parse_time(entry[25:29]),
-            public_departure = parse_time(entry[29:33]),
-            platform = entry[33:36].strip(),
-            line = entry[36:39].strip(),
-            path = entry[39:42].strip(),
-            activity = entry[42:54].strip(),
-            engineering_allowance = entry[54:56].strip(),
-            pathing_allowance = entry[56:58].strip(),
-            performance_allowance = entry[58:60].strip()))]
+        row = decode_li_entry(entry,
+            state.current_train['train_uid'], state.train_route_index - 1)
+        state.stop_at(row[LOCATION], row[SCHEDULED_ARRIVAL_TIME], row[SCHEDULED_DEPARTURE_TIME])
+        return [(TimetableLocation, row)]
 
     if entry_type == 'LT':
         if state.current_train is None or not state.has_extra_details_record:
@@ -376,25 +541,20 @@ def record_for_mca_entry(entry: str, state: State) -> list[Record]:
         assert not state.has_terminated
         state.has_terminated = True
 
+        row = decode_lt_entry(entry,
+            state.current_train['train_uid'], state.train_route_index)
+        state.stop_at(row[LOCATION], row[SCHEDULED_ARRIVAL_TIME], None)
         return [
-            (TrainTimetable, state.current_train),
-            (TimetableLocation, dict(
-                train_uid = state.current_train['train_uid'],
-                train_route_index = state.train_route_index,
-                location_type = TimetableLocationType.Terminating,
-                location = entry[2:10].strip(),
-                scheduled_arrival_time = time_to_sql(parse_time(entry[10:15])),
-                public_arrival = parse_time(entry[15:19]),
-                platform = entry[19:22].strip(),
-                path = entry[22:25].strip(),
-                activity = entry[25:37].strip()))
+            record_from_dict(TrainTimetable, state.current_train),
+            (TrainCalendar, (
+                state.current_train['train_uid'],
+                state.current_train['date_runs_from'],
+                running_days_bitmap(state.current_train, state.horizon))),
+            (TimetableLocation, row),
         ]
 
     if entry_type == 'TI':
-        return [(TIPLOC, dict(
-            tiploc_code = entry[2:9].strip(),
-            crs_code = entry[53:56],
-            description = entry[56:72].strip()))]
+        return [(TIPLOC, decode_ti_entry(entry))]
 
     return []
 
@@ -466,29 +626,191 @@ def entry_parser_for_file(file: str) -> Union[Callable[[str, State], list[Record
     }
     return parser_map.get(file[-3:])
 
+def records_in_dtd_stream(chunk_queue: Queue[RecordSet],
+                          entry_parser: Callable[[str, State], list[Record]],
+                          entries: Iterable[str], file: str,
+                          bytes_processed: Callable[[], int], total_size_bytes: int,
+                          progress: Progress):
+    with RecordChunkGenerator(chunk_queue) as chunk_generator:
+        last_progress_report = 0
+        state = State()
+        for entry_line in entries:
+            if time.time() - last_progress_report >= 1:
+                progress.report(file, bytes_processed(), total_size_bytes)
+                last_progress_report = time.time()
+
+            for record in entry_parser(entry_line.strip(), state):
+                chunk_generator.put(record)
+
+        for record in records_for_links(state.links):
+            chunk_generator.put(record)
+    progress.report(file, total_size_bytes, total_size_bytes)
+
+def block_split_prefix_for_file(file: str) -> Union[bytes, None]:
+    # NOTE: Blocks must start on an entry that doesn't depend on any
+    #       earlier parser state, so timetables are split on basic schedules
+    split_prefix_map = {
+        'MCA': b'BS',
+        'FFL': b'',
+    }
+    return split_prefix_map.get(file[-3:])
+
+def dtd_blocks(stream: BinaryIO, split_prefix: bytes) -> Iterator[bytes]:
+    pending = b''
+    while True:
+        data = stream.read(config.DTD_PARSE_BLOCK_SIZE)
+        if len(data) == 0:
+            break
+
+        pending += data
+        split_index = pending.rfind(b'\n' + split_prefix)
+        if split_index == -1:
+            continue
+
+        yield pending[:split_index + 1]
+        pending = pending[split_index + 1:]
+
+    if len(pending) > 0:
+        yield pending
+
+def records_in_dtd_block(entry_parser: Callable[[str, State], list[Record]],
+                         block: bytes) -> tuple[list[RecordSet], State]:
+    chunk_queue: Queue[RecordSet] = Queue()
+    with RecordChunkGenerator(chunk_queue) as chunk_generator:
+        state = State()
+        for entry_line in io.TextIOWrapper(io.BytesIO(block)):
+            for record in entry_parser(entry_line.strip(), state):
+                chunk_generator.put(record)
+    return list(chunk_queue.queue), state
+
+def remove_links_for_trains(links: Links, chunks: list[RecordSet], train_uids: set[str]):
+    stops_by_train_uid: dict[str, list[tuple]] = {}
+    for chunk in chunks:
+        if not TimetableLocation in chunk:
+            continue
+
+        for stop in chunk[TimetableLocation].rows():
+            if stop[TRAIN_UID] in train_uids:
+                stops_by_train_uid.setdefault(stop[TRAIN_UID], []).append(stop)
+
+    for stops in stops_by_train_uid.values():
+        stops.sort(key=lambda stop: stop[TRAIN_ROUTE_INDEX])
+        for from_stop, to_stop in zip(stops, stops[1:]):
+            run_time = run_time_minutes(
+                from_stop[SCHEDULED_DEPARTURE_TIME], to_stop[SCHEDULED_ARRIVAL_TIME])
+            add_link(links, from_stop[LOCATION], to_stop[LOCATION], run_time, -1)
+
+def drop_records_from_earlier_blocks(chunk: RecordSet,
+                                     earlier_trains: set[str],
+                                     earlier_expired_flow_ids: set[int]) -> RecordSet:
+    filtered_chunk: RecordSet = {}
+    for table, batch in chunk.items():
+        if len(earlier_trains) > 0 and table in [TrainTimetable, TrainCalendar, TimetableLocation]:
+            batch = batch.select('train_uid',
+                lambda train_uid: not train_uid in earlier_trains)
+
+        # NOTE: Flow records always come before their fares
+        if len(earlier_expired_flow_ids) > 0 and table == FareRecord:
+            batch = batch.select('flow_id',
+                lambda flow_id: not flow_id in earlier_expired_flow_ids)
+
+        filtered_chunk[table] = batch
+    return filtered_chunk
+
+def records_in_dtd_blocks(chunk_queue: Queue[RecordSet],
+                          entry_parser: Callable[[str, State], list[Record]],
+                          stream: BinaryIO, split_prefix: bytes, file: str,
+                          bytes_processed: Callable[[], int], total_size_bytes: int,
+                          progress: Progress):
+    seen_trains: set[str] = set()
+    expired_flow_ids: set[int] = set()
+    links: Links = {}
+
+    # Merge in file order, so the first schedule for a train still wins
+    def merge_block(task: Future):
+        chunks, block_state = task.result()
+        earlier_trains = block_state.duplicate_trains.intersection(seen_trains)
+        if len(earlier_trains) > 0:
+            remove_links_for_trains(block_state.links, chunks, earlier_trains)
+
+        for chunk in chunks:
+            chunk_queue.put(drop_records_from_earlier_blocks(
+                chunk, earlier_trains, expired_flow_ids))
+
+        seen_trains.update(block_state.duplicate_trains)
+        expired_flow_ids.update(block_state.expired_flow_ids)
+        merge_links(links, block_state.links)
+        progress.report(file, bytes_processed(), total_size_bytes)
+
+    process_count = config.DTD_PARSE_PROCESS_COUNT or os.cpu_count() or 1
+    # NOTE: Feeds are refreshed from background threads, which forking doesn't copy safely
+    with ProcessPoolExecutor(process_count, mp_context=multiprocessing.get_context('spawn')) as process_pool:
+        max_pending_blocks = process_count * 2
+        pending_blocks: deque[Future] = deque()
+        for block in dtd_blocks(stream, split_prefix):
+            pending_blocks.append(process_pool.submit(records_in_dtd_block, entry_parser, block))
+            if len(pending_blocks) >= max_pending_blocks:
+                merge_block(pending_blocks.popleft())
+
+        while len(pending_blocks) > 0:
+            merge_block(pending_blocks.popleft())
+
+    with RecordChunkGenerator(chunk_queue) as chunk_generator:
+        for record in records_for_links(links):
+            chunk_generator.put(record)
+    progress.report(file, total_size_bytes, total_size_bytes)
+
+def records_in_dtd_binary_stream(chunk_queue: Queue[RecordSet],
+                                 entry_parser: Callable[[str, State], list[Record]],
+                                 stream: BinaryIO, file: str,
+                                 bytes_processed: Callable[[], int], total_size_bytes: int,
+                                 progress: Progress):
+    split_prefix = block_split_prefix_for_file(file)
+    if config.PARALLEL_DTD_PARSE and not split_prefix is None:
+        records_in_dtd_blocks(chunk_queue, entry_parser, stream, split_prefix, file,
+            bytes_processed, total_size_bytes, progress)
+        return
+
+    records_in_dtd_stream(chunk_queue, entry_parser, io.TextIOWrapper(stream), file,
+        bytes_processed, total_size_bytes, progress)
+
 def records_in_dtd_file(chunk_queue: Queue[RecordSet],
                         entry_parser: Callable[[str, State], list[Record]],
                         path: str, file: str, 
                         progress: Progress):
-    with RecordChunkGenerator(chunk_queue) as chunk_generator:
-        last_progress_report = 0
-        total_size_bytes = os.path.getsize(path + '/' + file)
-        bytes_processed = 0
+    total_size_bytes = os.path.getsize(path + '/' + file)
+    with ByteCountingReader(open(path + '/' + file, 'rb')) as reader:
+        records_in_dtd_binary_stream(chunk_queue, entry_parser, reader, file,
+            lambda: reader.bytes_read, total_size_bytes, progress)
+
+def records_in_dtd_zip_member(chunk_queue: Queue[RecordSet],
+                              entry_parser: Callable[[str, State], list[Record]],
+                              zip_file_path: str, file: str,
+                              progress: Progress):
+    # NOTE: Each member gets its own handle, so progress is counted in
+    #       compressed bytes read from the ZIP for this member alone
+    with ByteCountingReader(open(zip_file_path, 'rb')) as reader, ZipFile(reader, 'r') as zip_file:
+        total_size_bytes = zip_file.getinfo(file).compress_size
+        with zip_file.open(file, 'r') as member:
+            start_offset = reader.bytes_read
+            records_in_dtd_binary_stream(chunk_queue, entry_parser, member, file,
+                lambda: reader.bytes_read - start_offset, total_size_bytes, progress)
+
+def records_in_dtd_zip(executor: Executor, chunk_queue: Queue[Union[RecordSet, None]],
+                       zip_file_path: str, progress: Progress) -> Iterable[Future]:
+    with ZipFile(zip_file_path, 'r') as zip_file:
+        files = zip_file.namelist()
 
-        with open(path + '/' + file, 'r') as f:
-            state = State()
-            line_no = 0
-            for entry_line in f:
-                line_no += 1
+    tasks: list[Future] = []
+    for file in files:
+        entry_parser = entry_parser_for_file(file)
+        if entry_parser is None:
+            continue
 
-                bytes_processed += len(entry_line)
-                if time.time() - last_progress_report >= 1:
-                    progress.report(file, bytes_processed, total_size_bytes)
-                    last_progress_report = time.time()
+        tasks.append(executor.submit(records_in_dtd_zip_member,
+            chunk_queue, entry_parser, zip_file_path, file, progress))
 
-                for record in entry_parser(entry_line.strip(), state):
-                    chunk_generator.put(record)
-        progress.report(file, total_size_bytes, total_size_bytes)
+    return tasks
 
 def records_in_dtd_file_set(executor: Executor, chunk_queue: Queue[Union[RecordSet, None]],
                             path: str, progress: Progress) -> Iterable[Future]:
@@ -503,21 +825,84 @@ def records_in_dtd_file_set(executor: Executor, chunk_queue: Queue[Union[RecordS
 
     return tasks
 
-def generate_precomputed_tables(db: Session):
-    from_station = aliased(TimetableLocation)
-    to_station = aliased(TimetableLocation)
-    select = db.query(from_station.location, to_station.location)\
-        .select_from(from_station, to_station)\
-        .distinct()\
-        .filter(to_station.train_uid == from_station.train_uid)\
-        .filter(to_station.train_route_index == from_station.train_route_index + 1)
-
-    statement = TimetableLink.__table__\
-        .insert()\
-        .from_select(['from_location', 'to_location'], select.statement)
-    db.execute(statement)
+def timetable_snapshot_prefix() -> str:
+    base, _ = os.path.splitext(config.DATABASE_FILE)
+    return base + '.timetable.'
+
+def timetable_snapshot_path(build_id: str) -> str:
+    return f'{ timetable_snapshot_prefix() }{ build_id }.snapshot'
+
+def remove_old_timetable_snapshots(keep: int):
+    directory, prefix = os.path.split(timetable_snapshot_prefix())
+    directory = directory if directory != '' else '.'
+    paths = [os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith(prefix) and name.endswith('.snapshot')]
+
+    # NOTE: Processes still mapping a removed snapshot keep their pages until they let go
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[keep:]:
+        os.remove(path)
+
+def compile_timetable_snapshot(db: Session) -> str:
+    locations: list[str] = []
+    location_ids: dict[str, int] = {}
+    def location_id(location: str) -> int:
+        if not location in location_ids:
+            location_ids[location] = len(locations)
+            locations.append(location)
+        return location_ids[location]
+
+    tiplocs = db.query(TIPLOC.tiploc_code, TIPLOC.crs_code).all()
+    links = db.query(TimetableLink.from_location, TimetableLink.to_location).all()
+    calendars = db.query(TrainCalendar.train_uid, TrainCalendar.first_date, TrainCalendar.running_days)\
+        .order_by(TrainCalendar.train_uid)\
+        .all()
+    train_ids = { train_uid: i for i, (train_uid, _, _) in enumerate(calendars) }
+    stops = [stop
+        for stop in db.query(
+                TimetableLocation.train_uid,
+                TimetableLocation.train_route_index,
+                TimetableLocation.location,
+                TimetableLocation.scheduled_arrival_time,
+                TimetableLocation.scheduled_departure_time)\
+            .order_by(TimetableLocation.train_uid, TimetableLocation.train_route_index)\
+            .all()
+        if stop[0] in train_ids]
+
+    # Stops of train t are stop_*[stop_offsets[t]:stop_offsets[t + 1]], and
+    # the same goes for the running days bitmap of each train
+    stop_trains = np.array([train_ids[stop[0]] for stop in stops], dtype=np.int64)
+    stop_offsets = np.searchsorted(stop_trains, np.arange(len(calendars) + 1))
+    calendar_offsets = np.cumsum([0] + [len(running_days) for _, _, running_days in calendars])
+
+    arrays = {
+        'tiploc_location': np.array([location_id(tiploc) for tiploc, _ in tiplocs], dtype=np.int32),
+        'tiploc_crs': np.array([crs for _, crs in tiplocs], dtype='S3'),
+        'link_from': np.array([location_id(from_location) for from_location, _ in links], dtype=np.int32),
+        'link_to': np.array([location_id(to_location) for _, to_location in links], dtype=np.int32),
+        'train_uids': np.array([train_uid for train_uid, _, _ in calendars], dtype='S6'),
+        'calendar_first_date': np.array([first_date for _, first_date, _ in calendars], dtype=np.int32),
+        'calendar_offsets': np.array(calendar_offsets, dtype=np.int64),
+        'calendar_bits': np.frombuffer(b''.join([running_days for _, _, running_days in calendars]), dtype=np.uint8),
+        'stop_offsets': np.array(stop_offsets, dtype=np.int64),
+        'stop_route_index': np.array([stop[1] for stop in stops], dtype=np.int32),
+        'stop_location': np.array([location_id(stop[2]) for stop in stops], dtype=np.int32),
+        'stop_arrival': np.array([-1 if stop[3] is None else stop[3] for stop in stops], dtype=np.int16),
+        'stop_departure': np.array([-1 if stop[4] is None else stop[4] for stop in stops], dtype=np.int16),
+    }
+    arrays['locations'] = np.array(locations, dtype='S7')
+
+    build_id = uuid.uuid4().hex
+    write_snapshot(timetable_snapshot_path(build_id), build_id, arrays)
+    db.query(TimetableSnapshot).delete()
+    db.add(TimetableSnapshot(build_id = build_id))
     db.commit()
 
+    # Keep the last one around, in case this database fails to be swapped in
+    remove_old_timetable_snapshots(2)
+    return build_id
+
 class DTDFeed(Feed):
     def records_in_feed(self,
                         executor: Executor,
@@ -525,6 +910,9 @@ class DTDFeed(Feed):
                         path: str,
                         progress: Progress) -> Iterable[Future]:
         zip_file_path = os.path.join(path, self.file_name())
+        if config.STREAM_DTD_FEEDS_FROM_ZIP:
+            return records_in_dtd_zip(executor, chunk_queue, zip_file_path, progress)
+
         with ZipFile(zip_file_path, 'r') as f:
             f.extractall(path)
         os.remove(zip_file_path)
@@ -553,13 +941,26 @@ class DTDTimetableFeed(DTDFeed):
     def file_name(self) -> str:
         return 'TIMETABLE.ZIP'
 
-    def preprocess_hook(self, db: Session):
-        generate_precomputed_tables(db)
-
     def associated_tables(self) -> Iterable[type[Base]]:
         return [
             TimetableLocation, TimetableLink,
-            TrainTimetable, TIPLOC]
+            TrainTimetable, TrainCalendar, TIPLOC,
+            TimetableSnapshot, TransferPattern]
+
+    def required_tables(self) -> Iterable[type[Base]]:
+        return [
+            TimetableLocation, TimetableLink,
+            TrainTimetable, TrainCalendar, TIPLOC]
+
+    def preprocess_hook(self, db: Session):
+        if config.TIMETABLE_SNAPSHOT:
+            compile_timetable_snapshot(db)
+
+    def postprocess_hook(self, db: Session):
+        if config.TRANSFER_PATTERNS:
+            # NOTE: Imported here, as the reasoning engine is built on top of this module
+            from reasoning_engine.transfer_patterns import compile_transfer_patterns
+            compile_transfer_patterns(db, datetime.date.today())
 
 """
 class DTDRouteingFeed(DTDFeed):
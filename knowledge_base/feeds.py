@@ -10,10 +10,19 @@ import sqlalchemy
 import shutil
 import datetime
 import traceback
+import re
+import io
+import hashlib
 import config
-from typing import Iterable, TextIO, Union
+from dataclasses import dataclass
+from functools import lru_cache
+from threading import RLock
+from itertools import compress
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, TextIO, Union
 from abc import ABC, abstractmethod
-from sqlalchemy.sql.schema import Column
+from sqlalchemy import event
+from sqlalchemy.sql import func
+from sqlalchemy.sql.schema import Column, Index
 from sqlalchemy.sql.sqltypes import Integer, Text
 from queue import Queue
 from concurrent.futures import ThreadPoolExecutor, Executor, Future
@@ -26,40 +35,113 @@ from knowledge_base.progress import Progress
 Base = declarative_base()
 is_updating = False
 
-Record = tuple[type[Base], dict]
-RecordSet = dict[type[Base], list[dict]]
-
 class ExpiryTimes(Base):
     __tablename__ = 'expiry_times'
     api_url = Column(Text, primary_key=True)
     expiry_timestamp = Column(Integer)
 
+@lru_cache(maxsize=None)
+def table_column_names(table: type[Base]) -> tuple[str, ...]:
+    return tuple(column.name for column in table.__table__.columns)
+
+class RecordBatch:
+    table: type[Base]
+    column_names: tuple[str, ...]
+    columns: list[list[Any]]
+
+    def __init__(self, table: type[Base], rows: Iterable[tuple] = ()):
+        self.table = table
+        self.column_names = table_column_names(table)
+        self.columns = [list(column) for column in zip(*rows)]
+        if len(self.columns) == 0:
+            self.columns = [[] for _ in self.column_names]
+
+    def __len__(self) -> int:
+        return len(self.columns[0])
+
+    def column(self, name: str) -> list[Any]:
+        return self.columns[self.column_names.index(name)]
+
+    def extend(self, other: RecordBatch):
+        assert other.table == self.table
+        for column, other_column in zip(self.columns, other.columns):
+            column.extend(other_column)
+
+    def select(self, name: str, keep: Callable[[Any], bool]) -> RecordBatch:
+        selectors = [keep(value) for value in self.column(name)]
+        selected = RecordBatch(self.table)
+        selected.columns = [list(compress(column, selectors)) for column in self.columns]
+        return selected
+
+    def rows(self) -> Iterator[tuple]:
+        return zip(*self.columns)
+
+Record = tuple[type[Base], tuple]
+RecordSet = dict[type[Base], RecordBatch]
+
+def record_from_dict(table: type[Base], entry: dict) -> Record:
+    return table, tuple(entry.get(name) for name in table_column_names(table))
+
 class RecordChunkGenerator:
     _chunk_queue: Queue[RecordSet]
-    _chunk: RecordSet
+    _rows: dict[type[Base], list[tuple]]
     _chunk_count: int
 
     def __init__(self, chunk_queue: Queue[RecordSet]):
         self._chunk_queue = chunk_queue
-        self._chunk = {}
+        self._rows = {}
+        self._chunk_count = 0
+
+    def _flush(self):
+        self._chunk_queue.put({
+            table: RecordBatch(table, rows)
+            for table, rows in self._rows.items() })
+        self._rows = {}
         self._chunk_count = 0
 
     def put(self, record: Record):
-        table, entry = record
-        self._chunk.setdefault(table, []).append(entry)
+        table, row = record
+        self._rows.setdefault(table, []).append(row)
         self._chunk_count += 1
 
         if self._chunk_count >= config.RECORD_CHUNK_SIZE:
-            self._chunk_queue.put(self._chunk)
-            self._chunk = {}
-            self._chunk_count = 0
+            self._flush()
 
     def __enter__(self):
         return self
     
     def __exit__(self, *_):
         if self._chunk_count > 0:
-            self._chunk_queue.put(self._chunk)
+            self._flush()
+
+class ByteCountingReader(io.RawIOBase):
+    _file: BinaryIO
+    bytes_read: int
+
+    def __init__(self, file: BinaryIO):
+        self._file = file
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return self._file.seekable()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def readinto(self, buffer) -> int:
+        bytes_read = self._file.readinto(buffer)
+        self.bytes_read += bytes_read
+        return bytes_read
+
+    def close(self):
+        self._file.close()
+        super().close()
 
 class Feed(ABC):
     _registered_feeds: set[type[Feed]] = set()
@@ -91,9 +173,29 @@ class Feed(ABC):
     def preprocess_hook(self, _: Session):
         pass
 
+    # Run against the live database once the refreshed feed is being served,
+    # for work that shouldn't hold up swapping it in
+    def postprocess_hook(self, _: Session):
+        pass
+
+    def required_tables(self) -> Iterable[type[Base]]:
+        return self.associated_tables()
+
+    def delta_key(self) -> Union[str, None]:
+        # Column shared by all associated tables, which groups rows that change together.
+        # If set, refreshes only write what changed instead of reloading the whole feed
+        return None
+
     def unique_path_id(self) -> str:
         return str(hash(self.feed_api_url()))
 
+    def schema_name(self) -> str:
+        return 'feed_' + re.sub('[^0-9a-zA-Z]', '_', self.feed_api_url())
+
+    def database_file(self) -> str:
+        base, extension = os.path.splitext(config.DATABASE_FILE)
+        return f'{ base }.{ self.schema_name() }{ extension }'
+
     @staticmethod
     def register(feed: type[Feed]):
         Feed._registered_feeds.add(feed)
@@ -102,18 +204,101 @@ class Feed(ABC):
     def feeds() -> list[Feed]:
         return [feed() for feed in Feed._registered_feeds]
 
-def open_database(file: TextIO = sys.stdout) -> Session:
-    is_new_database = not os.path.exists(config.DATABASE_FILE)
-    engine = sqlalchemy.create_engine('sqlite:///' + config.DATABASE_FILE)
-    assert isinstance(engine, Engine)
+def feed_tables(feeds: Iterable[Feed]) -> list[sqlalchemy.Table]:
+    return [table.__table__ for feed in feeds for table in feed.associated_tables()]
+
+# NOTE: Every refresher thread connects on its own, so only one at a time
+#       creates or upgrades the databases, and none attach them half made
+_feed_database_lock = RLock()
+
+def attach_feed_databases(dbapi_connection, connection_record, _):
+    # NOTE: Feed files are swapped in by renaming them, so a changed
+    #       inode means this connection still sees an old snapshot
+    attached = connection_record.info.setdefault('attached_feeds', {})
+    cursor = dbapi_connection.cursor()
+    with _feed_database_lock:
+        for feed in Feed.feeds():
+            path = feed.database_file()
+            schema = feed.schema_name()
+            if not os.path.exists(path):
+                continue
+
+            version = os.stat(path).st_ino
+            if attached.get(schema) == version:
+                continue
+
+            if schema in attached:
+                cursor.execute(f'DETACH DATABASE { schema }')
+            cursor.execute(f'ATTACH DATABASE ? AS { schema }', (path,))
+            attached[schema] = version
+    cursor.close()
+
+def create_feed_database(db: Session, feed: Feed, path: str):
+    engine = sqlalchemy.create_engine('sqlite:///' + path)
+    Base.metadata.create_all(engine, tables=feed_tables([feed]))
+    engine.dispose()
+
+    # Tables in the main database would hide the attached ones
+    for table in feed_tables([feed]):
+        db.execute(f'DROP TABLE IF EXISTS main.{ table.name }')
+    db.query(ExpiryTimes)\
+        .filter(ExpiryTimes.api_url == feed.feed_api_url())\
+        .delete()
+    db.commit()
 
-    Base.metadata.create_all(engine)
-    db = sessionmaker(bind = engine)()
-    if is_new_database:
-        db.execute('PRAGMA journal_mode = WAL')
-        db.execute('PRAGMA synchronous = NORMAL')
-        db.execute('PRAGMA cache_size = 100000')
+def upgrade_feed_database(db: Session, feed: Feed, path: str):
+    engine = sqlalchemy.create_engine('sqlite:///' + path)
+    existing_tables = set(sqlalchemy.inspect(engine).get_table_names())
+    missing_tables = [table for table in feed_tables([feed]) if not table.name in existing_tables]
+    if len(missing_tables) > 0:
+        Base.metadata.create_all(engine, tables=missing_tables)
+    engine.dispose()
+
+    # NOTE: New tables start empty, so the feed needs to be fetched again to fill them
+    if len(missing_tables) > 0:
+        db.query(ExpiryTimes)\
+            .filter(ExpiryTimes.api_url == feed.feed_api_url())\
+            .delete()
+        db.commit()
+
+def connect_database() -> Session:
+    with _feed_database_lock:
+        is_new_database = not os.path.exists(config.DATABASE_FILE)
+        engine = sqlalchemy.create_engine('sqlite:///' + config.DATABASE_FILE)
+        assert isinstance(engine, Engine)
+
+        if not config.SHADOW_BUILD_FEEDS:
+            Base.metadata.create_all(engine)
+        else:
+            event.listen(engine, 'checkout', attach_feed_databases)
+            all_feed_tables = feed_tables(Feed.feeds())
+            Base.metadata.create_all(engine, tables=[
+                table for table in Base.metadata.sorted_tables
+                if not table in all_feed_tables])
+
+        db = sessionmaker(bind = engine)()
+        if is_new_database:
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+            db.execute('PRAGMA cache_size = 100000')
+
+        if config.SHADOW_BUILD_FEEDS:
+            for feed in Feed.feeds():
+                if not os.path.exists(feed.database_file()):
+                    create_feed_database(db, feed, feed.database_file())
+                else:
+                    upgrade_feed_database(db, feed, feed.database_file())
+        return db
+
+def connect_read_only_database(database_file: str) -> Session:
+    # NOTE: Never writes, so any number of processes can read alongside a refresh
+    engine = sqlalchemy.create_engine(f'sqlite:///file:{ database_file }?mode=ro&uri=true')
+    if config.SHADOW_BUILD_FEEDS:
+        event.listen(engine, 'checkout', attach_feed_databases)
+    return sessionmaker(bind = engine)()
 
+def open_database(file: TextIO = sys.stdout) -> Session:
+    db = connect_database()
     update_database(db, file)
     return db
 
@@ -211,13 +396,46 @@ def report_flushing_progress(progress: Progress,
         written, 
         written + chunk + queue_size*config.RECORD_CHUNK_SIZE)
 
+def insert_statement(db: Session, table: type[Base]) -> str:
+    dialect = db.get_bind().dialect
+    column_names = table_column_names(table)
+    statement = table.__table__.insert().compile(dialect=dialect, column_keys=list(column_names))
+    assert statement.positiontup == list(column_names)
+    return str(statement)
+
+def bind_processed_columns(db: Session, batch: RecordBatch) -> list[list[Any]]:
+    dialect = db.get_bind().dialect
+    table = batch.table.__table__
+
+    # Convert each distinct value once, then map the whole column
+    columns = []
+    for name in batch.column_names:
+        values = batch.column(name)
+        processor = table.columns[name].type.dialect_impl(dialect).bind_processor(dialect)
+        if processor is None:
+            columns.append(values)
+            continue
+
+        processed = { value: processor(value) for value in set(values) }
+        columns.append(list(map(processed.__getitem__, values)))
+    return columns
+
+def insert_record_batch(db: Session, batch: RecordBatch):
+    if len(batch) == 0:
+        return
+
+    cursor = db.connection().connection.cursor()
+    cursor.executemany(insert_statement(db, batch.table),
+        zip(*bind_processed_columns(db, batch)))
+    cursor.close()
+
 def flush_record_chunk(db: Session, record_chunk: RecordSet, 
                        chunk_count: int, written: int, 
                        queue_size: int, progress: Progress):
     report_flushing_progress(progress, written, chunk_count, queue_size)
 
-    for table, entries in record_chunk.items():
-        db.bulk_insert_mappings(table, entries)
+    for batch in record_chunk.values():
+        insert_record_batch(db, batch)
     db.commit()
     
     report_flushing_progress(progress, written + chunk_count, 0, queue_size)
@@ -229,9 +447,12 @@ def batch_and_flush_chunks(db: Session, chunk_queue: Queue[Union[RecordSet, None
     current_chunk_count = 0
     total_records_being_written = 0
     for record_chunk in iter(chunk_queue.get, None):
-        for table, entities in record_chunk.items():
-            current_chunk.setdefault(table, []).extend(entities)
-            current_chunk_count += len(entities)
+        for table, batch in record_chunk.items():
+            if table in current_chunk:
+                current_chunk[table].extend(batch)
+            else:
+                current_chunk[table] = batch
+            current_chunk_count += len(batch)
 
         report_flushing_progress(progress, 
             total_records_being_written, current_chunk_count, chunk_queue.qsize())
@@ -254,6 +475,69 @@ def batch_and_flush_chunks(db: Session, chunk_queue: Queue[Union[RecordSet, None
             chunk_queue.qsize(), progress)
     report_flushing_progress(progress, 0, 0, 0)
 
+class BulkLoad:
+    _db: Session
+    _tables: list[type[Base]]
+    _progress: Progress
+    _dropped_indexes: list[Index]
+    _load_pragmas: dict[str, Any]
+    _restore_pragmas: dict[str, Any]
+
+    def __init__(self, db: Session, tables: Iterable[type[Base]], progress: Progress):
+        self._db = db
+        self._tables = list(tables)
+        self._progress = progress
+        self._dropped_indexes = []
+        self._load_pragmas = {
+            'synchronous': 'OFF',
+            'cache_size': config.BULK_LOAD_CACHE_SIZE,
+            'temp_store': 'MEMORY',
+        }
+        self._restore_pragmas = {}
+
+    def _set_pragmas(self, pragmas: dict[str, Any]):
+        for name, value in pragmas.items():
+            self._db.execute(f'PRAGMA { name } = { value }')
+
+    def _on_connect(self, dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for name, value in self._load_pragmas.items():
+            cursor.execute(f'PRAGMA { name } = { value }')
+        cursor.close()
+
+    def __enter__(self):
+        self._restore_pragmas = {
+            name: self._db.execute(f'PRAGMA { name }').scalar()
+            for name in self._load_pragmas.keys() }
+        self._set_pragmas(self._load_pragmas)
+
+        # NOTE: Connections may not be reused between commits
+        event.listen(self._db.get_bind(), 'connect', self._on_connect)
+
+        # NOTE: Only secondary indexes, the primary keys are kept
+        connection = self._db.connection()
+        for table in self._tables:
+            for index in table.__table__.indexes:
+                index.drop(connection, checkfirst=True)
+                self._dropped_indexes.append(index)
+        self._db.commit()
+        return self
+
+    def __exit__(self, *_):
+        self._db.rollback()
+
+        index_count = len(self._dropped_indexes)
+        connection = self._db.connection()
+        for i, index in enumerate(self._dropped_indexes):
+            self._progress.report('Building Indexes', i, index_count)
+            index.create(connection, checkfirst=True)
+        self._db.commit()
+        self._progress.report('Building Indexes', index_count, index_count)
+
+        event.remove(self._db.get_bind(), 'connect', self._on_connect)
+        self._set_pragmas(self._restore_pragmas)
+        self._dropped_indexes = []
+
 def backup_feed_file_to_storage(path: str, feed: Feed):
     storage_path = config.LOCAL_FEED_STORAGE_BASE
     file_name = feed.file_name()
@@ -267,45 +551,47 @@ def update_feeds(db: Session, executor: Executor, feeds: Iterable[Feed], file: T
     progress = Progress(file)
     data_path = tempfile.mkdtemp()
 
-    download_tasks: list[Future[tuple[Feed, str]]] = []
-    for feed in feeds:
-        download_tasks.append(executor.submit(download_feed_file,
-            token, data_path, feed, progress))
-
-        # Clear alongside downloading
-        for table in feed.associated_tables():
-            db.query(table).delete()
-
-    chunk_queue: Queue[Union[RecordSet, None]] = Queue(maxsize = config.MAX_QUEUE_SIZE)
-    write_tasks: list[Future] = []
-    for task in as_completed(download_tasks):
-        feed, path = task.result()
-
-        # Copy to local storage if enabled
-        if config.BACKUP_DOWNLOADED_TO_LOCAL:
-            backup_feed_file_to_storage(path, feed)
-
-        write_tasks += feed.records_in_feed(
-            executor, chunk_queue, path, progress)
-
-    # Write each chunk synchronously on the main thread
-    def terminate_queue_on_tasks_complete(tasks: Iterable[Future]):
-        for result in as_completed(tasks):
-            e = result.exception()
-            if not e:
-                continue
-
-            print(result, file=sys.stderr)
-            print(type(e), e, file=sys.stderr)
-            traceback.print_exception(type(e), value=e, file=sys.stderr)
-
+    tables = [table for feed in feeds for table in feed.associated_tables()]
+    with BulkLoad(db, tables, progress):
+        download_tasks: list[Future[tuple[Feed, str]]] = []
+        for feed in feeds:
+            download_tasks.append(executor.submit(download_feed_file,
+                token, data_path, feed, progress))
+
+            # Clear alongside downloading
+            for table in feed.associated_tables():
+                db.query(table).delete()
+
+        chunk_queue: Queue[Union[RecordSet, None]] = Queue(maxsize = config.MAX_QUEUE_SIZE)
+        write_tasks: list[Future] = []
+        for task in as_completed(download_tasks):
+            feed, path = task.result()
+
+            # Copy to local storage if enabled
+            if config.BACKUP_DOWNLOADED_TO_LOCAL:
+                backup_feed_file_to_storage(path, feed)
+
+            write_tasks += feed.records_in_feed(
+                executor, chunk_queue, path, progress)
+
+        # Write each chunk synchronously on the main thread
+        def terminate_queue_on_tasks_complete(tasks: Iterable[Future]):
+            for result in as_completed(tasks):
+                e = result.exception()
+                if not e:
+                    continue
+
+                print(result, file=sys.stderr)
+                print(type(e), e, file=sys.stderr)
+                traceback.print_exception(type(e), value=e, file=sys.stderr)
+
+                chunk_queue.put(None)
+                raise e
             chunk_queue.put(None)
-            raise e
-        chunk_queue.put(None)
-    wait_task = executor.submit(terminate_queue_on_tasks_complete, write_tasks)
+        wait_task = executor.submit(terminate_queue_on_tasks_complete, write_tasks)
 
-    # NOTE: We can only run SQL on the main thread
-    batch_and_flush_chunks(db, chunk_queue, progress)
+        # NOTE: We can only run SQL on the main thread
+        batch_and_flush_chunks(db, chunk_queue, progress)
     for feed in feeds:
         feed.preprocess_hook(db)
 
@@ -315,6 +601,130 @@ def update_feeds(db: Session, executor: Executor, feeds: Iterable[Feed], file: T
     # Clean up /tmp directory
     shutil.rmtree(data_path)
 
+def table_row_count(db: Session, table: type[Base]) -> int:
+    return db.query(func.count()).select_from(table).scalar()
+
+def validate_shadow_database(feed: Feed, shadow_db: Session, live_db: Session):
+    for table in feed.required_tables():
+        count = table_row_count(shadow_db, table)
+        live_count = table_row_count(live_db, table)
+        if count == 0 or count < live_count * config.SHADOW_MIN_ROW_RATIO:
+            raise Exception(
+                f"Refusing to swap in '{ feed.feed_api_url() }', "
+                f"'{ table.__tablename__ }' has { count } rows, down from { live_count }")
+
+def update_feed_in_shadow_database(db: Session, executor: Executor, feed: Feed, file: TextIO):
+    live_path = feed.database_file()
+    shadow_path = live_path + '.shadow'
+    if os.path.exists(shadow_path):
+        os.remove(shadow_path)
+
+    shadow_engine = sqlalchemy.create_engine('sqlite:///' + shadow_path)
+    Base.metadata.create_all(shadow_engine, tables=feed_tables([feed]))
+    shadow_db = sessionmaker(bind = shadow_engine)()
+    try:
+        update_feeds(shadow_db, executor, [feed], file)
+
+        # Make sure we compare against the latest snapshot
+        db.commit()
+        validate_shadow_database(feed, shadow_db, db)
+    except Exception as e:
+        shadow_db.close()
+        shadow_engine.dispose()
+        os.remove(shadow_path)
+        raise e
+
+    shadow_db.close()
+    shadow_engine.dispose()
+
+    # Readers pick up the new file the next time they check out a connection,
+    # the old one is dropped once the last of them has let go of it
+    os.replace(shadow_path, live_path)
+
+@dataclass
+class DeltaUpdate:
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+
+def stored_rows(db: Session, table: type[Base]) -> list[tuple]:
+    cursor = db.connection().connection.cursor()
+    cursor.execute(f"SELECT { ', '.join(table_column_names(table)) } FROM { table.__tablename__ }")
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+def content_hashes(rows_by_table: dict[type[Base], list[tuple]], key: str) -> dict[Any, str]:
+    hashes: dict[Any, Any] = {}
+    for table, rows in rows_by_table.items():
+        key_index = table_column_names(table).index(key)
+        for row in sorted(rows, key=repr):
+            content_hash = hashes.setdefault(row[key_index], hashlib.sha1())
+            content_hash.update(repr((table.__tablename__, row)).encode())
+    return { key_value: content_hash.hexdigest() for key_value, content_hash in hashes.items() }
+
+def records_in_feed_file(db: Session, executor: Executor, feed: Feed,
+                         file: TextIO) -> dict[type[Base], list[tuple]]:
+    token = '' if config.DISABLE_DOWNLOAD else generate_opendata_token()
+    progress = Progress(file)
+    data_path = tempfile.mkdtemp()
+    chunk_queue: Queue[Union[RecordSet, None]] = Queue()
+    try:
+        _, path = download_feed_file(token, data_path, feed, progress)
+        for task in feed.records_in_feed(executor, chunk_queue, path, progress):
+            task.result()
+    finally:
+        shutil.rmtree(data_path)
+
+    # NOTE: Rows are kept as they're stored, so they compare equal to what's in the database
+    rows_by_table: dict[type[Base], list[tuple]] = { table: [] for table in feed.associated_tables() }
+    while not chunk_queue.empty():
+        record_chunk = chunk_queue.get()
+        assert not record_chunk is None
+        for table, batch in record_chunk.items():
+            rows_by_table[table].extend(zip(*bind_processed_columns(db, batch)))
+    return rows_by_table
+
+def update_feed_delta(db: Session, executor: Executor, feed: Feed, file: TextIO) -> DeltaUpdate:
+    key = feed.delta_key()
+    assert not key is None
+
+    new_rows = records_in_feed_file(db, executor, feed, file)
+    new_hashes = content_hashes(new_rows, key)
+    stored_hashes = content_hashes({ table: stored_rows(db, table) for table in new_rows.keys() }, key)
+
+    changed = { key_value
+        for key_value, content_hash in new_hashes.items()
+        if stored_hashes.get(key_value) != content_hash }
+    removed = stored_hashes.keys() - new_hashes.keys()
+    delta = DeltaUpdate(
+        inserted = len(changed - stored_hashes.keys()),
+        updated = len(changed & stored_hashes.keys()),
+        deleted = len(removed))
+
+    # Everything is worked out up front, so the write lock is only held for these statements
+    if len(changed) != 0 or len(removed) != 0:
+        cursor = db.connection().connection.cursor()
+        for table, rows in new_rows.items():
+            key_index = table_column_names(table).index(key)
+            cursor.executemany(f'DELETE FROM { table.__tablename__ } WHERE { key } = ?',
+                [(key_value,) for key_value in changed | removed])
+            cursor.executemany(insert_statement(db, table),
+                [row for row in rows if row[key_index] in changed])
+        cursor.close()
+    db.commit()
+    return delta
+
+def update_feed(db: Session, executor: Executor, feed: Feed, file: TextIO):
+    if config.DELTA_UPDATE_FEEDS and not feed.delta_key() is None:
+        delta = update_feed_delta(db, executor, feed, file)
+        print(f"Updated '{ feed.feed_api_url() }', { delta.inserted } inserted, "
+              f"{ delta.updated } updated, { delta.deleted } deleted", file=file)
+    elif config.SHADOW_BUILD_FEEDS:
+        update_feed_in_shadow_database(db, executor, feed, file)
+    else:
+        update_feeds(db, executor, [feed], file)
+
 def get_outdated_feeds(db: Session) -> list[Feed]:
     now = int(time.time())
     not_expired = [value[0]
@@ -326,6 +736,16 @@ def get_outdated_feeds(db: Session) -> list[Feed]:
         for feed in Feed.feeds()
         if not feed.feed_api_url() in not_expired]
 
+def postprocess_feeds(db: Session, feeds: Iterable[Feed]):
+    # NOTE: The feeds are already being served, so a failure here shouldn't fail the refresh
+    for feed in feeds:
+        try:
+            feed.postprocess_hook(db)
+        except Exception as e:
+            db.rollback()
+            print(Exception, e, file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+
 def update_expiry_times(db: Session, feeds: Iterable[Feed]):
     for feed in feeds:
         now = int(time.time())
@@ -348,7 +768,17 @@ def update_database(db: Session, file: TextIO):
 
     with ThreadPoolExecutor() as executor:
         try:
-            update_feeds(db, executor, outdated_feeds, file)
+            delta_feeds = [feed for feed in outdated_feeds
+                if config.DELTA_UPDATE_FEEDS and not feed.delta_key() is None]
+            if config.SHADOW_BUILD_FEEDS or len(delta_feeds) == len(outdated_feeds):
+                for feed in outdated_feeds:
+                    update_feed(db, executor, feed, file)
+                    update_expiry_times(db, [feed])
+            else:
+                for feed in delta_feeds:
+                    update_feed(db, executor, feed, file)
+                update_feeds(db, executor,
+                    [feed for feed in outdated_feeds if not feed in delta_feeds], file)
         except Exception as e:
             print(Exception, e, file=sys.stderr)
             traceback.print_exc(file=sys.stderr)
@@ -356,6 +786,7 @@ def update_database(db: Session, file: TextIO):
 
     # Update expiry times
     update_expiry_times(db, outdated_feeds)
+    postprocess_feeds(db, outdated_feeds)
 
     is_updating = False
     print('Finished')
@@ -0,0 +1,116 @@
+import datetime
+import enum
+from dataclasses import dataclass, field
+from typing import Any, Callable, Union
+from knowledge_base.feeds import parse_date_ddmmyyyy, parse_time, time_to_sql
+
+# NOTE: Dates past this are used to mean there is no end date
+NO_END_DATE = 29990000
+
+class FieldKind(enum.Enum):
+    Text = enum.auto()
+    Stripped = enum.auto()
+    Int = enum.auto()
+    YesFlag = enum.auto()
+    DayFlag = enum.auto()
+    SQLTime = enum.auto()
+    Time = enum.auto()
+    SQLDateYYMMDD = enum.auto()
+    DateDDMMYYYY = enum.auto()
+
+@dataclass(frozen=True)
+class Field:
+    name: str
+    start: int
+    end: int
+    kind: FieldKind = FieldKind.Text
+
+@dataclass(frozen=True)
+class RecordSpec:
+    fields: list[Field]
+    arguments: tuple[str, ...] = ()
+    constants: dict[str, Any] = field(default_factory=dict)
+
+    # Start of DDMMYYYY validity dates, records outside of them decode to None
+    valid_to: Union[int, None] = None
+    valid_from: Union[int, None] = None
+
+class _ParsedCache(dict):
+    _parse: Callable[[str], Any]
+
+    def __init__(self, parse: Callable[[str], Any]):
+        super().__init__()
+        self._parse = parse
+
+    def __missing__(self, key: str) -> Any:
+        value = self._parse(key)
+        self[key] = value
+        return value
+
+SQL_TIMES = _ParsedCache(lambda time_str: time_to_sql(parse_time(time_str)))
+TIMES = _ParsedCache(parse_time)
+DATES = _ParsedCache(parse_date_ddmmyyyy)
+
+def today_to_sql() -> int:
+    today = datetime.date.today()
+    return today.year*10000 + today.month*100 + today.day
+
+def _sql_date_ddmmyyyy_expression(start: int) -> str:
+    return (
+        f'int(entry[{ start + 4 }:{ start + 8 }] + '
+        f'entry[{ start + 2 }:{ start + 4 }] + '
+        f'entry[{ start }:{ start + 2 }])')
+
+def _field_expression(field: Field) -> str:
+    entry_slice = f'entry[{ field.start }:{ field.end }]'
+    return {
+        FieldKind.Text: entry_slice,
+        FieldKind.Stripped: f'{ entry_slice }.strip()',
+        FieldKind.Int: f'int({ entry_slice })',
+        FieldKind.YesFlag: f"{ entry_slice } == 'Y'",
+        FieldKind.DayFlag: f"{ entry_slice } == '1'",
+        FieldKind.SQLTime: f'SQL_TIMES[entry[{ field.start }:{ field.start + 4 }]]',
+        FieldKind.Time: f'TIMES[entry[{ field.start }:{ field.start + 4 }]]',
+        FieldKind.SQLDateYYMMDD: f'20000000 + int({ entry_slice })',
+        FieldKind.DateDDMMYYYY: f'DATES[{ entry_slice }]',
+    }[field.kind]
+
+def compile_record_decoder(spec: RecordSpec,
+                           columns: Union[tuple[str, ...], None] = None
+                           ) -> Callable[..., Union[dict, tuple, None]]:
+    has_validity = not spec.valid_to is None and not spec.valid_from is None
+    parameters = ['entry'] + (['today'] if has_validity else []) + list(spec.arguments)
+
+    lines = [f"def decode({ ', '.join(parameters) }):"]
+    if has_validity:
+        assert not spec.valid_to is None and not spec.valid_from is None
+        lines += [
+            f'    valid_to = { _sql_date_ddmmyyyy_expression(spec.valid_to) }',
+            f'    valid_from = { _sql_date_ddmmyyyy_expression(spec.valid_from) }',
+            f'    if today < valid_from or (valid_to < { NO_END_DATE } and today > valid_to):',
+            f'        return None',
+        ]
+
+    expressions = { name: name for name in spec.arguments }
+    expressions.update({ name: f'constant_{ name }' for name in spec.constants.keys() })
+    expressions.update({ field.name: _field_expression(field) for field in spec.fields })
+
+    # Without columns decode to a dict, otherwise to a row in column order
+    if columns is None:
+        lines.append('    return {')
+        lines += [f"        '{ name }': { expression }," for name, expression in expressions.items()]
+        lines.append('    }')
+    else:
+        assert all([name in columns for name in expressions.keys()])
+        lines.append('    return (')
+        lines += [f"        { expressions.get(name, 'None') }," for name in columns]
+        lines.append('    )')
+
+    namespace: dict[str, Any] = {
+        'SQL_TIMES': SQL_TIMES,
+        'TIMES': TIMES,
+        'DATES': DATES,
+    }
+    namespace.update({ f'constant_{ name }': value for name, value in spec.constants.items() })
+    exec('\n'.join(lines), namespace)
+    return namespace['decode']
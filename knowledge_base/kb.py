@@ -2,11 +2,11 @@ import os
 import time
 from datetime import datetime
 from queue import Queue
-from typing import Iterable, Union
+from typing import Iterable, Iterator, Union
 from concurrent.futures import Executor, Future
 from sqlalchemy.sql.schema import Column
 from sqlalchemy.sql.sqltypes import Boolean, DateTime, Float, String, Text
-from knowledge_base.feeds import Base, Feed, RecordChunkGenerator, RecordSet
+from knowledge_base.feeds import Base, Feed, RecordChunkGenerator, RecordSet, record_from_dict
 from knowledge_base.progress import Progress
 import xml.etree.ElementTree as ET
 
@@ -15,6 +15,27 @@ NAMESPACES = {
     's': 'http://nationalrail.co.uk/xml/station'
 }
 
+def expanded_tag(tag: str) -> str:
+    prefix, name = tag.split(':')
+    return f'{{{ NAMESPACES[prefix] }}}{ name }'
+
+# NOTE: Tags are expanded up front, so lookups don't have to resolve namespaces
+INCIDENT_NUMBER = expanded_tag('i:IncidentNumber')
+INCIDENT_CREATION_TIME = expanded_tag('i:CreationTime')
+INCIDENT_PLANNED = expanded_tag('i:Planned')
+INCIDENT_SUMMARY = expanded_tag('i:Summary')
+INCIDENT_DESCRIPTION = expanded_tag('i:Description')
+INCIDENT_CLEARED = expanded_tag('i:ClearedIncident')
+INCIDENT_AFFECTS = expanded_tag('i:Affects')
+INCIDENT_ROUTES_AFFECTED = expanded_tag('i:RoutesAffected')
+INCIDENT_OPERATORS = expanded_tag('i:Operators')
+OPERATOR_REF = expanded_tag('i:OperatorRef')
+OPERATOR_NAME = expanded_tag('i:OperatorName')
+STATION_CRS_CODE = expanded_tag('s:CrsCode')
+STATION_NAME = expanded_tag('s:Name')
+STATION_LATITUDE = expanded_tag('s:Latitude')
+STATION_LONGITUDE = expanded_tag('s:Longitude')
+
 class Incident(Base):
     __tablename__ = 'incidents'
     incident_number = Column(String(32), primary_key=True)
@@ -41,71 +62,85 @@ class Station(Base):
 def parse_datetime(datetime_str: str) -> datetime:
     return datetime.strptime(datetime_str.split('.')[0], '%Y-%m-%dT%H:%M:%S')
 
-def records_for_incidents(incidents: list[ET.Element], chunk_queue: Queue[RecordSet],
-                          progress: Progress):
-    incident_count = len(incidents)
-    incidents_done = 0
+def elements_in_xml_file(file_path: str, name: str, progress: Progress) -> Iterator[ET.Element]:
+    total_size_bytes = os.path.getsize(file_path)
     time_since_last_progress_report = time.time()
-    progress.report('Incidents', 0, incident_count)
+    progress.report(name, 0, total_size_bytes)
+
+    # Yield each child of the root as soon as it's parsed, then let go of it
+    with open(file_path, 'rb') as f:
+        root: Union[ET.Element, None] = None
+        depth = 0
+        for event, element in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth != 1:
+                continue
+
+            assert not root is None
+            yield element
+            root.clear()
 
+            if time.time() - time_since_last_progress_report >= 1:
+                progress.report(name, f.tell(), total_size_bytes)
+                time_since_last_progress_report = time.time()
+    progress.report(name, total_size_bytes, total_size_bytes)
+
+def records_for_incidents(file_path: str, chunk_queue: Queue[RecordSet],
+                          progress: Progress):
     with RecordChunkGenerator(chunk_queue) as chunk_generator:
-        for incident in incidents:
-            incident_number = incident.findtext('i:IncidentNumber', namespaces=NAMESPACES)
+        for incident in elements_in_xml_file(file_path, 'Incidents', progress):
+            incident_number = incident.findtext(INCIDENT_NUMBER)
             if incident_number is None:
                 continue
 
-            affects = incident.find('i:Affects', namespaces=NAMESPACES)
+            affects = incident.find(INCIDENT_AFFECTS)
             assert not affects is None
 
-            chunk_generator.put((Incident, dict(
+            chunk_generator.put(record_from_dict(Incident, dict(
                 incident_number = incident_number,
-                creation_time = parse_datetime(incident.findtext('i:CreationTime', '', namespaces=NAMESPACES)),
-                planned = (incident.findtext('i:Planned', namespaces=NAMESPACES) == 'true'),
-                summery = incident.findtext('i:Summary', namespaces=NAMESPACES),
-                description = incident.findtext('i:Description', namespaces=NAMESPACES),
-                cleared_incident = (incident.findtext('i:ClearedIncident', namespaces=NAMESPACES) == 'true'),
-                route_affected = affects.findtext('i:RoutesAffected', namespaces=NAMESPACES))))
+                creation_time = parse_datetime(incident.findtext(INCIDENT_CREATION_TIME, '')),
+                planned = (incident.findtext(INCIDENT_PLANNED) == 'true'),
+                summery = incident.findtext(INCIDENT_SUMMARY),
+                description = incident.findtext(INCIDENT_DESCRIPTION),
+                cleared_incident = (incident.findtext(INCIDENT_CLEARED) == 'true'),
+                route_affected = affects.findtext(INCIDENT_ROUTES_AFFECTED))))
             
-            operators = affects.find('i:Operators', NAMESPACES) 
+            operators = affects.find(INCIDENT_OPERATORS)
             assert not operators is None
 
             for operator in operators:
-                chunk_generator.put((IncidentAffectedOperators, dict(
+                chunk_generator.put(record_from_dict(IncidentAffectedOperators, dict(
                     incident_number = incident_number,
-                    operator_toc = operator.findtext('i:OperatorRef', namespaces=NAMESPACES),
-                    operator_name = operator.findtext('i:OperatorName', namespaces=NAMESPACES))))
+                    operator_toc = operator.findtext(OPERATOR_REF),
+                    operator_name = operator.findtext(OPERATOR_NAME))))
 
-            incidents_done += 1
-            if time.time() - time_since_last_progress_report >= 1:
-                progress.report('Incidents', incidents_done, incident_count)
-                time_since_last_progress_report = time.time()
-    progress.report('Incidents', incident_count, incident_count)
-
-def records_for_stations(stations: list[ET.Element], chunk_queue: Queue[RecordSet],
+def records_for_stations(file_path: str, chunk_queue: Queue[RecordSet],
                          progress: Progress):
-    station_count = len(stations)
-    stations_done = 0
-    time_since_last_progress_report = time.time()
-    progress.report('Stations', 0, station_count)
-
     with RecordChunkGenerator(chunk_queue) as chunk_generator:
-        for station in stations:
-            chunk_generator.put((Station, dict(
-                crs_code = station.findtext('s:CrsCode', namespaces=NAMESPACES),
-                name = station.findtext('s:Name', namespaces=NAMESPACES),
-                latitude = station.findtext('s:Latitude', namespaces=NAMESPACES),
-                longitude = station.findtext('s:Longitude', namespaces=NAMESPACES))))
-
-            stations_done += 1
-            if time.time() - time_since_last_progress_report >= 1:
-                progress.report('Stations', stations_done, station_count)
-                time_since_last_progress_report = time.time()
-    progress.report('Stations', station_count, station_count)
+        for station in elements_in_xml_file(file_path, 'Stations', progress):
+            chunk_generator.put(record_from_dict(Station, dict(
+                crs_code = station.findtext(STATION_CRS_CODE),
+                name = station.findtext(STATION_NAME),
+                latitude = station.findtext(STATION_LATITUDE),
+                longitude = station.findtext(STATION_LONGITUDE))))
 
 class KBIncidents(Feed):
     def associated_tables(self) -> Iterable[type[Base]]:
         return [Incident, IncidentAffectedOperators]
 
+    def required_tables(self) -> Iterable[type[Base]]:
+        # NOTE: No incidents is a perfectly valid feed
+        return []
+
+    def delta_key(self) -> Union[str, None]:
+        return 'incident_number'
+
     def file_name(self) -> str:
         return 'INCIDENTS.XML'
 
@@ -120,11 +155,8 @@ class KBIncidents(Feed):
                         chunk_queue: Queue[Union[RecordSet, None]],
                         path: str,
                         progress: Progress) -> Iterable[Future]:
-        tree = ET.parse(os.path.join(path, self.file_name()))
-        incidents = [incident for incident in tree.getroot()]
-
         return [executor.submit(records_for_incidents,
-            incidents, chunk_queue, progress)]
+            os.path.join(path, self.file_name()), chunk_queue, progress)]
 
 class KBStations(Feed):
     def associated_tables(self) -> Iterable[type[Base]]:
@@ -144,11 +176,8 @@ class KBStations(Feed):
                         chunk_queue: Queue[Union[RecordSet, None]],
                         path: str,
                         progress: Progress) -> Iterable[Future]:
-        tree = ET.parse(os.path.join(path, self.file_name()))
-        stations = [station for station in tree.getroot()]
-
         return [executor.submit(records_for_stations,
-            stations, chunk_queue, progress)]
+            os.path.join(path, self.file_name()), chunk_queue, progress)]
 
 Feed.register(KBIncidents)
 Feed.register(KBStations)
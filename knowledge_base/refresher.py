@@ -0,0 +1,164 @@
+import sys
+import time
+import enum
+import traceback
+import config
+from dataclasses import dataclass, replace
+from threading import Event, Lock, Thread
+from typing import TextIO, Union
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.orm.session import Session
+from knowledge_base.feeds import ExpiryTimes, Feed, connect_database, update_expiry_times
+from knowledge_base.feeds import postprocess_feeds, update_feed
+
+class RefreshState(enum.Enum):
+    Waiting = enum.auto()
+    Refreshing = enum.auto()
+    Failed = enum.auto()
+    Stopped = enum.auto()
+
+@dataclass
+class FeedStatus:
+    state: RefreshState = RefreshState.Waiting
+    next_refresh: Union[float, None] = None
+    last_refresh_started: Union[float, None] = None
+    last_refresh_finished: Union[float, None] = None
+    last_refresh_duration: Union[float, None] = None
+    last_error: Union[str, None] = None
+    refresh_count: int = 0
+    failure_count: int = 0
+
+class FeedRefresher:
+    _feeds: list[Feed]
+    _file: TextIO
+    _status: dict[str, FeedStatus]
+    _status_mutex: Lock
+    _write_mutex: Lock
+    _stop_event: Event
+    _threads: list[Thread]
+
+    def __init__(self, feeds: Union[list[Feed], None] = None, file: TextIO = sys.stdout):
+        self._feeds = Feed.feeds() if feeds is None else feeds
+        self._file = file
+        self._status = { feed.feed_api_url(): FeedStatus() for feed in self._feeds }
+        self._status_mutex = Lock()
+        self._write_mutex = Lock()
+        self._stop_event = Event()
+        self._threads = []
+
+    def _update_status(self, feed: Feed, **changes):
+        with self._status_mutex:
+            status = self._status[feed.feed_api_url()]
+            for name, value in changes.items():
+                setattr(status, name, value)
+
+    def _finish_refresh(self, feed: Feed, started: float, next_refresh: float,
+                        error: Union[Exception, None]):
+        finished = time.time()
+        with self._status_mutex:
+            status = self._status[feed.feed_api_url()]
+            status.next_refresh = next_refresh
+            status.state = RefreshState.Waiting if error is None else RefreshState.Failed
+            status.last_refresh_finished = finished
+            status.last_refresh_duration = finished - started
+            status.last_error = None if error is None else f'{ type(error).__name__ }: { error }'
+            if error is None:
+                status.refresh_count += 1
+            else:
+                status.failure_count += 1
+
+    def status(self) -> dict[str, FeedStatus]:
+        with self._status_mutex:
+            return { url: replace(status) for url, status in self._status.items() }
+
+    def _next_refresh(self, db: Session, feed: Feed) -> float:
+        # Let go of the last snapshot, so we see expiry times written by other feeds
+        db.commit()
+
+        entry = db.query(ExpiryTimes).get(feed.feed_api_url())
+        if entry is None:
+            return time.time()
+        return float(entry.expiry_timestamp)
+
+    def _refresh_feed(self, db: Session, feed: Feed):
+        with ThreadPoolExecutor() as executor:
+            if config.SHADOW_BUILD_FEEDS:
+                update_feed(db, executor, feed, self._file)
+            else:
+                # NOTE: Without shadow builds every feed writes into the same
+                #       database, so they have to take turns
+                with self._write_mutex:
+                    update_feed(db, executor, feed, self._file)
+        update_expiry_times(db, [feed])
+        postprocess_feeds(db, [feed])
+
+    def _refresh_loop(self, feed: Feed):
+        db = connect_database()
+        next_refresh = self._next_refresh(db, feed)
+        while True:
+            self._update_status(feed, next_refresh = next_refresh)
+            if self._stop_event.wait(max(0.0, next_refresh - time.time())):
+                break
+
+            started = time.time()
+            self._update_status(feed,
+                state = RefreshState.Refreshing,
+                last_refresh_started = started)
+            print('Refreshing feed', feed.feed_api_url(), file=self._file)
+
+            try:
+                self._refresh_feed(db, feed)
+            except Exception as e:
+                db.rollback()
+                print(Exception, e, file=sys.stderr)
+                traceback.print_exc(file=sys.stderr)
+
+                next_refresh = time.time() + config.FEED_REFRESH_RETRY_SECONDS
+                self._finish_refresh(feed, started, next_refresh, e)
+                continue
+
+            next_refresh = self._next_refresh(db, feed)
+            self._finish_refresh(feed, started, next_refresh, None)
+            print(f'Refreshed feed { feed.feed_api_url() } in { round(time.time() - started, 1) }s', file=self._file)
+
+        db.close()
+        self._update_status(feed, state = RefreshState.Stopped, next_refresh = None)
+
+    def start(self):
+        assert len(self._threads) == 0
+        self._stop_event.clear()
+
+        # NOTE: Each feed gets its own worker, so a long timetable refresh
+        #       never holds up the short lived ones
+        for feed in self._feeds:
+            thread = Thread(target = self._refresh_loop, args = (feed,),
+                name = f'refresh-{ feed.schema_name() }', daemon = True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: Union[float, None] = None):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+def format_refresh_status(status: dict[str, FeedStatus]) -> str:
+    now = time.time()
+    lines = []
+    for url, feed_status in status.items():
+        line = f'{ url }: { feed_status.state.name }'
+        if not feed_status.last_refresh_duration is None:
+            line += f', last refresh took { round(feed_status.last_refresh_duration, 1) }s'
+        if not feed_status.next_refresh is None:
+            line += f', next in { max(0, int(feed_status.next_refresh - now)) }s'
+        if not feed_status.last_error is None:
+            line += f', last error { feed_status.last_error }'
+        lines.append(line)
+    return '\n'.join(lines)
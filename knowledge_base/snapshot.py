@@ -0,0 +1,70 @@
+import os
+import mmap
+import struct
+import numpy as np
+from typing import Union
+
+# Magic, format version, array count and the build id shared with the database it came from
+SNAPSHOT_MAGIC = b'TTSNAP\0\0'
+SNAPSHOT_FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sII32s')
+
+# Name, dtype, byte offset and element count of each array
+ENTRY = struct.Struct('<24s8sQQ')
+
+# NOTE: Arrays start on cache line boundaries, so they can be viewed in place
+ALIGNMENT = 64
+
+def aligned(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def write_snapshot(path: str, build_id: str, arrays: dict[str, np.ndarray]):
+    arrays = { name: np.ascontiguousarray(array) for name, array in arrays.items() }
+    offset = aligned(HEADER.size + ENTRY.size * len(arrays))
+    entries: list[bytes] = []
+    for name, array in arrays.items():
+        entries.append(ENTRY.pack(name.encode(), array.dtype.str.encode(), offset, len(array)))
+        offset = aligned(offset + array.nbytes)
+
+    # Written to the side then swapped in, so a reader never maps half a file
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, len(arrays), build_id.encode()))
+        for entry in entries:
+            f.write(entry)
+        for array in arrays.values():
+            f.write(b'\0' * (aligned(f.tell()) - f.tell()))
+            f.write(array.tobytes())
+    os.replace(temp_path, path)
+
+class Snapshot:
+    build_id: str
+    _map: mmap.mmap
+    _arrays: dict[str, np.ndarray]
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, format_version, array_count, build_id = HEADER.unpack_from(self._map, 0)
+        if magic != SNAPSHOT_MAGIC or format_version != SNAPSHOT_FORMAT_VERSION:
+            raise Exception(f"'{ path }' is not a version { SNAPSHOT_FORMAT_VERSION } snapshot")
+
+        self.build_id = build_id.rstrip(b'\0').decode()
+        self._arrays = {}
+        for i in range(array_count):
+            name, dtype, offset, length = ENTRY.unpack_from(self._map, HEADER.size + ENTRY.size * i)
+            self._arrays[name.rstrip(b'\0').decode()] = np.frombuffer(self._map,
+                dtype=np.dtype(dtype.rstrip(b'\0').decode()), count=length, offset=offset)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self._arrays[name]
+
+def open_snapshot(path: str, build_id: str) -> Union[Snapshot, None]:
+    if not os.path.exists(path):
+        return None
+
+    snapshot = Snapshot(path)
+    if snapshot.build_id != build_id:
+        return None
+    return snapshot
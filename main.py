@@ -1,3 +1,5 @@
+import os
+import sys
 import datetime
 import config
 from pyowm.owm import OWM
@@ -9,12 +11,15 @@ from interface.response import format_not_enough_data_response
 from interface.response import format_pending_response
 from interface.response import format_journey_response
 from interface.response import format_incidents_response
-from knowledge_base import TrainRoute, tiploc_route_to_crs_route
-from knowledge_base.feeds import open_database
+from knowledge_base import tiploc_route_to_crs_route
+from knowledge_base.feeds import connect_database, open_database
+from knowledge_base.refresher import FeedRefresher, format_refresh_status
 from knowledge_base.weather import get_weather_at_crs, open_weather
 from reasoning_engine.delays import delay_for_route, open_delays_model
 from reasoning_engine.incidents import find_incidents, strip_html
-from reasoning_engine.routeing import Journey, filter_best_journeys, find_journeys_from_crs
+from reasoning_engine.journeys import find_journeys
+from reasoning_engine.routeing import Journey
+from reasoning_engine.timetable import format_cache_stats, route_cache
 from reasoning_engine.tickets import ticket_prices
 from interface.bot import Message, open_bot, send_reply
 from interface.bot import conversation_handler
@@ -27,27 +32,6 @@ def has_enough_info_for_user_report(state: RoutePlanningState) -> bool:
         (not state.from_loc is None) and
         (not state.to_loc is None))
 
-def order_key(journey: Journey) -> datetime.time:
-    departure = journey[0].start.public_departure
-    arrival = journey[-1].end.public_arrival
-    if arrival < departure:
-        return departure
-    else:
-        return arrival
-
-def find_journeys(db: Session, from_crs: str, to_crs: str,
-                  date: datetime.date, time: datetime.time) -> list[tuple[TrainRoute, Journey]]:
-    journeys = find_journeys_from_crs(db, from_crs, to_crs, date)
-    best_journeys = filter_best_journeys(journeys)
-
-    route_journeys = [
-        (route, journey)
-        for route, journeys in best_journeys
-        for journey in journeys
-        if journey[0].start.public_departure >= time]
-    route_journeys.sort(key = lambda x: order_key(x[1]))
-    return route_journeys
-
 def find_delays(db: Session, model: Model, journey: Journey, date: datetime.date) -> Union[int, None]:
     start_segment = journey[0]
     start_tiploc = start_segment.start.location
@@ -71,13 +55,8 @@ def fetch_and_report_route_info(on_response: Callable[[str], None],
         state.date, state.time)
 
     if len(journeys) == 0:
-        # Try looking at the start of tomorrow
-        journeys = find_journeys(db, state.from_loc.crs, state.to_loc.crs,
-            state.date + datetime.timedelta(days=1), datetime.time(0))
-
-        if len(journeys) == 0:
-            on_response(f'No route from { state.from_loc.name } to { state.to_loc.name } found')
-            return None
+        on_response(f'No route from { state.from_loc.name } to { state.to_loc.name } found')
+        return None
 
     # Ticket and journey info
     print('Reporting on journey info')
@@ -105,6 +84,9 @@ def handle_conversation_state(text: str,
                               db: Session,
                               model: Model,
                               owm: OWM):
+    # Let go of the last snapshot, so each message sees the latest swapped in feeds
+    db.close()
+
     raw_text_message_content = strip_html(text)
     gather_information(db, raw_text_message_content, state)
     print(f'Got message { raw_text_message_content }')
@@ -168,7 +150,8 @@ def handle_bot_conversation_state(bot: Mastodon,
         on_response, state, db, model, owm)
     return last_message
 
-def text_mode(db: Session, model: Model, owm: OWM):
+def text_mode(db: Session, model: Model, owm: OWM,
+              refresher: Union[FeedRefresher, None] = None):
     print(' !!! WARNING: Mastodon disabled, running in text mode !!! ')
     state = RoutePlanningState()
     while True:
@@ -176,17 +159,34 @@ def text_mode(db: Session, model: Model, owm: OWM):
         if text.strip().lower() in ['exit', 'quit', 'q']:
             break
 
+        if text.strip().lower() == 'status':
+            if not refresher is None:
+                print(format_refresh_status(refresher.status()))
+            print(format_cache_stats('Route cache', route_cache.stats()))
+            continue
+
         handle_conversation_state(text,
             print, state, db, model, owm)
 
 def main():
     print(' ==> Loading data')
-    db = open_database()
+    refresher = None
+    if config.BACKGROUND_FEED_REFRESH:
+        # Start from whatever we already have, feeds are swapped in as they're refreshed
+        db = connect_database()
+
+        # NOTE: Keep progress bars from drawing over the text mode prompt
+        refresh_log = open(os.devnull, 'w') if config.DISABLE_MASTODON else sys.stdout
+        refresher = FeedRefresher(file = refresh_log)
+        refresher.start()
+    else:
+        db = open_database()
+
     model = open_delays_model('prediction/delays.model')
     owm = open_weather()
 
     if config.DISABLE_MASTODON:
-        text_mode(db, model, owm)
+        text_mode(db, model, owm, refresher)
         return
 
     print(' ==> Listening for messages')
@@ -0,0 +1,114 @@
+import sys
+import time
+import datetime
+import config
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Iterable, Iterator, NamedTuple, TextIO, Union
+from knowledge_base.feeds import connect_read_only_database
+from knowledge_base.progress import Progress
+from reasoning_engine.csa import find_journeys_csa_profile
+from reasoning_engine.raptor import find_journeys_raptor
+from reasoning_engine.routeing import RouteAndJourneys, filter_best_journeys
+from reasoning_engine.transfer_patterns import find_journeys_with_patterns
+from sqlalchemy.orm.session import Session
+
+RouteQuery = tuple[str, str, datetime.date]
+
+class BatchLeg(NamedTuple):
+    train_uid: str
+    from_location: str
+    to_location: str
+    departure: datetime.time
+    arrival: datetime.time
+
+@dataclass
+class BatchResult:
+    from_crs: str
+    to_crs: str
+    date: datetime.date
+    journeys: list[list[BatchLeg]]
+    error: Union[str, None] = None
+
+# Each worker process keeps its own read only connection
+_worker_db: Union[Session, None] = None
+
+def open_batch_worker(database_file: str):
+    global _worker_db
+    _worker_db = connect_read_only_database(database_file)
+
+def find_route_journeys(db: Session, from_crs: str, to_crs: str,
+                        date: datetime.date, time: datetime.time) -> list[RouteAndJourneys]:
+    if config.ROUTING_ENGINE == 'csa':
+        # NOTE: A batch covers the whole day, not just the first few journeys after the time
+        return [
+            route_journeys
+            for day, day_journeys in find_journeys_csa_profile(db, from_crs, to_crs, date, time,
+                config.PROFILE_WINDOW_MINUTES, every_journey = True)
+            if day == date
+            for route_journeys in day_journeys]
+    elif config.ROUTING_ENGINE == 'raptor':
+        return find_journeys_raptor(db, from_crs, to_crs, date, time)
+    else:
+        return find_journeys_with_patterns(db, from_crs, to_crs, date)
+
+def batch_result_for_query(db: Session, query: RouteQuery) -> BatchResult:
+    from_crs, to_crs, date = query
+    try:
+        route_journeys = filter_best_journeys(
+            find_route_journeys(db, from_crs, to_crs, date, datetime.time(0)))
+    except Exception as e:
+        return BatchResult(from_crs, to_crs, date, [], str(e))
+
+    # NOTE: Only plain values are sent back, the ORM objects stay in the worker
+    journeys = [
+        [BatchLeg(segment.train.train_uid, segment.start.location, segment.end.location,
+            segment.start.public_departure, segment.end.public_arrival)
+            for segment in journey]
+        for _, journeys in route_journeys
+        for journey in journeys]
+    journeys.sort(key=lambda journey: journey[0].departure)
+    return BatchResult(from_crs, to_crs, date, journeys)
+
+def route_query_shard(queries: list[RouteQuery]) -> list[BatchResult]:
+    assert not _worker_db is None
+    results = [batch_result_for_query(_worker_db, query) for query in queries]
+
+    # Let go of the snapshot, so the next shard sees any newly swapped in feeds
+    _worker_db.close()
+    return results
+
+def route_query_shards(queries: Iterable[RouteQuery], shard_size: int) -> list[list[RouteQuery]]:
+    # NOTE: Keeping queries on the same date together lets each
+    #       worker reuse the timetables it's already built
+    queries = sorted(queries, key=lambda query: query[2])
+    return [queries[start:start + shard_size] for start in range(0, len(queries), shard_size)]
+
+def route_batch(queries: Iterable[RouteQuery], file: TextIO = sys.stdout,
+                process_count: Union[int, None] = None,
+                database_file: Union[str, None] = None) -> Iterator[BatchResult]:
+    if process_count is None:
+        process_count = config.BATCH_ROUTING_PROCESS_COUNT
+    shards = route_query_shards(queries, config.BATCH_ROUTING_SHARD_SIZE)
+    query_count = sum([len(shard) for shard in shards])
+    progress = Progress(file)
+
+    start = time.perf_counter()
+    completed = 0
+    # NOTE: Spawned, so workers don't inherit this process's database connections
+    with ProcessPoolExecutor(process_count,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=open_batch_worker,
+            initargs=(database_file or config.DATABASE_FILE,)) as executor:
+        tasks = [executor.submit(route_query_shard, shard) for shard in shards]
+        for task in as_completed(tasks):
+            results = task.result()
+            completed += len(results)
+            progress.report('Routing', completed, query_count)
+            yield from results
+
+    duration = time.perf_counter() - start
+    queries_per_second = 0 if duration == 0 else round(completed / duration, 1)
+    print(f'Routed { completed } queries in { round(duration, 1) }s '
+          f'({ queries_per_second } queries/s)', file=file)
@@ -0,0 +1,259 @@
+import datetime
+import config
+import numpy as np
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Iterable, Union
+from sqlalchemy.orm.session import Session
+from reasoning_engine.routeing import Leg, RouteAndJourneys, crs_to_tiplocs, journeys_from_legs
+from reasoning_engine.timetable import StopRow, minutes_from_sql_time, stops_running_on_date
+from reasoning_engine.timetable import timetable_cache
+
+NEVER = 1 << 30
+
+@dataclass
+class ConnectionTimetable:
+    stations: list[str]
+    station_ids: dict[str, int]
+    train_uids: list[str]
+
+    # One entry per connection between consecutive stops, sorted by departure.
+    # Times are in minutes from the start of the service day, so may go past midnight
+    departure_station: list[int]
+    arrival_station: list[int]
+    departure_time: list[int]
+    arrival_time: list[int]
+    trip: list[int]
+    departure_route_index: list[int]
+    arrival_route_index: list[int]
+
+def connection_timetable_from_stops(stops: Iterable[StopRow]) -> ConnectionTimetable:
+    stations: list[str] = []
+    station_ids: dict[str, int] = {}
+    train_uids: list[str] = []
+    connections: list[tuple[int, int, int, int, int, int, int]] = []
+
+    def station_id(location: str) -> int:
+        if not location in station_ids:
+            station_ids[location] = len(stations)
+            stations.append(location)
+        return station_ids[location]
+
+    day_offset = 0
+    last_time = 0
+
+    # NOTE: Times only go forward along a train, so going backwards means it ran past midnight
+    def service_day_minutes(time: Union[int, None]) -> Union[int, None]:
+        nonlocal day_offset, last_time
+        if time is None:
+            return None
+        minutes = minutes_from_sql_time(time) + day_offset
+        if minutes < last_time:
+            day_offset += 24*60
+            minutes += 24*60
+        last_time = minutes
+        return minutes
+
+    last_stop: Union[tuple[int, int, int], None] = None
+    last_train_uid = None
+    for train_uid, route_index, location, arrival_time, departure_time in stops:
+        if train_uid != last_train_uid:
+            train_uids.append(train_uid)
+            last_train_uid = train_uid
+            last_stop = None
+            day_offset = 0
+            last_time = 0
+
+        arrival = service_day_minutes(arrival_time)
+        departure = service_day_minutes(departure_time)
+        location_id = station_id(location)
+        if not last_stop is None and not arrival is None:
+            from_id, from_departure, from_route_index = last_stop
+            connections.append((from_departure, arrival, from_id, location_id,
+                len(train_uids) - 1, from_route_index, route_index))
+
+        last_stop = None if departure is None else (location_id, departure, route_index)
+
+    connections.sort()
+    return ConnectionTimetable(
+        stations = stations,
+        station_ids = station_ids,
+        train_uids = train_uids,
+        departure_time = [connection[0] for connection in connections],
+        arrival_time = [connection[1] for connection in connections],
+        departure_station = [connection[2] for connection in connections],
+        arrival_station = [connection[3] for connection in connections],
+        trip = [connection[4] for connection in connections],
+        departure_route_index = [connection[5] for connection in connections],
+        arrival_route_index = [connection[6] for connection in connections])
+
+def connection_timetable_for_date(db: Session, date: datetime.date) -> ConnectionTimetable:
+    return timetable_cache.get(db, ('connections', date),
+        lambda: connection_timetable_from_stops(stops_running_on_date(db, date)))
+
+def concatenate_connection_timetables(timetables: list[ConnectionTimetable]) -> ConnectionTimetable:
+    stations: list[str] = []
+    station_ids: dict[str, int] = {}
+    train_uids: list[str] = []
+    columns: dict[str, list[np.ndarray]] = {}
+    for day, timetable in enumerate(timetables):
+        for location in timetable.stations:
+            if not location in station_ids:
+                station_ids[location] = len(stations)
+                stations.append(location)
+
+        # Each service day follows on from the one before, with its own trips
+        station_map = np.array([station_ids[location] for location in timetable.stations], dtype=np.int64)
+        day_columns = {
+            'departure_time': np.array(timetable.departure_time, dtype=np.int64) + day*24*60,
+            'arrival_time': np.array(timetable.arrival_time, dtype=np.int64) + day*24*60,
+            'departure_station': station_map[np.array(timetable.departure_station, dtype=np.int64)],
+            'arrival_station': station_map[np.array(timetable.arrival_station, dtype=np.int64)],
+            'trip': np.array(timetable.trip, dtype=np.int64) + len(train_uids),
+            'departure_route_index': np.array(timetable.departure_route_index, dtype=np.int64),
+            'arrival_route_index': np.array(timetable.arrival_route_index, dtype=np.int64),
+        }
+        for name, column in day_columns.items():
+            columns.setdefault(name, []).append(column)
+        train_uids += timetable.train_uids
+
+    merged = { name: np.concatenate(column) for name, column in columns.items() }
+    order = np.argsort(merged['departure_time'], kind='stable')
+    return ConnectionTimetable(
+        stations = stations,
+        station_ids = station_ids,
+        train_uids = train_uids,
+        **{ name: column[order].tolist() for name, column in merged.items() })
+
+def connection_timetable_for_dates(db: Session, date: datetime.date, day_count: int) -> ConnectionTimetable:
+    if day_count == 1:
+        return connection_timetable_for_date(db, date)
+
+    return timetable_cache.get(db, ('connections', date, day_count),
+        lambda: concatenate_connection_timetables([
+            connection_timetable_for_date(db, date + datetime.timedelta(days=day))
+            for day in range(day_count)]))
+
+def earliest_arrival(timetable: ConnectionTimetable,
+                     sources: Iterable[int], targets: Iterable[int],
+                     departure: int, start: int = 0) -> Union[tuple[int, list[Leg]], None]:
+    station_count = len(timetable.stations)
+    targets = set(targets)
+
+    # Earliest time a train can be caught from each station
+    ready_at = [NEVER] * station_count
+    arrived_at = [NEVER] * station_count
+    for source in sources:
+        ready_at[source] = departure
+        arrived_at[source] = departure
+
+    # Connections the station was first reached with, and where that train was boarded
+    reached_by = [-1] * station_count
+    boarded_at = [-1] * station_count
+    trip_boarded_at = [-1] * len(timetable.train_uids)
+
+    departure_time = timetable.departure_time
+    arrival_time = timetable.arrival_time
+    departure_station = timetable.departure_station
+    arrival_station = timetable.arrival_station
+    trip = timetable.trip
+    change_minutes = config.MIN_CHANGE_MINUTES
+
+    best_arrival = NEVER
+    best_target = -1
+    # NOTE: Indexed from the first connection leaving in time, slicing
+    #       or islice would step through every connection before it
+    for i in range(bisect_left(departure_time, departure, lo=start), len(departure_time)):
+        connection_departure = departure_time[i]
+        if connection_departure >= best_arrival:
+            break
+
+        connection_trip = trip[i]
+        if trip_boarded_at[connection_trip] < 0:
+            if connection_departure < ready_at[departure_station[i]]:
+                continue
+            trip_boarded_at[connection_trip] = i
+
+        connection_arrival = arrival_time[i]
+        station = arrival_station[i]
+        if connection_arrival < arrived_at[station]:
+            arrived_at[station] = connection_arrival
+            ready_at[station] = connection_arrival + change_minutes
+            reached_by[station] = i
+            boarded_at[station] = trip_boarded_at[connection_trip]
+            if station in targets:
+                best_arrival = connection_arrival
+                best_target = station
+
+    if best_target < 0:
+        return None
+
+    legs: list[Leg] = []
+    station = best_target
+    board = -1
+    while reached_by[station] >= 0:
+        board = boarded_at[station]
+        alight = reached_by[station]
+        legs.append((
+            timetable.train_uids[trip[alight]],
+            timetable.departure_route_index[board],
+            timetable.arrival_route_index[alight]))
+        station = departure_station[board]
+    legs.reverse()
+    return departure_time[board], legs
+
+def journey_legs_after(timetable: ConnectionTimetable,
+                       from_locations: Iterable[str], to_locations: Iterable[str],
+                       departure: int, count: Union[int, None], latest_departure: int = NEVER
+                       ) -> list[tuple[int, list[Leg]]]:
+    sources = [timetable.station_ids[location] for location in from_locations if location in timetable.station_ids]
+    targets = [timetable.station_ids[location] for location in to_locations if location in timetable.station_ids]
+    if len(sources) == 0 or len(targets) == 0:
+        return []
+
+    # Each following journey has to leave after the last one, so its
+    # scan carries on from where the last one started rather than the start
+    journeys: list[tuple[int, list[Leg]]] = []
+    start = 0
+    while count is None or len(journeys) < count:
+        start = bisect_left(timetable.departure_time, departure, lo=start)
+        result = earliest_arrival(timetable, sources, targets, departure, start)
+        if result is None or len(result[1]) == 0:
+            break
+
+        first_departure, legs = result
+        if first_departure > latest_departure:
+            break
+
+        journeys.append((first_departure, legs))
+        departure = first_departure + 1
+    return journeys
+
+def find_journeys_csa(db: Session, from_crs: str, to_crs: str,
+                      date: datetime.date, time: datetime.time) -> list[RouteAndJourneys]:
+    timetable = connection_timetable_for_date(db, date)
+    journeys = journey_legs_after(timetable,
+        crs_to_tiplocs(db, from_crs), crs_to_tiplocs(db, to_crs),
+        time.hour*60 + time.minute, config.ROUTE_JOURNEY_COUNT)
+    return journeys_from_legs(db, [legs for _, legs in journeys])
+
+def find_journeys_csa_profile(db: Session, from_crs: str, to_crs: str,
+                              date: datetime.date, time: datetime.time,
+                              window_minutes: int, every_journey: bool = False
+                              ) -> list[tuple[datetime.date, list[RouteAndJourneys]]]:
+    # NOTE: Scans every service day the window touches at once, so a search late
+    #       in the evening carries on into the next morning
+    departure = time.hour*60 + time.minute
+    latest_departure = departure + window_minutes
+    timetable = connection_timetable_for_dates(db, date, latest_departure // (24*60) + 1)
+    journeys = journey_legs_after(timetable,
+        crs_to_tiplocs(db, from_crs), crs_to_tiplocs(db, to_crs),
+        departure, None if every_journey else config.ROUTE_JOURNEY_COUNT, latest_departure)
+
+    # Grouped by the day each journey sets off
+    legs_by_day: dict[int, list[list[Leg]]] = {}
+    for first_departure, legs in journeys:
+        legs_by_day.setdefault(first_departure // (24*60), []).append(legs)
+    return [
+        (date + datetime.timedelta(days=day), journeys_from_legs(db, day_legs))
+        for day, day_legs in sorted(legs_by_day.items())]
@@ -0,0 +1,84 @@
+import datetime
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Iterable, Iterator, NamedTuple
+from sqlalchemy.orm.session import Session
+from reasoning_engine.timetable import StopRow, service_day_times, stops_running_on_date
+from reasoning_engine.timetable import timetable_cache
+
+class Departure(NamedTuple):
+    # Minutes from the start of the service day, so may go past midnight
+    time: int
+    train_uid: str
+    train_route_index: int
+
+@dataclass
+class DepartureIndex:
+    station_ids: dict[str, int]
+    train_uids: list[str]
+
+    # Departures from each station sorted by time, times[offsets[s]:offsets[s + 1]]
+    offsets: list[int]
+    times: list[int]
+    trips: list[int]
+    route_indices: list[int]
+
+    def departure_range(self, location: str, start: int, end: int) -> range:
+        station = self.station_ids.get(location)
+        if station is None:
+            return range(0)
+
+        lo, hi = self.offsets[station], self.offsets[station + 1]
+        return range(
+            bisect_left(self.times, start, lo, hi),
+            bisect_left(self.times, end, lo, hi))
+
+    def departure(self, i: int) -> Departure:
+        return Departure(self.times[i], self.train_uids[self.trips[i]], self.route_indices[i])
+
+    def departures_between(self, location: str, start: int, end: int) -> Iterator[Departure]:
+        for i in self.departure_range(location, start, end):
+            yield self.departure(i)
+
+    def next_departures(self, location: str, time: int, count: int) -> list[Departure]:
+        departures = self.departure_range(location, time, 1 << 30)
+        return [self.departure(i) for i in departures[:count]]
+
+def departure_index_from_stops(stops: Iterable[StopRow]) -> DepartureIndex:
+    station_ids: dict[str, int] = {}
+    train_uids: list[str] = []
+    station_departures: list[list[tuple[int, int, int]]] = []
+    for stop, _, departure in service_day_times(stops):
+        train_uid, route_index, location, _, _ = stop
+        if len(train_uids) == 0 or train_uids[-1] != train_uid:
+            train_uids.append(train_uid)
+        if departure is None:
+            continue
+
+        if not location in station_ids:
+            station_ids[location] = len(station_departures)
+            station_departures.append([])
+        station_departures[station_ids[location]].append((departure, len(train_uids) - 1, route_index))
+
+    offsets = [0]
+    times: list[int] = []
+    trips: list[int] = []
+    route_indices: list[int] = []
+    for departures in station_departures:
+        departures.sort()
+        times += [time for time, _, _ in departures]
+        trips += [trip for _, trip, _ in departures]
+        route_indices += [route_index for _, _, route_index in departures]
+        offsets.append(len(times))
+
+    return DepartureIndex(
+        station_ids = station_ids,
+        train_uids = train_uids,
+        offsets = offsets,
+        times = times,
+        trips = trips,
+        route_indices = route_indices)
+
+def departure_index_for_date(db: Session, date: datetime.date) -> DepartureIndex:
+    return timetable_cache.get(db, ('departures', date),
+        lambda: departure_index_from_stops(stops_running_on_date(db, date)))
@@ -0,0 +1,82 @@
+import datetime
+import config
+from knowledge_base import TrainRoute
+from reasoning_engine.csa import find_journeys_csa_profile
+from reasoning_engine.raptor import find_journeys_raptor
+from reasoning_engine.routeing import Journey, RouteAndJourneys, SearchProgress, filter_best_journeys
+from reasoning_engine.routeing import record_search_progress
+from reasoning_engine.timetable import route_cache, route_cache_key, search_start_time
+from reasoning_engine.transfer_patterns import find_journeys_with_patterns
+from sqlalchemy.orm.session import Session
+
+def order_key(journey: Journey) -> datetime.time:
+    departure = journey[0].start.public_departure
+    arrival = journey[-1].end.public_arrival
+    if arrival < departure:
+        return departure
+    else:
+        return arrival
+
+def journeys_departing_from(route_journeys: list[RouteAndJourneys], time: datetime.time) -> list[RouteAndJourneys]:
+    departing = [
+        (route, [journey for journey in journeys if journey[0].start.public_departure >= time])
+        for route, journeys in route_journeys]
+    return [(route, journeys) for route, journeys in departing if len(journeys) > 0]
+
+def find_best_journeys(db: Session, from_crs: str, to_crs: str,
+                       date: datetime.date, time: datetime.time,
+                       progress: SearchProgress) -> list[tuple[int, list[RouteAndJourneys]]]:
+    # NOTE: Cached for every date with the same service pattern, so
+    #       days are kept as an offset from the date searched for
+    if config.ROUTING_ENGINE == 'csa':
+        return [((day - date).days, list(filter_best_journeys(journeys)))
+            for day, journeys in find_journeys_csa_profile(db, from_crs, to_crs,
+                date, time, config.PROFILE_WINDOW_MINUTES)]
+
+    # NOTE: Other engines search one service day at a time, so only
+    #       look at the start of tomorrow if there's nothing left today
+    best_journeys_by_day = []
+    for day_offset, day_time in [(0, time), (1, datetime.time(0))]:
+        day = date + datetime.timedelta(days=day_offset)
+        if config.ROUTING_ENGINE == 'raptor':
+            journeys = find_journeys_raptor(db, from_crs, to_crs, day, day_time)
+        else:
+            journeys = find_journeys_with_patterns(db, from_crs, to_crs, day, progress)
+
+        best_journeys = journeys_departing_from(list(filter_best_journeys(journeys)), day_time)
+        if len(best_journeys) > 0:
+            best_journeys_by_day = [(day_offset, best_journeys)]
+            break
+        if progress.out_of_time():
+            break
+
+    if config.ROUTING_ENGINE != 'raptor':
+        record_search_progress(from_crs, to_crs, date, progress)
+    return best_journeys_by_day
+
+def find_journeys(db: Session, from_crs: str, to_crs: str,
+                  date: datetime.date, time: datetime.time) -> list[tuple[TrainRoute, Journey]]:
+    # NOTE: Profile searches start from the beginning of the time bucket,
+    #       so the cached journeys cover any time within it
+    progress = SearchProgress(budget_seconds = config.ROUTE_SEARCH_BUDGET_SECONDS)
+    cache_key = route_cache_key(db, from_crs, to_crs, date, time)
+    best_journeys_by_day = route_cache.get(db, cache_key,
+        lambda: find_best_journeys(db, from_crs, to_crs, date, search_start_time(time), progress))
+
+    # Give the next query for this route another go, rather than keeping what was found in time
+    if not progress.complete:
+        print(f'Route search ran out of time, after searching { progress.routes_searched } routes')
+        route_cache.discard(cache_key)
+
+    # NOTE: Journeys don't carry the day they run on, so only offer
+    #       tomorrow's trains when there's nothing left today
+    for day_offset, best_journeys in best_journeys_by_day:
+        route_journeys = [
+            (route, journey)
+            for route, journeys in best_journeys
+            for journey in journeys
+            if day_offset != 0 or journey[0].start.public_departure >= time]
+        if len(route_journeys) > 0:
+            route_journeys.sort(key = lambda x: order_key(x[1]))
+            return route_journeys
+    return []
@@ -0,0 +1,286 @@
+import datetime
+import config
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Union
+from sqlalchemy.orm.session import Session
+from reasoning_engine.routeing import Leg, RouteAndJourneys, crs_to_tiplocs, journeys_from_legs
+from reasoning_engine.timetable import StopRow, minutes_from_sql_time, stops_running_on_date
+from reasoning_engine.timetable import timetable_cache
+
+NEVER = 1 << 30
+
+# Route, trip within the route, and the positions it's boarded and left at
+Label = tuple[int, int, int, int]
+
+@dataclass
+class RouteTimetable:
+    stations: list[str]
+    station_ids: dict[str, int]
+
+    # Stations along each route pattern, routes_stations[route_stop_offsets[r]:route_stop_offsets[r + 1]]
+    route_stop_offsets: list[int]
+    route_stations: list[int]
+
+    # Trips of each route ordered by departure, with a row of times per trip.
+    # Times are in minutes from the start of the service day
+    route_trip_uids: list[list[str]]
+    route_arrivals: list[list[list[int]]]
+    route_departures: list[list[list[int]]]
+
+    # Departures from each stop of each trip, by stop position, so trips can be bisected
+    route_stop_departures: list[list[list[int]]]
+
+    # Routes calling at each station, station_routes[station_route_offsets[s]:station_route_offsets[s + 1]]
+    station_route_offsets: list[int]
+    station_routes: list[tuple[int, int]]
+
+def trip_times(stops: list[StopRow]) -> tuple[list[int], list[int]]:
+    arrivals: list[int] = []
+    departures: list[int] = []
+    day_offset = 0
+    last_time = 0
+    for _, _, _, arrival_time, departure_time in stops:
+        times = []
+        for time in [arrival_time, departure_time]:
+            if time is None:
+                times.append(None)
+                continue
+
+            # NOTE: Times only go forward along a train, so going backwards means it ran past midnight
+            minutes = minutes_from_sql_time(time) + day_offset
+            if minutes < last_time:
+                day_offset += 24*60
+                minutes += 24*60
+            last_time = minutes
+            times.append(minutes)
+
+        arrival, departure = times
+        arrivals.append(NEVER if arrival is None else arrival)
+        departures.append(NEVER if departure is None else departure)
+    return arrivals, departures
+
+def overtakes(arrivals: list[int], departures: list[int],
+              other_arrivals: list[int], other_departures: list[int]) -> bool:
+    return any([
+        arrival < other_arrival or departure < other_departure
+        for arrival, departure, other_arrival, other_departure
+        in zip(arrivals, departures, other_arrivals, other_departures)])
+
+def route_timetable_from_stops(stops: Iterable[StopRow]) -> RouteTimetable:
+    stations: list[str] = []
+    station_ids: dict[str, int] = {}
+
+    def station_id(location: str) -> int:
+        if not location in station_ids:
+            station_ids[location] = len(stations)
+            stations.append(location)
+        return station_ids[location]
+
+    # Group trains calling at the same stations in the same order
+    trips_by_pattern: dict[tuple[int, ...], list[tuple[str, list[int], list[int]]]] = {}
+    train_stops: list[StopRow] = []
+    def add_train():
+        if len(train_stops) < 2:
+            return
+        pattern = tuple([station_id(stop[2]) for stop in train_stops])
+        arrivals, departures = trip_times(train_stops)
+        trips_by_pattern.setdefault(pattern, []).append((train_stops[0][0], arrivals, departures))
+
+    for stop in stops:
+        if len(train_stops) > 0 and train_stops[-1][0] != stop[0]:
+            add_train()
+            train_stops = []
+        train_stops.append(stop)
+    add_train()
+
+    # NOTE: A trip can only be found by bisecting if it never overtakes an earlier one,
+    #       so any that do are split off into their own route
+    route_stop_offsets = [0]
+    route_stations: list[int] = []
+    route_trip_uids: list[list[str]] = []
+    route_arrivals: list[list[list[int]]] = []
+    route_departures: list[list[list[int]]] = []
+    for pattern, trips in trips_by_pattern.items():
+        trips.sort(key=lambda trip: trip[2][0])
+        routes: list[list[tuple[str, list[int], list[int]]]] = []
+        for trip in trips:
+            for route in routes:
+                _, last_arrivals, last_departures = route[-1]
+                if not overtakes(trip[1], trip[2], last_arrivals, last_departures):
+                    route.append(trip)
+                    break
+            else:
+                routes.append([trip])
+
+        for route in routes:
+            route_stations += pattern
+            route_stop_offsets.append(len(route_stations))
+            route_trip_uids.append([train_uid for train_uid, _, _ in route])
+            route_arrivals.append([arrivals for _, arrivals, _ in route])
+            route_departures.append([departures for _, _, departures in route])
+
+    route_stop_departures = [
+        [list(stop_departures) for stop_departures in zip(*departures)]
+        for departures in route_departures]
+
+    routes_at_station: list[list[tuple[int, int]]] = [[] for _ in stations]
+    for route in range(len(route_trip_uids)):
+        start, end = route_stop_offsets[route], route_stop_offsets[route + 1]
+        for position, station in enumerate(route_stations[start:end]):
+            routes_at_station[station].append((route, position))
+
+    station_route_offsets = [0]
+    station_routes: list[tuple[int, int]] = []
+    for routes in routes_at_station:
+        station_routes += routes
+        station_route_offsets.append(len(station_routes))
+
+    return RouteTimetable(
+        stations = stations,
+        station_ids = station_ids,
+        route_stop_offsets = route_stop_offsets,
+        route_stations = route_stations,
+        route_trip_uids = route_trip_uids,
+        route_arrivals = route_arrivals,
+        route_departures = route_departures,
+        route_stop_departures = route_stop_departures,
+        station_route_offsets = station_route_offsets,
+        station_routes = station_routes)
+
+def route_timetable_for_date(db: Session, date: datetime.date) -> RouteTimetable:
+    return timetable_cache.get(db, ('routes', date),
+        lambda: route_timetable_from_stops(stops_running_on_date(db, date)))
+
+def label_path(timetable: RouteTimetable, labels: list[list[Union[Label, None]]],
+               round: int, station: int) -> list[Label]:
+    path: list[Label] = []
+    while round > 0:
+        label = labels[round][station]
+        assert not label is None
+
+        route, _, board, _ = label
+        path.append(label)
+        station = timetable.route_stations[timetable.route_stop_offsets[route] + board]
+        round -= 1
+
+        # Skip rounds that didn't improve on the station we boarded at
+        while round > 0 and labels[round][station] == labels[round - 1][station]:
+            round -= 1
+
+    path.reverse()
+    return path
+
+def legs_for_label(timetable: RouteTimetable, labels: list[list[Union[Label, None]]],
+                   round: int, station: int) -> list[Leg]:
+    # NOTE: Routes include every stop of their trains, so positions are route indices
+    return [(timetable.route_trip_uids[route][trip], board, alight)
+        for route, trip, board, alight in label_path(timetable, labels, round, station)]
+
+def raptor_rounds(timetable: RouteTimetable, sources: Iterable[int], departure: int,
+                  max_trips: int, targets: Iterable[int] = (), stop_at: set[int] = set()
+                  ) -> Iterator[tuple[int, list[int], list[list[Union[Label, None]]], set[int]]]:
+    station_count = len(timetable.stations)
+    targets = list(targets)
+    change_minutes = config.MIN_CHANGE_MINUTES
+
+    # Best arrival with at most k trips, along with how the station was reached
+    arrivals = [[NEVER] * station_count]
+    labels: list[list[Union[Label, None]]] = [[None] * station_count]
+    best_arrivals = [NEVER] * station_count
+    marked = set(sources)
+    for source in marked:
+        arrivals[0][source] = departure - change_minutes
+        best_arrivals[source] = departure - change_minutes
+
+    route_stop_offsets = timetable.route_stop_offsets
+    route_stations = timetable.route_stations
+    station_route_offsets = timetable.station_route_offsets
+    station_routes = timetable.station_routes
+
+    # NOTE: Nothing arriving after the targets are reached can lead to a better journey
+    best_target_arrival = NEVER
+    for round in range(1, max_trips + 1):
+        last_arrivals = arrivals[-1]
+        round_arrivals = list(last_arrivals)
+        round_labels = list(labels[-1])
+        arrivals.append(round_arrivals)
+        labels.append(round_labels)
+
+        # Only scan routes from the first station marked last round, journeys
+        # can still reach the stations to stop at but never change trains there
+        routes_to_scan: dict[int, int] = {}
+        for station in marked:
+            if station in stop_at:
+                continue
+            for route, position in station_routes[station_route_offsets[station]:station_route_offsets[station + 1]]:
+                if position < routes_to_scan.get(route, NEVER):
+                    routes_to_scan[route] = position
+
+        marked = set()
+        for route, start_position in routes_to_scan.items():
+            offset = route_stop_offsets[route]
+            stations = route_stations[offset:route_stop_offsets[route + 1]]
+            trip_arrivals = timetable.route_arrivals[route]
+            stop_departures = timetable.route_stop_departures[route]
+
+            trip = -1
+            board = -1
+            arrival_times: list[int] = []
+            for position in range(start_position, len(stations)):
+                station = stations[position]
+                if trip >= 0:
+                    arrival = arrival_times[position]
+                    if arrival < best_arrivals[station] and arrival < best_target_arrival:
+                        round_arrivals[station] = arrival
+                        best_arrivals[station] = arrival
+                        round_labels[station] = (route, trip, board, position)
+                        marked.add(station)
+
+                # Catch an earlier trip, if we got here in time last round
+                ready = last_arrivals[station] + change_minutes
+                if trip < 0 or ready <= stop_departures[position][trip]:
+                    earlier_trip = bisect_left(stop_departures[position], ready)
+                    if earlier_trip < len(stop_departures[position]) and earlier_trip != trip:
+                        if stop_departures[position][earlier_trip] < NEVER:
+                            trip = earlier_trip
+                            board = position
+                            arrival_times = trip_arrivals[trip]
+
+                    # NOTE: Looped back round to where it was boarded, so it's just as good to get on here
+                    elif earlier_trip == trip and station == stations[board]:
+                        board = position
+
+        # Stations reached sooner this round, along with the arrivals and labels so far
+        yield round, round_arrivals, labels, marked
+        if len(targets) > 0:
+            best_target_arrival = min(best_target_arrival, min([round_arrivals[target] for target in targets]))
+        if len(marked) == 0:
+            break
+
+def pareto_journey_legs(timetable: RouteTimetable,
+                        sources: Iterable[int], targets: Iterable[int],
+                        departure: int, max_trips: int) -> list[list[Leg]]:
+    targets = list(targets)
+    journeys: list[list[Leg]] = []
+    best_target_arrival = NEVER
+    for round, round_arrivals, labels, _ in raptor_rounds(timetable, sources, departure, max_trips, targets):
+        target_arrival, target = min([(round_arrivals[target], target) for target in targets])
+        if target_arrival < best_target_arrival:
+            best_target_arrival = target_arrival
+            journeys.append(legs_for_label(timetable, labels, round, target))
+    return journeys
+
+def find_journeys_raptor(db: Session, from_crs: str, to_crs: str,
+                         date: datetime.date, time: datetime.time) -> list[RouteAndJourneys]:
+    timetable = route_timetable_for_date(db, date)
+    sources = [timetable.station_ids[location]
+        for location in crs_to_tiplocs(db, from_crs) if location in timetable.station_ids]
+    targets = [timetable.station_ids[location]
+        for location in crs_to_tiplocs(db, to_crs) if location in timetable.station_ids]
+    if len(sources) == 0 or len(targets) == 0:
+        return []
+
+    journeys = pareto_journey_legs(timetable, sources, targets,
+        time.hour*60 + time.minute, config.RAPTOR_MAX_TRIPS)
+    return journeys_from_legs(db, journeys)
@@ -1,13 +1,18 @@
 from __future__ import annotations
 import datetime
-import copy
-import math
-from dataclasses import dataclass
-from typing import Iterable, Sequence, Union
+import json
+import time
+import config
+from dataclasses import asdict, dataclass, field
+from typing import Iterable, Iterator, Sequence, Union
 from knowledge_base import TrainPath, TrainRoute, TrainRouteSegment, group
-from knowledge_base.dtd import TIPLOC, TimetableLocationType, date_to_sql
-from knowledge_base.dtd import TimetableLocation, TrainTimetable, TimetableLink
-from sqlalchemy.sql.elements import literal
+from knowledge_base.dtd import TIPLOC
+from knowledge_base.dtd import TimetableLocation, TrainTimetable
+from reasoning_engine.departures import DepartureIndex, departure_index_for_date
+from reasoning_engine.station_graph import load_station_coordinates, load_station_graph, stations_within_detour
+from reasoning_engine.stop_batch import Stop, StopBatch, stop_batch_at_locations, stop_batch_for_date
+from reasoning_engine.stop_batch import trains_visiting_in_order
+from reasoning_engine.timetable import minutes_from_sql_time
 from sqlalchemy.orm.session import Session
 
 @dataclass
@@ -23,163 +28,214 @@ class JourneySegment:
             hash(self.end))
 
 LocationRoute = list[str]
-TrainStops = list[TimetableLocation]
+TrainStops = list[Stop]
 Journey = Sequence[JourneySegment]
 RouteAndJourneys = tuple[TrainRoute, list[Journey]]
 
-class Path:
-    _stations: list[str]
-    _sub_paths: list[Path]
+NEVER = 1 << 30
 
-    _locations: set[str]
-    _sub_path_locations: list[set[str]]
+# Stops each train in a journey is boarded and left at
+StopJourney = list[tuple[Stop, Stop]]
 
-    def __init__(self, other: Path = None):
-        self._stations = copy.copy(other._stations) if other else []
-        self._sub_paths = copy.copy(other._sub_paths) if other else []
+# Train uid, along with the route index it's boarded and left at
+Leg = tuple[str, int, int]
 
-        self._locations = copy.copy(other._locations) if other else set()
-        self._sub_path_locations = copy.copy(other._sub_path_locations) if other else []
+@dataclass
+class SearchProgress:
+    # NOTE: Searches check in as they go, and stop with what they've found once out of time
+    budget_seconds: Union[float, None] = None
+    started: float = field(default_factory=time.perf_counter)
+    complete: bool = True
+
+    depth: int = 0
+    paths_explored: int = 0
+    routes_searched: int = 0
+    phase_seconds: dict[str, float] = field(default_factory=dict)
+
+    def out_of_time(self, budget_share: float = 1) -> bool:
+        if self.budget_seconds is None:
+            return False
+        if time.perf_counter() - self.started < self.budget_seconds * budget_share:
+            return False
+
+        self.complete = False
+        return True
+
+    def finish_phase(self, phase: str, start: float):
+        self.phase_seconds[phase] = self.phase_seconds.get(phase, 0) + time.perf_counter() - start
+
+def record_search_progress(from_crs: str, to_crs: str, date: datetime.date, progress: SearchProgress):
+    if config.ROUTE_SEARCH_STATS_FILE is None:
+        return
+
+    # One JSON object per line, so the file can be appended to as queries come in
+    with open(config.ROUTE_SEARCH_STATS_FILE, 'a') as f:
+        f.write(json.dumps(dict(asdict(progress),
+            from_crs = from_crs, to_crs = to_crs, date = date.isoformat(),
+            seconds = time.perf_counter() - progress.started)) + '\n')
 
-    def extend(self, from_location: str) -> Path:
-        new_path = Path(self)
-        new_path._stations.insert(0, from_location)
-        new_path._locations.add(from_location)
-        return new_path
+class Path:
+    # NOTE: Paths share their history through parent pointers, each node only
+    #       adds a station or joins together paths reaching the same station
+    __slots__ = ['_stations', '_station', '_parents', '_visited', '_count']
+    _stations: list[str]
+    _station: Union[int, None]
+    _parents: tuple[Path, ...]
+    _visited: int
+    _count: int
+
+    def __init__(self, stations: list[str], station: Union[int, None] = None,
+                 parents: tuple[Path, ...] = (), visited: int = 0):
+        self._stations = stations
+        self._station = station
+        self._parents = parents
+        self._visited = visited
+        self._count = 1 if len(parents) == 0 else sum([parent._count for parent in parents])
+
+    def extend(self, from_location: int) -> Path:
+        return Path(self._stations, from_location, (self,),
+            self._visited | (1 << from_location))
     
     def merge(self, other: Path) -> Path:
-        # Flatten any unneeded sub paths
-        new_path = Path()
+        # Flatten any unneeded joins
+        parents: list[Path] = []
         for sub_path in [self, other]:
-            new_path._sub_path_locations.append(sub_path._locations)
-            new_path._sub_path_locations += sub_path._sub_path_locations
-            if len(sub_path._stations) == 0:
-                new_path._sub_paths += sub_path._sub_paths
+            if sub_path._station is None and len(sub_path._parents) > 0:
+                parents += sub_path._parents
             else:
-                new_path._sub_paths.append(sub_path)
+                parents.append(sub_path)
 
-        return new_path
+        return Path(self._stations, None, tuple(parents),
+            self._visited | other._visited)
 
-    def has_been_to(self, location: str) -> bool:
-        if location in self._locations:
-            return True
-
-        return any([location in location_set 
-            for location_set in self._sub_path_locations])
+    def has_been_to(self, location: int) -> bool:
+        return (self._visited >> location) & 1 == 1
 
     def possible_paths_count(self) -> int:
-        return 1 + sum([sub_path.possible_paths_count() 
-            for sub_path in self._sub_paths])
+        return self._count
 
     def all_locations(self) -> set[str]:
-        return self._locations.union(*self._sub_path_locations)
-
-    def routes(self) -> list[LocationRoute]:
-        if len(self._sub_paths) == 0:
-            return [self._stations]
+        locations = set()
+        visited = self._visited
+        while visited:
+            lowest_bit = visited & -visited
+            locations.add(self._stations[lowest_bit.bit_length() - 1])
+            visited ^= lowest_bit
+        return locations
+
+    def routes(self) -> Iterator[LocationRoute]:
+        stack: list[tuple[Path, LocationRoute]] = [(self, [])]
+        while len(stack) > 0:
+            path, route = stack.pop()
+            if not path._station is None:
+                route = route + [path._stations[path._station]]
+
+            if len(path._parents) == 0:
+                yield route
+                continue
 
-        return [self._stations + sub_route
-            for sub_path in self._sub_paths
-            for sub_route in sub_path.routes()]
+            for parent in reversed(path._parents):
+                stack.append((parent, route))
 
     def debug_print(self, indent: int = 0):
-        print(f"{ ' ' * indent }{ ' '.join(self._stations) }")
-        for sub_path in self._sub_paths:
-            sub_path.debug_print(indent + 1)
-
-def links_from_location(db: Session, from_loc: Iterable[str]):
-    links = db.query(TimetableLink.from_location, TimetableLink.to_location)\
-        .select_from(TimetableLink)\
-        .filter(TimetableLink.from_location.in_(from_loc))\
-        .all()
-    return links
+        station = '' if self._station is None else self._stations[self._station]
+        print(f"{ ' ' * indent }{ station }")
+        for parent in self._parents:
+            parent.debug_print(indent + 1)
+
+def search_paths_and_expansions(db: Session, n: int, from_loc: str, to_loc: str,
+                                detour_factor: Union[float, None] = None,
+                                min_detour_km: Union[float, None] = None,
+                                progress: Union[SearchProgress, None] = None,
+                                prune_detours: bool = True) -> tuple[list[Path], int]:
+    if progress is None:
+        progress = SearchProgress()
+    if detour_factor is None:
+        detour_factor = config.PATH_SEARCH_DETOUR_FACTOR
+    if min_detour_km is None:
+        min_detour_km = config.PATH_SEARCH_MIN_DETOUR_KM
+
+    graph = load_station_graph(db)
+    if not from_loc in graph.station_ids or not to_loc in graph.station_ids:
+        return [], 0
+
+    from_id, to_id = graph.station_ids[from_loc], graph.station_ids[to_loc]
+    allowed = None
+    if prune_detours and not detour_factor is None:
+        allowed = stations_within_detour(load_station_coordinates(db, graph),
+            from_id, to_id, detour_factor, min_detour_km)
 
-def search_paths(db: Session, n: int,
-                 from_loc: str, to_loc: str) -> list[Path]:
     found_paths = []
     found_possible_routes_count = 0
-    paths = { from_loc: Path() }
+    paths = { from_id: Path(graph.stations) }
     depth = 0
-    while found_possible_routes_count < n:
-        next_paths = {}
-        for from_location, to_location in links_from_location(db, paths.keys()):
-            path = paths[from_location]
-            if path.has_been_to(to_location):
-                continue
+    expansions = 0
+    while found_possible_routes_count < n and len(paths) > 0:
+        # Leave the rest of the budget for finding trains along what's been found
+        if progress.out_of_time(config.PATH_SEARCH_BUDGET_SHARE):
+            break
+
+        next_paths: dict[int, Path] = {}
+        for from_location, path in paths.items():
+            expansions += 1
+            for to_location in graph.neighbours(from_location):
+                if path.has_been_to(to_location):
+                    continue
+                if not allowed is None and not allowed[to_location]:
+                    continue
 
-            new_path = path.extend(from_location)
-            if to_location in next_paths:
-                new_path = new_path.merge(next_paths[to_location])
-            next_paths[to_location] = new_path
+                new_path = path.extend(from_location)
+                if to_location in next_paths:
+                    new_path = new_path.merge(next_paths[to_location])
+                next_paths[to_location] = new_path
 
         paths = next_paths
-        if to_loc in paths:
-            path = paths[to_loc].extend(to_loc)
+        if to_id in paths:
+            path = paths[to_id].extend(to_id)
             found_possible_routes_count += path.possible_paths_count()
             found_paths.append(path)
-            del paths[to_loc]
+            del paths[to_id]
         
         depth += 1
         if depth >= 400:
             break
 
-    return found_paths
+    progress.depth = max(progress.depth, depth)
+    progress.paths_explored += expansions
+
+    # NOTE: Some journeys really do double back on themselves, so fall back to searching everywhere
+    if len(found_paths) == 0 and not allowed is None:
+        found_paths, bfs_expansions = search_paths_and_expansions(db, n, from_loc, to_loc,
+            progress = progress, prune_detours = False)
+        expansions += bfs_expansions
+    return found_paths, expansions
+
+def search_paths(db: Session, n: int,
+                 from_loc: str, to_loc: str,
+                 progress: Union[SearchProgress, None] = None) -> list[Path]:
+    return search_paths_and_expansions(db, n, from_loc, to_loc, progress = progress)[0]
 
 def train_stops_in_route(db: Session, route: LocationRoute,
-                         date: datetime.date) -> list[TimetableLocation]:
-    possible_end_locations = db.query(TimetableLocation)\
-        .select_from(TimetableLocation)\
-        .join(TrainTimetable, TrainTimetable.train_uid == TimetableLocation.train_uid)\
-        .filter(TimetableLocation.location.in_(literal(route)))\
-        .filter(date_to_sql(date) >= TrainTimetable.date_runs_from)\
-        .filter(date_to_sql(date) <= TrainTimetable.date_runs_to)\
-        .filter(TrainTimetable.day_to_column(date.weekday()))
-    return list(possible_end_locations.all())
+                         date: datetime.date) -> StopBatch:
+    # NOTE: Only the stops of trains running that day are read, once, then shared between routes
+    return stop_batch_at_locations(stop_batch_for_date(db, date), route)
 
 def train_stops_from_paths(db: Session, date: datetime.date,
-                           paths: Iterable[Path]) -> list[TimetableLocation]:
+                           paths: Iterable[Path]) -> StopBatch:
     all_locations = set().union(
         *[path.all_locations() for path in paths])
     return train_stops_in_route(db, list(all_locations), date)
 
-def sort_trains_by_uid(train_stops: TrainStops,
-                       route: LocationRoute) -> dict[str, TrainStops]:
-    stops_by_train_uid: dict[str, TrainStops] = {}
-    index_lookup = { location: i for i, location in enumerate(route) }
-
-    for new_stop in train_stops:
-        if not new_stop.train_uid in stops_by_train_uid:
-            stops_by_train_uid[new_stop.train_uid] = [new_stop]
-            continue
-        
-        train = stops_by_train_uid[new_stop.train_uid]
-        location_route_index = index_lookup[new_stop.location]
-
-        if (new_stop.train_route_index < train[-1].train_route_index
-            and location_route_index > index_lookup[train[-1].location]):
-            train.append(new_stop)
-            continue
-
-        last_stop_route_index = math.inf
-        for i, next_stop in enumerate(train):
-            if (new_stop.train_route_index > next_stop.train_route_index
-                and new_stop.train_route_index < last_stop_route_index
-                and location_route_index < index_lookup[next_stop.location]):
-                train.insert(i, new_stop)
-                break
-            last_stop_route_index = next_stop.train_route_index
-    return {
-        train_uid: stops
-        for train_uid, stops in stops_by_train_uid.items()
-        if len(stops) > 1 }
-
 def search_train_route(start: str,
                        train_paths: Iterable[TrainPath],
                        route: LocationRoute,
                        train_route: TrainRoute = [],
+                       progress: Union[SearchProgress, None] = None
                        ) -> Union[TrainRoute, None]:
     if len(train_route) > 3:
         return None
+    if not progress is None and progress.out_of_time():
+        return None
 
     trains = [train for train in train_paths if start in train]
     for train in trains:
@@ -192,72 +248,155 @@ def search_train_route(start: str,
                 continue
 
             result = search_train_route(stop, train_paths, route,
-                train_route + [TrainRouteSegment(train, start, stop)])
+                train_route + [TrainRouteSegment(train, start, stop)], progress)
             if not result is None:
                 return result
     return None
 
-def train_timetable_from_train_uid(db: Session, train_uid: str) -> TrainTimetable:
-    return db.query(TrainTimetable)\
-        .filter(TrainTimetable.train_uid == train_uid)\
-        .first()
+def train_timetables_from_train_uids(db: Session, train_uids: Iterable[str]) -> dict[str, TrainTimetable]:
+    train_uids = set(train_uids)
+    if len(train_uids) == 0:
+        return {}
+
+    return { train.train_uid: train
+        for train in db.query(TrainTimetable)\
+            .filter(TrainTimetable.train_uid.in_(train_uids))\
+            .all() }
+
+def timetable_locations_from_train_uids(db: Session, train_uids: Iterable[str]
+                                        ) -> dict[tuple[str, int], TimetableLocation]:
+    train_uids = set(train_uids)
+    if len(train_uids) == 0:
+        return {}
+
+    return { (stop.train_uid, stop.train_route_index): stop
+        for stop in db.query(TimetableLocation)\
+            .filter(TimetableLocation.train_uid.in_(train_uids))\
+            .all() }
+
+def find_stop_journeys(departures: DepartureIndex,
+                       trains_by_paths: dict[TrainPath, list[TrainStops]],
+                       train_route: TrainRoute) -> list[StopJourney]:
+    # Where each train on the later segments can be boarded, along with the rest of its stops
+    boarding_stops = [
+        { (stop.train_uid, stop.train_route_index): (stop, train)
+            for train in trains_by_paths[segment.path]
+            for stop in train
+                if stop.location == segment.start_location }
+        for segment in train_route[1:]]
 
-def find_journeys(db: Session,
-                  trains_by_paths: dict[TrainPath, list[TrainStops]],
-                  train_route: TrainRoute) -> list[Journey]:
     start_trains = trains_by_paths[train_route[0].path]
-    journeys: list[Journey] = []
+    journeys: list[StopJourney] = []
     for start_train in start_trains:
         first_start = start_train[-1]
         first_stop = next(filter(lambda x: x.location == train_route[0].stop_location, start_train))
 
-        train_timeable = train_timetable_from_train_uid(db, first_start.train_uid)
-        journey: Journey = [JourneySegment(train_timeable, first_start, first_stop)]
-        for segment in train_route[1:]:
-            trains = [(stop, train)
-                for train in trains_by_paths[segment.path]
-                for stop in train
-                    if (stop.location == journey[-1].end.location and
-                        stop.location_type != TimetableLocationType.Terminating and
-                        stop.scheduled_departure_time > journey[-1].end.scheduled_arrival_time)]
-            if len(trains) == 0:
+        journey: StopJourney = [(first_start, first_stop)]
+        for segment, segment_boarding_stops in zip(train_route[1:], boarding_stops):
+            last_stop = journey[-1][1]
+            arrival = minutes_from_sql_time(last_stop.scheduled_arrival_time)
+            next_train = next((
+                segment_boarding_stops[(departure.train_uid, departure.train_route_index)]
+                for departure in departures.departures_between(last_stop.location, arrival + 1, NEVER)
+                if (departure.train_uid, departure.train_route_index) in segment_boarding_stops), None)
+            if next_train is None:
                 break
 
-            start, train = min(trains, key=lambda x: x[0].scheduled_departure_time)
+            start, train = next_train
             stop = next(filter(lambda x: x.location == segment.stop_location, train))
-
-            train_timeable = train_timetable_from_train_uid(db, first_start.train_uid)
-            journey.append(JourneySegment(train_timeable, start, stop))
+            journey.append((start, stop))
         else:
             journeys.append(journey)
     return journeys
 
-def find_journeys_for_route(db: Session, route: LocationRoute,
-                            all_train_stops: list[TimetableLocation]
-                            ) -> Union[RouteAndJourneys, None]:
-    train_stops = [stop for stop in all_train_stops if stop.location in route]
-    stops_by_train_uid = sort_trains_by_uid(train_stops, route)
-    trains_by_paths = group(
-        stops_by_train_uid.values(),
-        lambda x: tuple([str(stop.location) for stop in x]))
+def find_stop_journeys_for_route(route: LocationRoute, all_train_stops: StopBatch,
+                                 departures: DepartureIndex,
+                                 progress: Union[SearchProgress, None] = None
+                                 ) -> Union[tuple[TrainRoute, list[StopJourney]], None]:
+    trains_by_paths = trains_visiting_in_order(all_train_stops, route)
     train_paths = trains_by_paths.keys()
 
     start_location = route[-1]
-    train_route = search_train_route(start_location, train_paths, route)
+    train_route = search_train_route(start_location, train_paths, route, progress = progress)
     if train_route is None:
         return None
     
-    return train_route, find_journeys(db, trains_by_paths, train_route)
+    return train_route, find_stop_journeys(departures, trains_by_paths, train_route)
 
 def find_journeys_for_paths(db: Session, date: datetime.date,
-                            paths: Iterable[Path]) -> Iterable[RouteAndJourneys]:
+                            paths: Iterable[Path],
+                            progress: Union[SearchProgress, None] = None) -> Iterable[RouteAndJourneys]:
+    if progress is None:
+        progress = SearchProgress()
+
+    start = time.perf_counter()
     all_train_stops = train_stops_from_paths(db, date, paths)
-    routes_and_journeys = []
+    departures = departure_index_for_date(db, date)
+    progress.finish_phase('stops', start)
+
+    # NOTE: Paths are found shortest first, so running out of time only loses the longer routes
+    start = time.perf_counter()
+    routes_and_stop_journeys = []
     for route in [route for path in paths for route in path.routes()]:
-        result = find_journeys_for_route(db, route, all_train_stops)
+        if progress.out_of_time():
+            break
+
+        progress.routes_searched += 1
+        result = find_stop_journeys_for_route(route, all_train_stops, departures, progress)
         if not result is None:
-            routes_and_journeys.append(result)
-    return routes_and_journeys
+            routes_and_stop_journeys.append(result)
+    progress.finish_phase('train_routes', start)
+
+    # NOTE: Every train taken is looked up together, once all the journeys are known
+    start = time.perf_counter()
+    train_uids = { start.train_uid
+        for _, stop_journeys in routes_and_stop_journeys
+        for journey in stop_journeys
+        for start, _ in journey }
+    trains = train_timetables_from_train_uids(db, train_uids)
+    stops = timetable_locations_from_train_uids(db, train_uids)
+
+    def journey_segment(start: Stop, end: Stop) -> JourneySegment:
+        return JourneySegment(trains[start.train_uid],
+            stops[(start.train_uid, start.train_route_index)],
+            stops[(end.train_uid, end.train_route_index)])
+
+    route_journeys = [
+        (train_route, [
+            [journey_segment(start, end) for start, end in journey]
+            for journey in stop_journeys])
+        for train_route, stop_journeys in routes_and_stop_journeys]
+    progress.finish_phase('trains', start)
+    return route_journeys
+
+def journeys_from_legs(db: Session, journey_legs: Iterable[list[Leg]]) -> list[RouteAndJourneys]:
+    journey_legs = list(journey_legs)
+    train_uids = { train_uid for legs in journey_legs for train_uid, _, _ in legs }
+    if len(train_uids) == 0:
+        return []
+
+    trains = train_timetables_from_train_uids(db, train_uids)
+    stops = timetable_locations_from_train_uids(db, train_uids)
+
+    journeys_by_route: dict[tuple[TrainRouteSegment, ...], list[Journey]] = {}
+    for legs in journey_legs:
+        route: TrainRoute = []
+        journey: list[JourneySegment] = []
+        for train_uid, start_index, end_index in legs:
+            train_path = tuple([str(stops[(train_uid, i)].location)
+                for i in range(start_index, end_index + 1)])
+            route.append(TrainRouteSegment(train_path, train_path[0], train_path[-1]))
+            journey.append(JourneySegment(trains[train_uid],
+                stops[(train_uid, start_index)], stops[(train_uid, end_index)]))
+        journeys_by_route.setdefault(tuple(route), []).append(journey)
+
+    return [(list(route), journeys) for route, journeys in journeys_by_route.items()]
+
+def crs_to_tiplocs(db: Session, crs: str) -> list[str]:
+    return [tiploc for tiploc, in db\
+        .query(TIPLOC.tiploc_code)\
+        .filter(TIPLOC.crs_code == crs)\
+        .all()]
 
 def crs_route_to_tiploc_route(db: Session, crs_route: LocationRoute) -> LocationRoute:
     crs_to_tiploc_map = {
@@ -269,10 +408,16 @@ def crs_route_to_tiploc_route(db: Session, crs_route: LocationRoute) -> Location
     return [crs_to_tiploc_map[crs] for crs in crs_route]
 
 def find_journeys_from_crs(db: Session, from_crs: str, to_crs: str,
-                           date: datetime.date) -> Iterable[RouteAndJourneys]:
+                           date: datetime.date,
+                           progress: Union[SearchProgress, None] = None) -> Iterable[RouteAndJourneys]:
+    if progress is None:
+        progress = SearchProgress()
+
     from_loc, to_loc = crs_route_to_tiploc_route(db, [from_crs, to_crs])
-    found_paths = search_paths(db, 4, from_loc, to_loc)
-    return find_journeys_for_paths(db, date, found_paths)
+    start = time.perf_counter()
+    found_paths = search_paths(db, 4, from_loc, to_loc, progress)
+    progress.finish_phase('paths', start)
+    return find_journeys_for_paths(db, date, found_paths, progress)
 
 def filter_best_journeys(journeys: Iterable[RouteAndJourneys]) -> Iterable[RouteAndJourneys]:
     all_journeys = [
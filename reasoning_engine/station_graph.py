@@ -0,0 +1,113 @@
+import numpy as np
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Union
+from knowledge_base.dtd import TIPLOC, TimetableLink
+from knowledge_base.feeds import ExpiryTimes
+from knowledge_base.kb import KBStations, Station
+from sqlalchemy.orm.session import Session
+from knowledge_base.snapshot import Snapshot
+from reasoning_engine.timetable import load_timetable_snapshot, snapshot_locations, timetable_cache
+
+@dataclass
+class StationGraph:
+    stations: list[str]
+    station_ids: dict[str, int]
+
+    # Stations linked to from each station, targets[offsets[s]:offsets[s + 1]]
+    offsets: list[int]
+    targets: list[int]
+
+    def neighbours(self, station: int) -> list[int]:
+        return self.targets[self.offsets[station]:self.offsets[station + 1]]
+
+    def links_from(self, locations: Iterable[str]) -> Iterator[tuple[str, str]]:
+        for location in locations:
+            station = self.station_ids.get(location)
+            if station is None:
+                continue
+
+            for target in self.neighbours(station):
+                yield location, self.stations[target]
+
+def station_graph_from_links(links: Iterable[tuple[str, str]]) -> StationGraph:
+    stations: list[str] = []
+    station_ids: dict[str, int] = {}
+
+    def station_id(location: str) -> int:
+        if not location in station_ids:
+            station_ids[location] = len(stations)
+            stations.append(location)
+        return station_ids[location]
+
+    id_links = sorted([(station_id(from_location), station_id(to_location))
+        for from_location, to_location in links])
+
+    offsets = [0] * (len(stations) + 1)
+    for from_station, _ in id_links:
+        offsets[from_station + 1] += 1
+    for station in range(len(stations)):
+        offsets[station + 1] += offsets[station]
+
+    return StationGraph(
+        stations = stations,
+        station_ids = station_ids,
+        offsets = offsets,
+        targets = [to_station for _, to_station in id_links])
+
+def links_from_snapshot(snapshot: Snapshot) -> list[tuple[str, str]]:
+    locations = snapshot_locations(snapshot)
+    return [(locations[from_location], locations[to_location])
+        for from_location, to_location in zip(snapshot['link_from'].tolist(), snapshot['link_to'].tolist())]
+
+def load_station_graph(db: Session) -> StationGraph:
+    def build() -> StationGraph:
+        snapshot = load_timetable_snapshot(db)
+        if not snapshot is None:
+            return station_graph_from_links(links_from_snapshot(snapshot))
+        return station_graph_from_links(
+            db.query(TimetableLink.from_location, TimetableLink.to_location).all())
+    return timetable_cache.get(db, 'station_graph', build)
+
+EARTH_RADIUS_KM = 6371.0
+
+def stations_version(db: Session) -> Union[int, None]:
+    return db.query(ExpiryTimes.expiry_timestamp)\
+        .filter(ExpiryTimes.api_url == KBStations().feed_api_url())\
+        .scalar()
+
+def load_station_coordinates(db: Session, graph: StationGraph) -> np.ndarray:
+    def build() -> np.ndarray:
+        # Latitude and longitude of each station in radians, or NaN where it's not known
+        coordinates = np.full((len(graph.stations), 2), np.nan)
+        for tiploc, latitude, longitude in db.query(TIPLOC.tiploc_code, Station.latitude, Station.longitude)\
+                .join(Station, Station.crs_code == TIPLOC.crs_code)\
+                .all():
+            station = graph.station_ids.get(tiploc)
+            if not station is None and not latitude is None and not longitude is None:
+                coordinates[station] = np.radians([latitude, longitude])
+        return coordinates
+
+    # NOTE: Cached with the timetable, as the station ids are the graph's, but the
+    #       stations feed is refreshed on its own, so it's part of the key too
+    return timetable_cache.get(db, ('station_coordinates', stations_version(db)), build)
+
+def great_circle_km(coordinates: np.ndarray, point: np.ndarray) -> np.ndarray:
+    latitude, longitude = coordinates[..., 0], coordinates[..., 1]
+    a = (np.sin((latitude - point[0]) / 2)**2 +
+        np.cos(latitude) * np.cos(point[0]) * np.sin((longitude - point[1]) / 2)**2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def stations_within_detour(coordinates: np.ndarray, from_station: int, to_station: int,
+                           detour_factor: float, min_detour_km: float) -> Union[list[bool], None]:
+    start, end = coordinates[from_station], coordinates[to_station]
+    if np.isnan(start).any() or np.isnan(end).any():
+        return None
+
+    # NOTE: Going via a station is never shorter than the great circle distances either
+    #       side of it, so this only drops stations a route couldn't pass within the detour
+    direct_km = great_circle_km(start, end)
+    via_km = great_circle_km(coordinates, start) + great_circle_km(coordinates, end)
+    within_detour = via_km <= direct_km * detour_factor + min_detour_km
+
+    # Stations without a known position can't be ruled out
+    return (within_detour | np.isnan(via_km)).tolist()
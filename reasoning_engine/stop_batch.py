@@ -0,0 +1,135 @@
+import datetime
+import numpy as np
+from dataclasses import dataclass, replace
+from typing import Iterable, NamedTuple, Union
+from knowledge_base import TrainPath
+from reasoning_engine.timetable import StopRow, stops_running_on_date, timetable_cache
+from sqlalchemy.orm.session import Session
+
+# Times are stored as -1 in the batch where the stop has none
+NO_TIME = -1
+
+class Stop(NamedTuple):
+    train_uid: str
+    train_route_index: int
+    location: str
+    scheduled_arrival_time: Union[int, None]
+    scheduled_departure_time: Union[int, None]
+
+@dataclass
+class StopBatch:
+    locations: list[str]
+    location_ids: dict[str, int]
+    train_uids: list[str]
+
+    # One entry per stop, sorted by train then route index
+    train: np.ndarray
+    route_index: np.ndarray
+    location: np.ndarray
+    arrival: np.ndarray
+    departure: np.ndarray
+
+def stop_batch_from_rows(rows: Iterable[StopRow]) -> StopBatch:
+    locations: list[str] = []
+    location_ids: dict[str, int] = {}
+    train_uids: list[str] = []
+    train_ids: dict[str, int] = {}
+
+    def intern(value: str, ids: dict[str, int], values: list[str]) -> int:
+        if not value in ids:
+            ids[value] = len(values)
+            values.append(value)
+        return ids[value]
+
+    columns: list[tuple[int, int, int, int, int]] = [
+        (intern(train_uid, train_ids, train_uids), route_index,
+            intern(location, location_ids, locations),
+            NO_TIME if arrival is None else arrival,
+            NO_TIME if departure is None else departure)
+        for train_uid, route_index, location, arrival, departure in rows]
+
+    table = np.array(columns, dtype=np.int64).reshape(-1, 5)
+    order = np.lexsort((table[:, 1], table[:, 0]))
+    table = table[order]
+    return StopBatch(
+        locations = locations,
+        location_ids = location_ids,
+        train_uids = train_uids,
+        train = table[:, 0],
+        route_index = table[:, 1],
+        location = table[:, 2],
+        arrival = table[:, 3],
+        departure = table[:, 4])
+
+def stop_batch_for_date(db: Session, date: datetime.date) -> StopBatch:
+    return timetable_cache.get(db, ('stop_batch', date),
+        lambda: stop_batch_from_rows(stops_running_on_date(db, date)))
+
+def stop_batch_at_locations(batch: StopBatch, locations: Iterable[str]) -> StopBatch:
+    location_ids = [batch.location_ids[location] for location in locations if location in batch.location_ids]
+    at_locations = np.isin(batch.location, np.array(location_ids, dtype=np.int64))
+    return replace(batch,
+        train = batch.train[at_locations],
+        route_index = batch.route_index[at_locations],
+        location = batch.location[at_locations],
+        arrival = batch.arrival[at_locations],
+        departure = batch.departure[at_locations])
+
+def trains_visiting_in_order(batch: StopBatch, route: list[str]) -> dict[TrainPath, list[list[Stop]]]:
+    # Position of each location along the route, the destination being first
+    positions_by_location = np.full(len(batch.locations), -1, dtype=np.int64)
+    for position, location in enumerate(route):
+        location_id = batch.location_ids.get(location)
+        if not location_id is None:
+            positions_by_location[location_id] = position
+
+    positions = positions_by_location[batch.location]
+    in_route = np.flatnonzero(positions >= 0)
+    if len(in_route) == 0:
+        return {}
+
+    trains = batch.train[in_route]
+    positions = positions[in_route]
+
+    # A train calling somewhere twice in a row along the route, having looped off it in
+    # between, is ridden through from the later call, unless it's getting off at the first
+    repeats = np.flatnonzero((trains[1:] == trains[:-1]) & (positions[1:] == positions[:-1]))
+    if len(repeats) > 0:
+        after = np.minimum(repeats + 2, len(trains) - 1)
+        carries_on = (repeats + 2 < len(trains)) & (trains[after] == trains[repeats]) & (positions[after] < positions[repeats])
+        not_repeated = np.ones(len(trains), dtype=bool)
+        not_repeated[np.where(carries_on, repeats, repeats + 1)] = False
+        in_route, trains, positions = in_route[not_repeated], trains[not_repeated], positions[not_repeated]
+
+    # NOTE: Stops are in travel order, so a train heading along the route always
+    #       gets closer to the destination. Trains that turn back or call somewhere
+    #       twice are split where they do, each part taken as a run of its own
+    same_train = trains[1:] == trains[:-1]
+    same_run = same_train & (positions[1:] < positions[:-1])
+
+    # Runs need to stop at least twice along the route to be of any use
+    is_first_stop = np.concatenate(([True], ~same_run))
+    run_starts = np.flatnonzero(is_first_stop)
+    stop_counts = np.diff(np.append(run_starts, len(trains)))
+    keep = np.repeat(stop_counts, stop_counts) > 1
+
+    kept = in_route[keep]
+    train_starts = np.flatnonzero(is_first_stop[keep])
+    kept_trains = batch.train[kept].tolist()
+    kept_route_indices = batch.route_index[kept].tolist()
+    kept_locations = batch.location[kept].tolist()
+    kept_arrivals = batch.arrival[kept].tolist()
+    kept_departures = batch.departure[kept].tolist()
+
+    trains_by_path: dict[TrainPath, list[list[Stop]]] = {}
+    for start, end in zip(train_starts.tolist(), np.append(train_starts[1:], len(kept)).tolist()):
+        # Stops are listed back from the destination, same as the routes
+        stops = [
+            Stop(batch.train_uids[kept_trains[i]], kept_route_indices[i],
+                batch.locations[kept_locations[i]],
+                None if kept_arrivals[i] == NO_TIME else kept_arrivals[i],
+                None if kept_departures[i] == NO_TIME else kept_departures[i])
+            for i in range(end - 1, start - 1, -1)]
+        path = tuple([stop.location for stop in stops])
+        trains_by_path.setdefault(path, []).append(stops)
+    return dict(sorted(trains_by_path.items()))
@@ -0,0 +1,280 @@
+import datetime
+import config
+import numpy as np
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Any, Callable, Iterable, Iterator, TypeVar, Union
+from knowledge_base.dtd import DTDTimetableFeed, TimetableLocation, TimetableSnapshot, TrainCalendar
+from knowledge_base.dtd import timetable_snapshot_path
+from knowledge_base.feeds import ExpiryTimes, date_from_sql
+from knowledge_base.snapshot import Snapshot, open_snapshot
+from sqlalchemy.orm.session import Session
+
+_T = TypeVar('_T')
+
+# Rows for each stop, ordered by train then route index
+StopRow = tuple[str, int, str, Union[int, None], Union[int, None]]
+
+def minutes_from_sql_time(time: int) -> int:
+    return (time // 100)*60 + time % 100
+
+def service_day_times(stops: Iterable[StopRow]) -> Iterator[tuple[StopRow, Union[int, None], Union[int, None]]]:
+    last_train_uid = None
+    day_offset = 0
+    last_time = 0
+    for stop in stops:
+        if stop[0] != last_train_uid:
+            last_train_uid = stop[0]
+            day_offset = 0
+            last_time = 0
+
+        # NOTE: Times only go forward along a train, so going backwards means it ran past midnight
+        times: list[Union[int, None]] = []
+        for time in stop[3:5]:
+            if time is None:
+                times.append(None)
+                continue
+
+            minutes = minutes_from_sql_time(time) + day_offset
+            if minutes < last_time:
+                day_offset += 24*60
+                minutes += 24*60
+            last_time = minutes
+            times.append(minutes)
+        yield stop, times[0], times[1]
+
+def timetable_version(db: Session) -> Union[int, None]:
+    # NOTE: The expiry time is rewritten every time the timetable is refreshed
+    return db.query(ExpiryTimes.expiry_timestamp)\
+        .filter(ExpiryTimes.api_url == DTDTimetableFeed().feed_api_url())\
+        .scalar()
+
+@dataclass
+class CacheStats:
+    entries: int
+    max_entries: int
+    hits: int
+    misses: int
+
+class TimetableCache:
+    _entries: OrderedDict[Any, Any]
+    _version: Union[int, None]
+    _mutex: Lock
+    _max_entries: int
+    _hits: int
+    _misses: int
+
+    def __init__(self, max_entries: int):
+        self._entries = OrderedDict()
+        self._version = None
+        self._mutex = Lock()
+        self._max_entries = max_entries
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, db: Session, key: Any, build: Callable[[], _T]) -> _T:
+        version = timetable_version(db)
+        with self._mutex:
+            # NOTE: Everything was built from the old timetable, so drop it all at once
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+
+            if key in self._entries:
+                self._hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self._misses += 1
+
+        # NOTE: Built outside the lock, two threads may race to build the same entry
+        value = build()
+        with self._mutex:
+            if version == self._version:
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+                while len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def stats(self) -> CacheStats:
+        with self._mutex:
+            return CacheStats(
+                entries = len(self._entries),
+                max_entries = self._max_entries,
+                hits = self._hits,
+                misses = self._misses)
+
+    def discard(self, key: Any):
+        with self._mutex:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._mutex:
+            self._entries.clear()
+            self._hits = 0
+            self._misses = 0
+
+def format_cache_stats(name: str, stats: CacheStats) -> str:
+    lookups = stats.hits + stats.misses
+    hit_rate = 0 if lookups == 0 else round(stats.hits / lookups * 100, 1)
+    return (
+        f'{ name }: { stats.entries }/{ stats.max_entries } entries, '
+        f'{ stats.hits } hits, { stats.misses } misses ({ hit_rate }% hit rate)')
+
+timetable_cache = TimetableCache(config.TIMETABLE_CACHE_SIZE)
+route_cache = TimetableCache(config.ROUTE_CACHE_SIZE)
+
+CALENDAR_EPOCH = datetime.date(2000, 1, 1)
+
+# Train uids are looked up in chunks, to stay under SQLite's bound parameter limit
+TRAIN_UID_CHUNK_SIZE = 500
+
+@dataclass
+class ServiceCalendar:
+    # Running days of each train, bit i of running_days is first_day + i days from the epoch
+    train_ids: dict[str, int]
+    train_uids: list[str]
+    first_days: list[int]
+    running_days: list[int]
+
+    # Sorted train uids running on each date, built the first time the date is asked for
+    _active_trains: dict[datetime.date, list[str]] = field(default_factory=dict)
+
+    # Dates running exactly the same trains share a pattern id
+    _service_patterns: dict[tuple[str, ...], int] = field(default_factory=dict)
+    _mutex: Lock = field(default_factory=Lock)
+
+    def runs_on(self, train_uid: str, date: datetime.date) -> bool:
+        train = self.train_ids.get(train_uid)
+        if train is None:
+            return False
+
+        day = (date - CALENDAR_EPOCH).days - self.first_days[train]
+        return day >= 0 and (self.running_days[train] >> day) & 1 == 1
+
+    def active_trains(self, date: datetime.date) -> list[str]:
+        with self._mutex:
+            active_trains = self._active_trains.get(date)
+        if not active_trains is None:
+            return active_trains
+
+        date_day = (date - CALENDAR_EPOCH).days
+        active_trains = sorted([
+            train_uid
+            for train_uid, first_day, running_days
+            in zip(self.train_uids, self.first_days, self.running_days)
+            if date_day >= first_day and (running_days >> (date_day - first_day)) & 1 == 1])
+        with self._mutex:
+            self._active_trains[date] = active_trains
+        return active_trains
+
+    def service_pattern(self, date: datetime.date) -> int:
+        active_trains = tuple(self.active_trains(date))
+        with self._mutex:
+            return self._service_patterns.setdefault(active_trains, len(self._service_patterns))
+
+def service_calendar_from_rows(rows: Iterable[tuple[str, int, bytes]]) -> ServiceCalendar:
+    calendar = ServiceCalendar(train_ids = {}, train_uids = [], first_days = [], running_days = [])
+    for train_uid, first_date, running_days in rows:
+        calendar.train_ids[train_uid] = len(calendar.train_uids)
+        calendar.train_uids.append(train_uid)
+        calendar.first_days.append((date_from_sql(first_date) - CALENDAR_EPOCH).days)
+        calendar.running_days.append(int.from_bytes(running_days, 'little'))
+    return calendar
+
+def open_timetable_snapshot(db: Session) -> Union[Snapshot, None]:
+    if not config.TIMETABLE_SNAPSHOT:
+        return None
+
+    build_id = db.query(TimetableSnapshot.build_id).scalar()
+    if build_id is None:
+        return None
+    return open_snapshot(timetable_snapshot_path(build_id), build_id)
+
+def load_timetable_snapshot(db: Session) -> Union[Snapshot, None]:
+    # NOTE: Falls back to querying the database when there's no snapshot matching it
+    return timetable_cache.get(db, 'snapshot', lambda: open_timetable_snapshot(db))
+
+def snapshot_locations(snapshot: Snapshot) -> list[str]:
+    return [location.decode() for location in snapshot['locations'].tolist()]
+
+def calendar_rows_from_snapshot(snapshot: Snapshot) -> Iterator[tuple[str, int, bytes]]:
+    offsets = snapshot['calendar_offsets'].tolist()
+    bits = snapshot['calendar_bits']
+    for i, (train_uid, first_date) in enumerate(zip(
+            snapshot['train_uids'].tolist(), snapshot['calendar_first_date'].tolist())):
+        yield train_uid.decode(), first_date, bits[offsets[i]:offsets[i + 1]].tobytes()
+
+def stops_from_snapshot(snapshot: Snapshot, train_uids: list[str]) -> list[StopRow]:
+    trains = np.searchsorted(snapshot['train_uids'], np.array(train_uids, dtype='S6'))
+    stop_offsets = snapshot['stop_offsets']
+    starts = stop_offsets[trains]
+    counts = stop_offsets[trains + 1] - starts
+
+    # Index of every stop of every train, one train after another
+    stop_indices = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    locations = snapshot_locations(snapshot)
+    return [
+        (train_uids[train], route_index, locations[location],
+            None if arrival < 0 else arrival,
+            None if departure < 0 else departure)
+        for train, route_index, location, arrival, departure in zip(
+            np.repeat(np.arange(len(train_uids)), counts).tolist(),
+            snapshot['stop_route_index'][stop_indices].tolist(),
+            snapshot['stop_location'][stop_indices].tolist(),
+            snapshot['stop_arrival'][stop_indices].tolist(),
+            snapshot['stop_departure'][stop_indices].tolist())]
+
+def read_service_calendar(db: Session, snapshot: Union[Snapshot, None]) -> ServiceCalendar:
+    if not snapshot is None:
+        return service_calendar_from_rows(calendar_rows_from_snapshot(snapshot))
+    return service_calendar_from_rows(
+        db.query(TrainCalendar.train_uid, TrainCalendar.first_date, TrainCalendar.running_days).all())
+
+def load_service_calendar(db: Session) -> ServiceCalendar:
+    return timetable_cache.get(db, 'service_calendar',
+        lambda: read_service_calendar(db, load_timetable_snapshot(db)))
+
+def stops_running_on_date(db: Session, date: datetime.date) -> list[StopRow]:
+    return read_stops_for_trains(db, load_timetable_snapshot(db),
+        load_service_calendar(db).active_trains(date))
+
+def read_stops_for_trains(db: Session, snapshot: Union[Snapshot, None],
+                          active_trains: list[str]) -> list[StopRow]:
+    if not snapshot is None:
+        return stops_from_snapshot(snapshot, active_trains)
+
+    # NOTE: Active trains are sorted, so each chunk follows on from the last in train order
+    stops: list[StopRow] = []
+    for start in range(0, len(active_trains), TRAIN_UID_CHUNK_SIZE):
+        stops += db.query(
+                TimetableLocation.train_uid,
+                TimetableLocation.train_route_index,
+                TimetableLocation.location,
+                TimetableLocation.scheduled_arrival_time,
+                TimetableLocation.scheduled_departure_time)\
+            .filter(TimetableLocation.train_uid.in_(active_trains[start:start + TRAIN_UID_CHUNK_SIZE]))\
+            .order_by(TimetableLocation.train_uid, TimetableLocation.train_route_index)\
+            .all()
+    return stops
+
+def time_bucket_start(time: datetime.time) -> datetime.time:
+    minutes = time.hour*60 + time.minute
+    minutes -= minutes % config.ROUTE_CACHE_BUCKET_MINUTES
+    return datetime.time(minutes // 60, minutes % 60)
+
+def search_start_time(time: datetime.time) -> datetime.time:
+    # NOTE: Only a profile search finds every journey leaving within the bucket,
+    #       the other engines have to search from the time asked for
+    if config.ROUTING_ENGINE != 'csa':
+        return time
+    return time_bucket_start(time)
+
+def route_cache_key(db: Session, from_crs: str, to_crs: str,
+                    date: datetime.date, time: datetime.time) -> tuple[str, str, int, int, datetime.time]:
+    # NOTE: Searches can run on into the next service day
+    calendar = load_service_calendar(db)
+    pattern = calendar.service_pattern(date)
+    next_pattern = calendar.service_pattern(date + datetime.timedelta(days=1))
+    return from_crs, to_crs, pattern, next_pattern, search_start_time(time)
@@ -0,0 +1,237 @@
+import datetime
+import time
+import config
+import multiprocessing
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Union
+from knowledge_base.dtd import TransferPattern
+from reasoning_engine.raptor import NEVER, RouteTimetable, label_path, raptor_rounds
+from reasoning_engine.raptor import route_timetable_for_date, route_timetable_from_stops
+from reasoning_engine.routeing import Leg, RouteAndJourneys, SearchProgress, crs_to_tiplocs, find_journeys_from_crs
+from reasoning_engine.routeing import journeys_from_legs
+from reasoning_engine.timetable import open_timetable_snapshot, read_service_calendar, read_stops_for_trains
+from sqlalchemy.orm.session import Session
+
+# Stations changed at between two stations, in the order they're changed at
+Interchanges = tuple[int, ...]
+
+# Route, along with the positions along it a leg boards and leaves at
+LegOption = tuple[int, int, int]
+
+def hub_stations(timetable: RouteTimetable, count: int) -> list[int]:
+    # NOTE: Journeys mostly change at the busiest stations, so they make the best hubs
+    calls = [0] * len(timetable.stations)
+    for route, trip_uids in enumerate(timetable.route_trip_uids):
+        start, end = timetable.route_stop_offsets[route], timetable.route_stop_offsets[route + 1]
+        for station in timetable.route_stations[start:end]:
+            calls[station] += len(trip_uids)
+    return sorted(range(len(calls)), key=lambda station: calls[station], reverse=True)[:count]
+
+def transfer_patterns_from_station(timetable: RouteTimetable, hubs: set[int], source: int,
+                                   sample_minutes: int) -> dict[int, set[Interchanges]]:
+    def boarded_at(route: int, board: int) -> int:
+        return timetable.route_stations[timetable.route_stop_offsets[route] + board]
+
+    # NOTE: Only hubs search the whole network, everywhere else stops at the first hub
+    #       it reaches, as the rest of the journey is covered by that hub's patterns
+    stop_at = set() if source in hubs else hubs
+
+    patterns: dict[int, set[Interchanges]] = {}
+    for departure in range(0, 24*60, sample_minutes):
+        best_arrivals: dict[int, int] = {}
+        for round, round_arrivals, labels, improved in raptor_rounds(
+                timetable, [source], departure, config.RAPTOR_MAX_TRIPS, stop_at = stop_at):
+            for target in improved:
+                if target == source or round_arrivals[target] >= best_arrivals.get(target, NEVER):
+                    continue
+                best_arrivals[target] = round_arrivals[target]
+
+                interchanges = tuple([boarded_at(route, board)
+                    for route, _, board, _ in label_path(timetable, labels, round, target)[1:]])
+                patterns.setdefault(target, set()).add(interchanges)
+    return patterns
+
+# Each worker process is handed the timetable once, rather than with every station
+_worker_timetable: Union[RouteTimetable, None] = None
+_worker_hubs: set[int] = set()
+
+def open_transfer_pattern_worker(timetable: RouteTimetable, hubs: set[int]):
+    global _worker_timetable, _worker_hubs
+    _worker_timetable = timetable
+    _worker_hubs = hubs
+
+def transfer_pattern_rows_from_station(source: int) -> list[dict[str, Union[str, bool]]]:
+    assert not _worker_timetable is None
+    stations = _worker_timetable.stations
+    patterns = transfer_patterns_from_station(_worker_timetable, _worker_hubs, source,
+        config.TRANSFER_PATTERN_SAMPLE_MINUTES)
+    return [
+        dict(from_location = stations[source], to_location = stations[target],
+            interchanges = ' '.join([stations[station] for station in interchanges]),
+            from_hub = source in _worker_hubs)
+        for target, target_patterns in patterns.items()
+        for interchanges in target_patterns]
+
+def compile_transfer_patterns(db: Session, start_date: datetime.date) -> int:
+    snapshot = open_timetable_snapshot(db)
+    calendar = read_service_calendar(db, snapshot)
+
+    # NOTE: Patterns are looked up by weekday, days in the week ahead
+    #       running the same trains share one set of searches
+    dates_by_service_pattern: dict[int, list[datetime.date]] = {}
+    for day in range(7):
+        date = start_date + datetime.timedelta(days=day)
+        dates_by_service_pattern.setdefault(calendar.service_pattern(date), []).append(date)
+
+    rows: list[dict[str, Union[str, bool, int]]] = []
+    for dates in dates_by_service_pattern.values():
+        timetable = route_timetable_from_stops(read_stops_for_trains(db, snapshot, calendar.active_trains(dates[0])))
+        hubs = set(hub_stations(timetable, config.TRANSFER_PATTERN_HUB_COUNT))
+
+        # NOTE: Spawned, as this runs from the refresher, alongside its other threads
+        with ProcessPoolExecutor(config.TRANSFER_PATTERN_PROCESS_COUNT,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=open_transfer_pattern_worker,
+                initargs=(timetable, hubs)) as executor:
+            for station_rows in executor.map(transfer_pattern_rows_from_station,
+                    range(len(timetable.stations)), chunksize=16):
+                rows += [dict(row, weekday = date.weekday()) for row in station_rows for date in dates]
+
+    # Written in one go, so the database isn't held for writing while searching
+    db.query(TransferPattern).delete()
+    db.bulk_insert_mappings(TransferPattern, rows)
+    db.commit()
+    return len(rows)
+
+def candidate_routes(patterns: Iterable[tuple[str, str, str, bool]],
+                     from_location: str, to_location: str) -> list[tuple[str, ...]]:
+    patterns_from: dict[str, list[list[str]]] = {}
+    patterns_from_hubs: dict[str, list[list[str]]] = {}
+    for pattern_from, pattern_to, interchanges, from_hub in patterns:
+        if pattern_from == from_location:
+            patterns_from.setdefault(pattern_to, []).append(interchanges.split())
+        if pattern_to == to_location and from_hub:
+            patterns_from_hubs.setdefault(pattern_from, []).append(interchanges.split())
+
+    routes = [[from_location] + interchanges + [to_location]
+        for interchanges in patterns_from.get(to_location, [])]
+
+    # Otherwise change at a hub, which has patterns to everywhere
+    for hub, second_patterns in patterns_from_hubs.items():
+        if hub == from_location or not hub in patterns_from:
+            continue
+
+        for first in patterns_from[hub]:
+            for second in second_patterns:
+                route = [from_location] + first + [hub] + second + [to_location]
+                if len(set(route)) == len(route):
+                    routes.append(route)
+    return sorted(set([tuple(route) for route in routes]), key=len)
+
+def leg_options(timetable: RouteTimetable, from_station: int, to_station: int) -> list[LegOption]:
+    offsets = timetable.station_route_offsets
+    options: list[LegOption] = []
+    for route, board in timetable.station_routes[offsets[from_station]:offsets[from_station + 1]]:
+        stations = timetable.route_stations[timetable.route_stop_offsets[route]:timetable.route_stop_offsets[route + 1]]
+        if to_station in stations[board + 1:]:
+            options.append((route, board, stations.index(to_station, board + 1)))
+    return options
+
+def earliest_leg(timetable: RouteTimetable, options: list[LegOption],
+                 ready: int) -> Union[tuple[int, Leg], None]:
+    best: Union[tuple[int, Leg], None] = None
+    for route, board, alight in options:
+        departures = timetable.route_stop_departures[route][board]
+        trip = bisect_left(departures, ready)
+        if trip >= len(departures) or departures[trip] >= NEVER:
+            continue
+
+        arrival = timetable.route_arrivals[route][trip][alight]
+        if best is None or arrival < best[0]:
+            best = arrival, (timetable.route_trip_uids[route][trip], board, alight)
+    return best
+
+# Departure and arrival times of a journey, along with the legs taken
+TimedJourney = tuple[int, int, list[Leg]]
+
+def journey_legs_for_route(timetable: RouteTimetable, route: list[int]) -> list[TimedJourney]:
+    route_leg_options = [leg_options(timetable, from_station, to_station)
+        for from_station, to_station in zip(route, route[1:])]
+    if any([len(options) == 0 for options in route_leg_options]):
+        return []
+
+    # NOTE: Routes include every stop of their trains, so positions are route indices
+    journeys: list[TimedJourney] = []
+    for first_route, board, alight in route_leg_options[0]:
+        for trip, departure in enumerate(timetable.route_stop_departures[first_route][board]):
+            if departure >= NEVER:
+                continue
+
+            legs: list[Leg] = [(timetable.route_trip_uids[first_route][trip], board, alight)]
+            arrival = timetable.route_arrivals[first_route][trip][alight]
+            for options in route_leg_options[1:]:
+                leg = earliest_leg(timetable, options, arrival + config.MIN_CHANGE_MINUTES)
+
+                # Staying on the same train is already covered by a pattern without the change
+                if leg is None or leg[1][0] == legs[-1][0]:
+                    break
+
+                arrival, next_leg = leg
+                legs.append(next_leg)
+            else:
+                journeys.append((departure, arrival, legs))
+    return journeys
+
+def pareto_journeys(journeys: list[TimedJourney]) -> list[list[Leg]]:
+    # Drop journeys another leaves no earlier, arrives no later and takes no more trains than
+    journeys = sorted(journeys, key=lambda journey: (-journey[0], len(journey[2]), journey[1]))
+    best_arrivals: dict[int, int] = {}
+    kept: list[list[Leg]] = []
+    for _, arrival, legs in journeys:
+        if any([best_arrival <= arrival
+                for trip_count, best_arrival in best_arrivals.items() if trip_count <= len(legs)]):
+            continue
+
+        best_arrivals[len(legs)] = min(arrival, best_arrivals.get(len(legs), NEVER))
+        kept.append(legs)
+    return kept
+
+def find_journeys_transfer_patterns(db: Session, from_crs: str, to_crs: str,
+                                    date: datetime.date) -> list[RouteAndJourneys]:
+    from_locations, to_locations = crs_to_tiplocs(db, from_crs), crs_to_tiplocs(db, to_crs)
+    patterns = db.query(
+            TransferPattern.from_location,
+            TransferPattern.to_location,
+            TransferPattern.interchanges,
+            TransferPattern.from_hub)\
+        .filter(TransferPattern.weekday == date.weekday())\
+        .filter(TransferPattern.from_location.in_(from_locations) |
+            TransferPattern.to_location.in_(to_locations))\
+        .all()
+    if len(patterns) == 0:
+        return []
+
+    timetable = route_timetable_for_date(db, date)
+    journeys: list[TimedJourney] = []
+    for from_location in from_locations:
+        for to_location in to_locations:
+            for route in candidate_routes(patterns, from_location, to_location):
+                if all([location in timetable.station_ids for location in route]):
+                    journeys += journey_legs_for_route(timetable,
+                        [timetable.station_ids[location] for location in route])
+    return journeys_from_legs(db, pareto_journeys(journeys))
+
+def find_journeys_with_patterns(db: Session, from_crs: str, to_crs: str,
+                                date: datetime.date,
+                                progress: Union[SearchProgress, None] = None) -> list[RouteAndJourneys]:
+    if config.TRANSFER_PATTERNS:
+        start = time.perf_counter()
+        route_journeys = find_journeys_transfer_patterns(db, from_crs, to_crs, date)
+        if not progress is None:
+            progress.finish_phase('patterns', start)
+        if len(route_journeys) > 0:
+            return route_journeys
+
+    # NOTE: Patterns are built from the week they were compiled in, so fall back to searching when none of them run
+    return list(find_journeys_from_crs(db, from_crs, to_crs, date, progress))
@@ -1,10 +1,74 @@
+import os
+import time
 import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 from typing import Any
-from knowledge_base.feeds import ExpiryTimes, open_database
-from knowledge_base.kb import Incident, KBIncidents
+from zipfile import ZipFile, ZIP_DEFLATED
+import config
+from knowledge_base.dtd import FareRecord, FlowRecord, TIPLOC, TimetableLocation, TimetableLocationType, TrainTimetable
+from knowledge_base.dtd import DTDTimetableFeed, TimetableLink, TrainCalendar
+from knowledge_base.dtd import records_in_dtd_file_set, records_in_dtd_zip
+from knowledge_base.feeds import Base, ExpiryTimes, Feed, RecordSet, batch_and_flush_chunks
+from knowledge_base.feeds import connect_database, open_database, update_feed_in_shadow_database
+from knowledge_base.feeds import DeltaUpdate, update_feed_delta
+from knowledge_base.kb import Incident, IncidentAffectedOperators, KBIncidents, Station
+from knowledge_base.kb import elements_in_xml_file, records_for_stations
+from knowledge_base.progress import Progress
+from knowledge_base.refresher import FeedRefresher, RefreshState, format_refresh_status
+from sqlalchemy import create_engine
 from sqlalchemy.sql import func
-from sqlalchemy.orm.session import Session
+from sqlalchemy.orm.session import Session, sessionmaker
+
+TEST_MCA_ENTRIES = [
+    'BSNC123452201012212311111100N',
+    'BX         SEY123456',
+    'LOBRGHTN  0900 09001  ',
+    'LIHOVE    0905 0906      09050906',
+    'LTPRSTNPK 0910 09101',
+    'TIBRGHTN00000000000000000000000000000000000000000000BTNBRIGHTON',
+]
+
+TEST_FFL_ENTRIES = [
+    'RFAAAABBBB         R3112299901012020TOC   0000001',
+    'RFAAAACCCC         R0101200001012000TOC   0000002',
+    'RT0000001SDS00001000',
+    'RT0000002SDS00002000',
+]
+
+def incident_xml(incident_number: str, summary: str, operators: list[str]) -> str:
+    return (
+        '<PtIncident>'
+        '<CreationTime>2022-01-01T10:00:00.000Z</CreationTime>'
+        f'<IncidentNumber>{ incident_number }</IncidentNumber>'
+        '<Planned>false</Planned>'
+        f'<Summary>{ summary }</Summary>'
+        '<Description>Some description</Description>'
+        '<ClearedIncident>false</ClearedIncident>'
+        '<Affects><Operators>' +
+        ''.join([
+            f'<AffectedOperator><OperatorRef>{ toc }</OperatorRef><OperatorName>{ toc } Trains</OperatorName></AffectedOperator>'
+            for toc in operators]) +
+        '</Operators><RoutesAffected>Brighton to Hove</RoutesAffected></Affects>'
+        '</PtIncident>')
+
+def mca_entries_for_train(train_uid: str) -> list[str]:
+    return [entry.replace('C12345', train_uid)
+        for entry in TEST_MCA_ENTRIES
+        if not entry.startswith('TI')]
+
+def collect_records(tasks_for_queue) -> dict[Any, list[tuple]]:
+    records: dict[Any, list[tuple]] = {}
+    chunk_queue: Queue[RecordSet] = Queue()
+    with ThreadPoolExecutor() as executor, open(os.devnull, 'w') as devnull:
+        for task in tasks_for_queue(executor, chunk_queue, Progress(devnull)):
+            task.result()
+
+    while not chunk_queue.empty():
+        for table, batch in chunk_queue.get().items():
+            records.setdefault(table, []).extend(batch.rows())
+    return records
 
 class KnowladgeBase(unittest.TestCase):
     
@@ -42,3 +106,257 @@ class KnowladgeBase(unittest.TestCase):
             self.assert_incidents_valid(db)
             db.close()
 
+
+    def test_stream_dtd_zip(self):
+        path = tempfile.mkdtemp()
+        zip_file_path = os.path.join(path, 'TIMETABLE.ZIP')
+        with ZipFile(zip_file_path, 'w', ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('RJTTF123.MCA', '\n'.join(TEST_MCA_ENTRIES * 100))
+            zip_file.writestr('RJTTF123.ZTR', 'Not a parsed file')
+
+        streamed = collect_records(lambda executor, chunk_queue, progress:
+            records_in_dtd_zip(executor, chunk_queue, zip_file_path, progress))
+        self.assertEqual(len(streamed[TrainTimetable]), 1)
+        self.assertEqual(len(streamed[TimetableLocation]), 3)
+        self.assertEqual(len(streamed[TIPLOC]), 100)
+
+        # Runs Monday to Friday through 2022, which started on a Saturday
+        (train_uid, first_date, running_days), = streamed[TrainCalendar]
+        self.assertEqual((train_uid, first_date), ('C12345', 20220101))
+        self.assertEqual(len(running_days), 46)
+        self.assertEqual(running_days[:2], bytes([0b01111100, 0b00111110]))
+        self.assertEqual(os.listdir(path), ['TIMETABLE.ZIP'])
+
+        with ZipFile(zip_file_path, 'r') as zip_file:
+            zip_file.extractall(path)
+        os.remove(zip_file_path)
+
+        extracted = collect_records(lambda executor, chunk_queue, progress:
+            records_in_dtd_file_set(executor, chunk_queue, path, progress))
+        self.assertEqual(streamed, extracted)
+
+    def test_parallel_dtd_parse(self):
+        path = tempfile.mkdtemp()
+        with open(os.path.join(path, 'RJTTF123.MCA'), 'w') as f:
+            for train_uid in ['C00001', 'C00002', 'C00003', 'C00002', 'C00004', 'C00001']:
+                f.write('\n'.join(mca_entries_for_train(train_uid)) + '\n')
+        with open(os.path.join(path, 'RJFAF123.FFL'), 'w') as f:
+            f.write('\n'.join(TEST_FFL_ENTRIES) + '\n')
+
+        def parse_records(parallel: bool):
+            old_parallel, old_block_size = config.PARALLEL_DTD_PARSE, config.DTD_PARSE_BLOCK_SIZE
+            config.PARALLEL_DTD_PARSE, config.DTD_PARSE_BLOCK_SIZE = parallel, 64
+            try:
+                return collect_records(lambda executor, chunk_queue, progress:
+                    records_in_dtd_file_set(executor, chunk_queue, path, progress))
+            finally:
+                config.PARALLEL_DTD_PARSE, config.DTD_PARSE_BLOCK_SIZE = old_parallel, old_block_size
+
+        serial = parse_records(False)
+        parallel = parse_records(True)
+        self.assertEqual(len(serial[TrainTimetable]), 4)
+        self.assertEqual(len(serial[FlowRecord]), 1)
+        self.assertEqual(len(serial[FareRecord]), 1)
+        self.assertEqual(sorted(serial[TimetableLink]), [
+            ('BRGHTN', 'HOVE', 4, 5),
+            ('HOVE', 'PRSTNPK', 4, 4),
+        ])
+        for table in serial.keys():
+            self.assertEqual(sorted(parallel[table]), sorted(serial[table]))
+
+    def test_flush_record_batches(self):
+        path = tempfile.mkdtemp()
+        with open(os.path.join(path, 'RJTTF123.MCA'), 'w') as f:
+            for train_uid in ['C00001', 'C00002', 'C00003']:
+                f.write('\n'.join(mca_entries_for_train(train_uid)) + '\n')
+
+        chunk_queue: Queue[RecordSet] = Queue()
+        with ThreadPoolExecutor() as executor, open(os.devnull, 'w') as devnull:
+            progress = Progress(devnull)
+            for task in records_in_dtd_file_set(executor, chunk_queue, path, progress):
+                task.result()
+            chunk_queue.put(None)
+
+            engine = create_engine('sqlite://')
+            Base.metadata.create_all(engine)
+            db = sessionmaker(bind = engine)()
+            batch_and_flush_chunks(db, chunk_queue, progress)
+
+        self.assertEqual(db.query(TrainTimetable).count(), 3)
+        stops = db.query(TimetableLocation)\
+            .filter(TimetableLocation.train_uid == 'C00002')\
+            .order_by(TimetableLocation.train_route_index)\
+            .all()
+        self.assertEqual([stop.location for stop in stops], ['BRGHTN', 'HOVE', 'PRSTNPK'])
+        self.assertEqual(stops[1].public_departure.hour, 9)
+        self.assertEqual(stops[1].public_departure.minute, 6)
+        self.assertEqual(stops[1].scheduled_departure_time, 906)
+        self.assertEqual(stops[2].location_type, TimetableLocationType.Terminating)
+
+    def test_shadow_feed_swap(self):
+        path = tempfile.mkdtemp()
+        storage_path = os.path.join(path, 'storage')
+        os.makedirs(storage_path)
+
+        def store_timetable(train_uids: list[str]):
+            with ZipFile(os.path.join(storage_path, 'TIMETABLE.ZIP'), 'w') as zip_file:
+                zip_file.writestr('RJTTF123.MCA', '\n'.join(
+                    [TEST_MCA_ENTRIES[-1]] +
+                    [entry for train_uid in train_uids for entry in mca_entries_for_train(train_uid)]))
+
+        old_config = config.DATABASE_FILE, config.DISABLE_DOWNLOAD, config.LOCAL_FEED_STORAGE_BASE
+        config.DATABASE_FILE = os.path.join(path, 'dtd.db')
+        config.DISABLE_DOWNLOAD = True
+        config.LOCAL_FEED_STORAGE_BASE = storage_path
+        try:
+            db = connect_database()
+            reader = connect_database()
+            self.assertEqual(reader.query(TrainTimetable).count(), 0)
+
+            store_timetable(['C00001', 'C00002', 'C00003'])
+            with ThreadPoolExecutor() as executor, open(os.devnull, 'w') as devnull:
+                update_feed_in_shadow_database(db, executor, DTDTimetableFeed(), devnull)
+
+            # An open snapshot is kept until the reader lets go of it
+            self.assertEqual(reader.query(TrainTimetable).count(), 0)
+            reader.commit()
+            self.assertEqual(reader.query(TrainTimetable).count(), 3)
+            self.assertEqual(reader.query(TimetableLink).count(), 2)
+
+            store_timetable(['C00001'])
+            with ThreadPoolExecutor() as executor, open(os.devnull, 'w') as devnull:
+                with self.assertRaises(Exception):
+                    update_feed_in_shadow_database(db, executor, DTDTimetableFeed(), devnull)
+
+            reader.commit()
+            self.assertEqual(reader.query(TrainTimetable).count(), 3)
+            self.assertFalse(os.path.exists(DTDTimetableFeed().database_file() + '.shadow'))
+        finally:
+            config.DATABASE_FILE, config.DISABLE_DOWNLOAD, config.LOCAL_FEED_STORAGE_BASE = old_config
+
+    def test_concurrent_connect_database(self):
+        path = tempfile.mkdtemp()
+        old_database_file = config.DATABASE_FILE
+        config.DATABASE_FILE = os.path.join(path, 'dtd.db')
+        try:
+            def connect_and_count(_) -> int:
+                db = connect_database()
+                count = db.query(TrainTimetable).count()
+                db.close()
+                return count
+
+            # Refresher threads all connect at once on startup
+            with ThreadPoolExecutor(8) as executor:
+                self.assertEqual(list(executor.map(connect_and_count, range(8))), [0] * 8)
+            self.assertTrue(all([os.path.exists(feed.database_file()) for feed in Feed.feeds()]))
+        finally:
+            config.DATABASE_FILE = old_database_file
+
+    def test_background_feed_refresh(self):
+        path = tempfile.mkdtemp()
+        storage_path = os.path.join(path, 'storage')
+        os.makedirs(storage_path)
+        with ZipFile(os.path.join(storage_path, 'TIMETABLE.ZIP'), 'w') as zip_file:
+            zip_file.writestr('RJTTF123.MCA', '\n'.join(TEST_MCA_ENTRIES))
+
+        old_config = config.DATABASE_FILE, config.DISABLE_DOWNLOAD, config.LOCAL_FEED_STORAGE_BASE
+        config.DATABASE_FILE = os.path.join(path, 'dtd.db')
+        config.DISABLE_DOWNLOAD = True
+        config.LOCAL_FEED_STORAGE_BASE = storage_path
+        try:
+            db = connect_database()
+            timetable_url = DTDTimetableFeed().feed_api_url()
+            incidents_url = KBIncidents().feed_api_url()
+
+            # NOTE: There's no stored incidents feed, so it fails alongside the timetable
+            with open(os.devnull, 'w') as devnull, \
+                 FeedRefresher([DTDTimetableFeed(), KBIncidents()], devnull) as refresher:
+                deadline = time.time() + 30
+                while refresher.status()[timetable_url].refresh_count == 0 and time.time() < deadline:
+                    time.sleep(0.05)
+                status = refresher.status()
+
+            self.assertEqual(status[timetable_url].refresh_count, 1)
+            self.assertEqual(status[timetable_url].state, RefreshState.Waiting)
+            self.assertIsNotNone(status[timetable_url].last_refresh_duration)
+            self.assertGreater(status[timetable_url].next_refresh, time.time() + 60 * 60)
+            self.assertEqual(status[incidents_url].refresh_count, 0)
+            self.assertIn(incidents_url, format_refresh_status(status))
+
+            db.commit()
+            self.assertEqual(db.query(TrainTimetable).count(), 1)
+        finally:
+            config.DATABASE_FILE, config.DISABLE_DOWNLOAD, config.LOCAL_FEED_STORAGE_BASE = old_config
+
+    def test_incidents_delta_update(self):
+        path = tempfile.mkdtemp()
+        storage_path = os.path.join(path, 'storage')
+        os.makedirs(storage_path)
+
+        def store_incidents(incidents: list[str]):
+            with open(os.path.join(storage_path, 'INCIDENTS.XML'), 'w') as f:
+                f.write('<Incidents xmlns="http://nationalrail.co.uk/xml/incident">')
+                f.write(''.join(incidents))
+                f.write('</Incidents>')
+
+        def update_incidents(db: Session) -> DeltaUpdate:
+            with ThreadPoolExecutor() as executor, open(os.devnull, 'w') as devnull:
+                return update_feed_delta(db, executor, KBIncidents(), devnull)
+
+        old_config = config.DATABASE_FILE, config.DISABLE_DOWNLOAD, config.LOCAL_FEED_STORAGE_BASE
+        config.DATABASE_FILE = os.path.join(path, 'incidents.db')
+        config.DISABLE_DOWNLOAD = True
+        config.LOCAL_FEED_STORAGE_BASE = storage_path
+        try:
+            db = connect_database()
+            store_incidents([
+                incident_xml('A1', 'Signal failure', ['SN', 'GX']),
+                incident_xml('A2', 'Flooding', ['SN']),
+            ])
+            self.assertEqual(update_incidents(db), DeltaUpdate(inserted = 2))
+            self.assertEqual(update_incidents(db), DeltaUpdate())
+
+            store_incidents([
+                incident_xml('A1', 'Signal failure', ['SN']),
+                incident_xml('A3', 'Strike', ['GX']),
+            ])
+            self.assertEqual(update_incidents(db), DeltaUpdate(inserted = 1, updated = 1, deleted = 1))
+
+            incidents = db.query(Incident).order_by(Incident.incident_number).all()
+            self.assertEqual([incident.incident_number for incident in incidents], ['A1', 'A3'])
+            self.assertEqual(incidents[0].creation_time.hour, 10)
+            self.assertFalse(incidents[0].planned)
+            operators = db.query(IncidentAffectedOperators)\
+                .order_by(IncidentAffectedOperators.incident_number)\
+                .all()
+            self.assertEqual([(operator.incident_number, operator.operator_toc) for operator in operators],
+                [('A1', 'SN'), ('A3', 'GX')])
+        finally:
+            config.DATABASE_FILE, config.DISABLE_DOWNLOAD, config.LOCAL_FEED_STORAGE_BASE = old_config
+
+    def test_stream_stations_xml(self):
+        file_path = os.path.join(tempfile.mkdtemp(), 'STATIONS.XML')
+        with open(file_path, 'w') as f:
+            f.write('<StationList xmlns="http://nationalrail.co.uk/xml/station">')
+            for i in range(100):
+                f.write(
+                    '<Station>'
+                    f'<CrsCode>S{ i:02}</CrsCode><Name>Station { i }</Name>'
+                    '<Latitude>50.8</Latitude><Longitude>-0.1</Longitude>'
+                    '</Station>')
+            f.write('</StationList>')
+
+        with open(os.devnull, 'w') as devnull:
+            progress = Progress(devnull)
+
+            child_counts = [len(station) for station in elements_in_xml_file(file_path, 'Stations', progress)]
+            self.assertEqual(child_counts, [4] * 100)
+
+            chunk_queue: Queue[RecordSet] = Queue()
+            records_for_stations(file_path, chunk_queue, progress)
+
+        stations = chunk_queue.get()[Station]
+        self.assertTrue(chunk_queue.empty())
+        self.assertEqual(len(stations), 100)
+        self.assertEqual(stations.column('crs_code')[:2], ['S00', 'S01'])
+        self.assertEqual(stations.column('name')[99], 'Station 99')
@@ -1,8 +1,104 @@
+import os
+import json
 import datetime
+import tempfile
 import unittest
+import config
+from typing import Union
 from reasoning_engine.tickets import ticket_prices
-from reasoning_engine.routeing import filter_best_journeys, find_journeys_from_crs
-from knowledge_base.feeds import open_database
+from reasoning_engine.routeing import Path, RouteAndJourneys, filter_best_journeys, find_journeys_from_crs, search_paths
+from reasoning_engine.routeing import SearchProgress, record_search_progress, search_paths_and_expansions
+from reasoning_engine.batch import BatchLeg, route_batch
+from reasoning_engine.journeys import find_journeys
+from reasoning_engine.departures import Departure, departure_index_for_date, departure_index_from_stops
+from reasoning_engine.station_graph import load_station_graph
+from reasoning_engine.stop_batch import stop_batch_at_locations, stop_batch_from_rows, trains_visiting_in_order
+from reasoning_engine.csa import connection_timetable_from_stops, find_journeys_csa, find_journeys_csa_profile
+from reasoning_engine.raptor import find_journeys_raptor, route_timetable_from_stops
+from reasoning_engine.transfer_patterns import compile_transfer_patterns, find_journeys_transfer_patterns
+from reasoning_engine.timetable import TimetableCache, load_service_calendar, route_cache, route_cache_key
+from reasoning_engine.timetable import load_timetable_snapshot, stops_running_on_date, timetable_cache
+from knowledge_base.dtd import TIPLOC, TimetableLink, TimetableLocation, TimetableLocationType, TrainTimetable
+from knowledge_base.dtd import DTDTimetableFeed, TrainCalendar, compile_timetable_snapshot, running_days_bitmap
+from knowledge_base.dtd import TransferPattern
+from knowledge_base.feeds import Base, ExpiryTimes, open_database
+from knowledge_base.kb import KBStations, Station
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm.session import Session, sessionmaker
+
+TEST_DATE = datetime.date(2022, 1, 4)
+
+TEST_TIPLOCS = {
+    'BRGHTN': 'BTN',
+    'HOVE': 'HOV',
+    'PRSTNPK': 'PRP',
+    'SHRHMBS': 'SSE',
+    'WRTHING': 'WRH',
+}
+
+TEST_STATION_POSITIONS = {
+    'BTN': (50.8290, -0.1410),
+    'HOV': (50.8353, -0.1713),
+    'PRP': (50.8459, -0.1553),
+    'SSE': (50.8345, -0.2716),
+    'WRH': (50.8183, -0.3756),
+}
+
+TEST_TRAINS = {
+    'C00001': [('BRGHTN', None, 900), ('HOVE', 905, 906), ('PRSTNPK', 910, None)],
+    'C00002': [('PRSTNPK', None, 915), ('SHRHMBS', 930, None)],
+    'C00003': [('BRGHTN', None, 920), ('SHRHMBS', 940, None)],
+    'C00004': [('HOVE', None, 908), ('WRTHING', 920, None)],
+}
+
+def sql_time_to_time(time: Union[int, None]) -> Union[datetime.time, None]:
+    return None if time is None else datetime.time(time // 100, time % 100)
+
+def add_test_train(db: Session, train_uid: str, stops: list[tuple[str, Union[int, None], Union[int, None]]]):
+    train = dict(
+        train_uid = train_uid,
+        date_runs_from = 20220101, date_runs_to = 20221231,
+        monday = True, tuesday = True, wednesday = True, thursday = True,
+        friday = True, saturday = True, sunday = True,
+        bank_holiday_running = False, toc = 'SN')
+    db.add(TrainTimetable(**train))
+    db.add(TrainCalendar(train_uid = train_uid, first_date = train['date_runs_from'],
+        running_days = running_days_bitmap(train, train['date_runs_to'])))
+
+    for i, (location, arrival, departure) in enumerate(stops):
+        location_type = TimetableLocationType.Intermediate
+        if i == 0:
+            location_type = TimetableLocationType.Origin
+        elif i == len(stops) - 1:
+            location_type = TimetableLocationType.Terminating
+
+        db.add(TimetableLocation(
+            train_uid = train_uid, train_route_index = i,
+            location_type = location_type, location = location,
+            scheduled_arrival_time = arrival, scheduled_departure_time = departure,
+            public_arrival = sql_time_to_time(arrival),
+            public_departure = sql_time_to_time(departure)))
+
+def open_test_timetable(database_file: str = '') -> Session:
+    engine = create_engine('sqlite://' + ('' if database_file == '' else '/' + database_file))
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind = engine)()
+    timetable_cache.clear()
+    for tiploc, crs in TEST_TIPLOCS.items():
+        db.add(TIPLOC(tiploc_code = tiploc, crs_code = crs))
+    for train_uid, stops in TEST_TRAINS.items():
+        add_test_train(db, train_uid, stops)
+    for from_location, to_location in sorted({ (from_stop[0], to_stop[0])
+            for stops in TEST_TRAINS.values() for from_stop, to_stop in zip(stops, stops[1:]) }):
+        db.add(TimetableLink(from_location = from_location, to_location = to_location))
+    db.commit()
+    return db
+
+def record_statements(db: Session) -> list[str]:
+    statements: list[str] = []
+    event.listen(db.get_bind(), 'before_cursor_execute',
+        lambda _connection, _cursor, statement, *_: statements.append(statement))
+    return statements
 
 class ReasoningEngine(unittest.TestCase):
     
@@ -18,3 +114,456 @@ class ReasoningEngine(unittest.TestCase):
         best_route_journeys = list(filter_best_journeys(route_journeys))
         self.assertGreater(len(best_route_journeys), 0)
 
+    def test_connection_scan(self):
+        db = open_test_timetable()
+        route_journeys = find_journeys_csa(db, 'BTN', 'SSE', TEST_DATE, datetime.time(8, 50))
+        journeys = [journey for _, journeys in route_journeys for journey in journeys]
+        self.assertEqual(len(journeys), 2)
+
+        change, direct = journeys
+        self.assertEqual([segment.train.train_uid for segment in change], ['C00001', 'C00002'])
+        self.assertEqual([(segment.start.location, segment.end.location) for segment in change],
+            [('BRGHTN', 'PRSTNPK'), ('PRSTNPK', 'SHRHMBS')])
+        self.assertEqual(change[-1].end.public_arrival, datetime.time(9, 30))
+        self.assertEqual([segment.train.train_uid for segment in direct], ['C00003'])
+
+        route, _ = route_journeys[0]
+        self.assertEqual(route[0].path, ('BRGHTN', 'HOVE', 'PRSTNPK'))
+
+        late_journeys = find_journeys_csa(db, 'BTN', 'SSE', TEST_DATE, datetime.time(9, 30))
+        self.assertEqual(late_journeys, [])
+
+    def test_connections_past_midnight(self):
+        timetable = connection_timetable_from_stops([
+            ('C00001', 0, 'BRGHTN', None, 2350),
+            ('C00001', 1, 'HOVE', 2358, 5),
+            ('C00001', 2, 'PRSTNPK', 10, None),
+        ])
+        self.assertEqual(timetable.departure_time, [23*60 + 50, 24*60 + 5])
+        self.assertEqual(timetable.arrival_time, [23*60 + 58, 24*60 + 10])
+
+    def test_raptor_pareto_journeys(self):
+        db = open_test_timetable()
+        route_journeys = find_journeys_raptor(db, 'BTN', 'SSE', TEST_DATE, datetime.time(8, 50))
+        journeys = [journey for _, journeys in route_journeys for journey in journeys]
+
+        # The direct train arrives later, but doesn't need a change
+        self.assertEqual([[segment.train.train_uid for segment in journey] for journey in journeys],
+            [['C00003'], ['C00001', 'C00002']])
+        self.assertEqual(journeys[1][0].end.location, 'PRSTNPK')
+        self.assertEqual(journeys[1][-1].end.public_arrival, datetime.time(9, 30))
+
+        journeys = find_journeys_raptor(db, 'HOV', 'WRH', TEST_DATE, datetime.time(9, 0))
+        self.assertEqual(len(journeys), 1)
+        self.assertEqual(find_journeys_raptor(db, 'WRH', 'BTN', TEST_DATE, datetime.time(9, 0)), [])
+
+    def test_raptor_splits_overtaking_trips(self):
+        timetable = route_timetable_from_stops([
+            ('C00001', 0, 'BRGHTN', None, 900),
+            ('C00001', 1, 'HOVE', 930, None),
+            ('C00002', 0, 'BRGHTN', None, 905),
+            ('C00002', 1, 'HOVE', 915, None),
+            ('C00003', 0, 'BRGHTN', None, 1000),
+            ('C00003', 1, 'HOVE', 1010, None),
+        ])
+        self.assertEqual(timetable.route_trip_uids, [['C00001', 'C00003'], ['C00002']])
+        self.assertEqual(timetable.route_stop_departures[0][0], [9*60, 10*60])
+
+    def test_station_graph(self):
+        db = open_test_timetable()
+        graph = load_station_graph(db)
+        self.assertEqual(sorted(graph.links_from(['HOVE', 'UNKNOWN'])),
+            [('HOVE', 'PRSTNPK'), ('HOVE', 'WRTHING')])
+        self.assertEqual(len(graph.targets), 5)
+
+        paths = search_paths(db, 2, 'BRGHTN', 'SHRHMBS')
+        routes = [route for path in paths for route in path.routes()]
+        self.assertEqual(routes, [['SHRHMBS', 'BRGHTN'], ['SHRHMBS', 'PRSTNPK', 'HOVE', 'BRGHTN']])
+
+        route_journeys = list(filter_best_journeys(find_journeys_from_crs(db, 'BTN', 'SSE', TEST_DATE)))
+        self.assertGreater(len(route_journeys), 0)
+
+    def test_path_shares_history(self):
+        stations = ['A', 'B', 'C', 'D']
+        start = Path(stations).extend(0)
+        via_b = start.extend(1)
+        via_c = start.extend(2)
+        both = via_b.merge(via_c).extend(3)
+
+        self.assertTrue(both.has_been_to(1))
+        self.assertFalse(start.has_been_to(3))
+        self.assertEqual(both.all_locations(), { 'A', 'B', 'C', 'D' })
+        self.assertEqual(both.possible_paths_count(), 2)
+        self.assertEqual(list(both.routes()), [['D', 'B', 'A'], ['D', 'C', 'A']])
+
+        wider = both.merge(Path(stations).extend(0).extend(3))
+        self.assertEqual(wider.possible_paths_count(), len(list(wider.routes())))
+
+    def test_service_calendar(self):
+        db = open_test_timetable()
+        tuesdays_only = dict(train_uid = 'C00005', date_runs_from = 20220103, date_runs_to = 20220131,
+            monday = False, tuesday = True, wednesday = False, thursday = False,
+            friday = False, saturday = False, sunday = False)
+        db.add(TrainTimetable(**tuesdays_only))
+        db.add(TrainCalendar(train_uid = 'C00005', first_date = 20220103,
+            running_days = running_days_bitmap(tuesdays_only, 20221231)))
+        add_test_train(db, 'C00006', [('HOVE', None, 1000), ('BRGHTN', 1005, None)])
+        db.commit()
+
+        calendar = load_service_calendar(db)
+        self.assertTrue(calendar.runs_on('C00005', TEST_DATE))
+        self.assertFalse(calendar.runs_on('C00005', TEST_DATE + datetime.timedelta(days=1)))
+        self.assertFalse(calendar.runs_on('C00005', datetime.date(2022, 2, 1)))
+        self.assertFalse(calendar.runs_on('C00005', datetime.date(2021, 12, 28)))
+        self.assertFalse(calendar.runs_on('UNKNOWN', TEST_DATE))
+
+        self.assertEqual(calendar.active_trains(TEST_DATE),
+            ['C00001', 'C00002', 'C00003', 'C00004', 'C00005', 'C00006'])
+        self.assertEqual(calendar.active_trains(datetime.date(2022, 1, 5)),
+            ['C00001', 'C00002', 'C00003', 'C00004', 'C00006'])
+        self.assertEqual(calendar.active_trains(datetime.date(2023, 1, 1)), [])
+
+        stops = stops_running_on_date(db, datetime.date(2022, 1, 5))
+        self.assertEqual([stop[:2] for stop in stops[-2:]], [('C00006', 0), ('C00006', 1)])
+        self.assertEqual(len(stops), 11)
+
+    def test_route_cache(self):
+        db = open_test_timetable()
+        key = route_cache_key(db, 'BTN', 'SSE', TEST_DATE, datetime.time(8, 50))
+        self.assertEqual(key, route_cache_key(db, 'BTN', 'SSE', TEST_DATE + datetime.timedelta(days=1), datetime.time(8, 45)))
+        self.assertNotEqual(key, route_cache_key(db, 'BTN', 'SSE', TEST_DATE, datetime.time(9, 0)))
+        self.assertNotEqual(key, route_cache_key(db, 'BTN', 'SSE', datetime.date(2023, 1, 1), datetime.time(8, 50)))
+
+        builds = []
+        def build(value: str) -> str:
+            builds.append(value)
+            return value
+
+        cache = TimetableCache(2)
+        self.assertEqual(cache.get(db, key, lambda: build('first')), 'first')
+        self.assertEqual(cache.get(db, key, lambda: build('second')), 'first')
+        cache.get(db, 'other', lambda: build('other'))
+        cache.get(db, key, lambda: build('unused'))
+        cache.get(db, 'evicts other', lambda: build('evicts other'))
+        cache.get(db, 'other', lambda: build('other again'))
+        self.assertEqual(builds, ['first', 'other', 'evicts other', 'other again'])
+
+        stats = cache.stats()
+        self.assertEqual((stats.entries, stats.hits, stats.misses), (2, 2, 4))
+
+        # A refreshed timetable throws away everything built from the old one
+        db.add(ExpiryTimes(api_url = DTDTimetableFeed().feed_api_url(), expiry_timestamp = 1))
+        db.commit()
+        self.assertEqual(cache.get(db, key, lambda: build('refreshed')), 'refreshed')
+        self.assertEqual(cache.stats().entries, 1)
+
+    def test_find_journeys_within_time_bucket(self):
+        db = open_test_timetable()
+        add_test_train(db, 'C00009', [('BRGHTN', None, 930), ('PRSTNPK', 940, None)])
+        db.commit()
+
+        old_engine = config.ROUTING_ENGINE
+        try:
+            for engine in ['csa', 'raptor', 'paths']:
+                config.ROUTING_ENGINE = engine
+                route_cache.clear()
+
+                # The 09:00 train has gone, even though it's in the same time bucket
+                route_journeys = find_journeys(db, 'BTN', 'PRP', TEST_DATE, datetime.time(9, 5))
+                self.assertEqual([[segment.train.train_uid for segment in journey] for _, journey in route_journeys],
+                    [['C00009']], engine)
+
+                # Tomorrow's trains are only offered once today's have all gone
+                route_journeys = find_journeys(db, 'BTN', 'PRP', TEST_DATE, datetime.time(9, 35))
+                self.assertGreater(len(route_journeys), 0, engine)
+                self.assertTrue(all([journey[0].start.public_departure < datetime.time(9, 35)
+                    for _, journey in route_journeys]), engine)
+        finally:
+            config.ROUTING_ENGINE = old_engine
+
+    def test_find_journeys_cached_from_another_date(self):
+        db = open_test_timetable()
+        add_test_train(db, 'C00009', [('BRGHTN', None, 930), ('PRSTNPK', 940, None)])
+        db.commit()
+
+        old_engine = config.ROUTING_ENGINE
+        config.ROUTING_ENGINE = 'csa'
+        try:
+            route_cache.clear()
+            find_journeys(db, 'BTN', 'PRP', TEST_DATE, datetime.time(9, 0))
+
+            # Every day runs the same trains, so this is found in the cache
+            # but the 09:00 train has still gone by the next day's query
+            route_journeys = find_journeys(db, 'BTN', 'PRP', TEST_DATE + datetime.timedelta(days=1), datetime.time(9, 5))
+            self.assertEqual(route_cache.stats().hits, 1)
+            self.assertEqual([[segment.train.train_uid for segment in journey] for _, journey in route_journeys],
+                [['C00009']])
+        finally:
+            config.ROUTING_ENGINE = old_engine
+
+    def test_path_journeys_fetch_trains_once(self):
+        db = open_test_timetable()
+        statements = record_statements(db)
+        route_journeys = find_journeys_from_crs(db, 'BTN', 'SSE', TEST_DATE)
+
+        journeys = [journey for _, journeys in route_journeys for journey in journeys]
+        self.assertEqual([[segment.train.train_uid for segment in journey] for journey in journeys],
+            [['C00003'], ['C00001', 'C00002']])
+        for journey in journeys:
+            for segment in journey:
+                self.assertEqual(segment.train.train_uid, segment.start.train_uid)
+
+        train_queries = [statement for statement in statements if 'FROM train_timetable' in statement]
+        self.assertEqual(len(train_queries), 1)
+
+    def test_trains_visiting_in_order(self):
+        batch = stop_batch_from_rows([
+            ('C00002', 1, 'HOVE', 1005, None),
+            ('C00001', 2, 'PRSTNPK', 910, None),
+            ('C00001', 0, 'BRGHTN', None, 900),
+            ('C00001', 1, 'HOVE', 905, 906),
+            ('C00002', 0, 'BRGHTN', None, 1000),
+            ('C00003', 0, 'PRSTNPK', None, 1100),
+            ('C00003', 1, 'BRGHTN', 1110, None),
+            ('C00004', 0, 'WRTHING', None, 1200),
+            ('C00004', 1, 'HOVE', 1210, None),
+        ])
+
+        trains_by_path = trains_visiting_in_order(batch, ['PRSTNPK', 'HOVE', 'BRGHTN'])
+        self.assertEqual(list(trains_by_path.keys()), [('HOVE', 'BRGHTN'), ('PRSTNPK', 'HOVE', 'BRGHTN')])
+        stops = trains_by_path[('PRSTNPK', 'HOVE', 'BRGHTN')][0]
+        self.assertEqual([(stop.train_uid, stop.train_route_index) for stop in stops],
+            [('C00001', 2), ('C00001', 1), ('C00001', 0)])
+        self.assertEqual((stops[-1].scheduled_arrival_time, stops[-1].scheduled_departure_time), (None, 900))
+        self.assertEqual(trains_visiting_in_order(batch, ['SHRHMBS']), {})
+
+        at_locations = stop_batch_at_locations(batch, ['HOVE', 'SHRHMBS'])
+        self.assertEqual(sorted(at_locations.train_uids[train] for train in at_locations.train), ['C00001', 'C00002', 'C00004'])
+        self.assertEqual(list(trains_visiting_in_order(at_locations, ['PRSTNPK', 'HOVE', 'BRGHTN']).keys()), [])
+
+    def test_looping_train(self):
+        db = open_test_timetable()
+        stops = [('WRTHING', None, 1000), ('SHRHMBS', 1010, 1011), ('HOVE', 1020, 1021), ('SHRHMBS', 1030, 1031), ('BRGHTN', 1040, None)]
+        add_test_train(db, 'C00010', stops)
+        for from_location, to_location in [('WRTHING', 'SHRHMBS'), ('SHRHMBS', 'HOVE'), ('HOVE', 'SHRHMBS'), ('SHRHMBS', 'BRGHTN')]:
+            db.add(TimetableLink(from_location = from_location, to_location = to_location))
+        db.commit()
+
+        def legs(route_journeys: list[RouteAndJourneys]) -> list[list[tuple[str, str, str, datetime.time, datetime.time]]]:
+            return sorted([[(segment.train.train_uid, segment.start.location, segment.end.location,
+                    segment.start.public_departure, segment.end.public_arrival) for segment in journey]
+                for _, journeys in filter_best_journeys(route_journeys) for journey in journeys])
+
+        # Ridden through the loop, boarded at the later call and left at the earlier one
+        for find_journeys_for_date in [
+                lambda from_crs, to_crs: find_journeys_from_crs(db, from_crs, to_crs, TEST_DATE),
+                lambda from_crs, to_crs: find_journeys_raptor(db, from_crs, to_crs, TEST_DATE, datetime.time(9, 50))]:
+            self.assertEqual(legs(find_journeys_for_date('WRH', 'BTN')),
+                [[('C00010', 'WRTHING', 'BRGHTN', datetime.time(10, 0), datetime.time(10, 40))]])
+            self.assertEqual(legs(find_journeys_for_date('SSE', 'BTN')),
+                [[('C00010', 'SHRHMBS', 'BRGHTN', datetime.time(10, 31), datetime.time(10, 40))]])
+            self.assertEqual(legs(find_journeys_for_date('WRH', 'SSE')),
+                [[('C00010', 'WRTHING', 'SHRHMBS', datetime.time(10, 0), datetime.time(10, 10))]])
+            self.assertEqual(legs(find_journeys_for_date('WRH', 'HOV')),
+                [[('C00010', 'WRTHING', 'HOVE', datetime.time(10, 0), datetime.time(10, 20))]])
+
+    def test_departure_index(self):
+        db = open_test_timetable()
+        departures = departure_index_for_date(db, TEST_DATE)
+        self.assertEqual(departures.next_departures('BRGHTN', 9*60, 5),
+            [Departure(9*60, 'C00001', 0), Departure(9*60 + 20, 'C00003', 0)])
+        self.assertEqual(departures.next_departures('BRGHTN', 9*60 + 1, 1), [Departure(9*60 + 20, 'C00003', 0)])
+        self.assertEqual(list(departures.departures_between('HOVE', 9*60, 9*60 + 7)), [Departure(9*60 + 6, 'C00001', 1)])
+        self.assertEqual(departures.next_departures('SHRHMBS', 0, 5), [])
+        self.assertEqual(departures.next_departures('UNKNOWN', 0, 5), [])
+
+        late = departure_index_from_stops([
+            ('C00001', 0, 'BRGHTN', None, 2350),
+            ('C00001', 1, 'HOVE', 2358, 5),
+            ('C00001', 2, 'PRSTNPK', 10, None),
+        ])
+        self.assertEqual(late.next_departures('HOVE', 23*60, 1), [Departure(24*60 + 5, 'C00001', 1)])
+
+    def test_timetable_snapshot(self):
+        path = tempfile.mkdtemp()
+        old_database_file = config.DATABASE_FILE
+        config.DATABASE_FILE = os.path.join(path, 'dtd.db')
+        try:
+            db = open_test_timetable()
+            stops = stops_running_on_date(db, TEST_DATE)
+            calendar = load_service_calendar(db)
+            links = sorted(load_station_graph(db).links_from(TEST_TIPLOCS.keys()))
+            self.assertIsNone(load_timetable_snapshot(db))
+
+            for _ in range(3):
+                build_id = compile_timetable_snapshot(db)
+            self.assertEqual(len(os.listdir(path)), 2)
+
+            timetable_cache.clear()
+            snapshot = load_timetable_snapshot(db)
+            self.assertIsNotNone(snapshot)
+            if snapshot is None:
+                return
+
+            self.assertEqual(snapshot.build_id, build_id)
+            self.assertEqual(stops_running_on_date(db, TEST_DATE), stops)
+            self.assertEqual(stops_running_on_date(db, datetime.date(2023, 1, 1)), [])
+            self.assertEqual(load_service_calendar(db).running_days, calendar.running_days)
+            self.assertEqual(sorted(load_station_graph(db).links_from(TEST_TIPLOCS.keys())), links)
+
+            route_journeys = find_journeys_raptor(db, 'BTN', 'SSE', TEST_DATE, datetime.time(8, 50))
+            self.assertEqual(len(route_journeys), 2)
+        finally:
+            config.DATABASE_FILE = old_database_file
+
+    def test_csa_profile_crosses_midnight(self):
+        db = open_test_timetable()
+        add_test_train(db, 'C00005', [('BRGHTN', None, 2350), ('SHRHMBS', 10, None)])
+        db.commit()
+
+        days = find_journeys_csa_profile(db, 'BTN', 'SSE', TEST_DATE, datetime.time(23, 0), 24*60)
+        self.assertEqual([day for day, _ in days], [TEST_DATE, TEST_DATE + datetime.timedelta(days=1)])
+
+        def train_uids(route_journeys) -> list[list[str]]:
+            return sorted([[segment.train.train_uid for segment in journey]
+                for _, journeys in route_journeys for journey in journeys])
+        self.assertEqual(train_uids(days[0][1]), [['C00005']])
+        self.assertEqual(train_uids(days[1][1]), [['C00001', 'C00002'], ['C00003']])
+
+        # Nothing departs within the window until the next morning
+        days = find_journeys_csa_profile(db, 'BTN', 'SSE', TEST_DATE, datetime.time(23, 55), 60)
+        self.assertEqual(days, [])
+
+    def test_batch_routing(self):
+        database_file = os.path.join(tempfile.mkdtemp(), 'dtd.db')
+        db = open_test_timetable(database_file)
+        for hour in range(10, 20):
+            add_test_train(db, f'C001{ hour }', [('BRGHTN', None, hour*100), ('PRSTNPK', hour*100 + 10, None)])
+        db.commit()
+        db.close()
+
+        queries = [
+            ('BTN', 'SSE', TEST_DATE),
+            ('HOV', 'WRH', TEST_DATE + datetime.timedelta(days=1)),
+            ('WRH', 'BTN', TEST_DATE),
+            ('BTN', 'PRP', datetime.date(2023, 1, 1)),
+            ('BTN', 'PRP', TEST_DATE),
+        ]
+        with open(os.devnull, 'w') as devnull:
+            results = list(route_batch(queries, devnull, process_count=2, database_file=database_file))
+
+        results_by_query = { (result.from_crs, result.to_crs, result.date): result for result in results }
+        self.assertEqual(sorted(results_by_query.keys()), sorted(queries))
+        self.assertTrue(all([result.error is None for result in results]))
+
+        direct = results_by_query[('BTN', 'SSE', TEST_DATE)]
+        self.assertEqual([[leg.train_uid for leg in journey] for journey in direct.journeys],
+            [['C00001', 'C00002'], ['C00003']])
+        self.assertEqual(direct.journeys[1][0],
+            BatchLeg('C00003', 'BRGHTN', 'SHRHMBS', datetime.time(9, 20), datetime.time(9, 40)))
+        self.assertEqual(len(results_by_query[('HOV', 'WRH', TEST_DATE + datetime.timedelta(days=1))].journeys), 1)
+        self.assertEqual(results_by_query[('WRH', 'BTN', TEST_DATE)].journeys, [])
+        self.assertEqual(results_by_query[('BTN', 'PRP', datetime.date(2023, 1, 1))].journeys, [])
+
+        # Every train of the day, not just the first few
+        hourly = results_by_query[('BTN', 'PRP', TEST_DATE)]
+        self.assertEqual([journey[0].departure for journey in hourly.journeys],
+            [datetime.time(hour, 0) for hour in range(9, 20)])
+
+    def test_detour_pruned_path_search(self):
+        db = open_test_timetable()
+        timetable_cache.clear()
+
+        # Nothing is pruned until the stations feed has been loaded
+        paths, _ = search_paths_and_expansions(db, 2, 'BRGHTN', 'SHRHMBS', 1.05, 0)
+        self.assertEqual(len([route for path in paths for route in path.routes()]), 2)
+
+        for crs, (latitude, longitude) in TEST_STATION_POSITIONS.items():
+            db.add(Station(crs_code = crs, name = crs, latitude = latitude, longitude = longitude))
+        db.add(ExpiryTimes(api_url = KBStations().feed_api_url(), expiry_timestamp = 1))
+        db.commit()
+
+        def routes(paths: list[Path]) -> list[list[str]]:
+            return [route for path in paths for route in path.routes()]
+
+        paths, bfs_expansions = search_paths_and_expansions(db, 2, 'BRGHTN', 'SHRHMBS', prune_detours = False)
+        self.assertEqual(routes(paths), [['SHRHMBS', 'BRGHTN'], ['SHRHMBS', 'PRSTNPK', 'HOVE', 'BRGHTN']])
+
+        # Going by Preston Park is a detour of a little over 10%
+        paths, _ = search_paths_and_expansions(db, 2, 'BRGHTN', 'SHRHMBS', 1.2, 0)
+        self.assertEqual(routes(paths), [['SHRHMBS', 'BRGHTN'], ['SHRHMBS', 'PRSTNPK', 'HOVE', 'BRGHTN']])
+        paths, pruned_expansions = search_paths_and_expansions(db, 2, 'BRGHTN', 'SHRHMBS', 1.05, 0)
+        self.assertEqual(routes(paths), [['SHRHMBS', 'BRGHTN']])
+        self.assertLess(pruned_expansions, bfs_expansions)
+
+        # Nothing is pruned without a position for both ends
+        db.query(Station).filter(Station.crs_code == 'BTN').delete()
+        db.query(ExpiryTimes).filter(ExpiryTimes.api_url == KBStations().feed_api_url()).update({ 'expiry_timestamp': 2 })
+        db.commit()
+        paths, _ = search_paths_and_expansions(db, 2, 'BRGHTN', 'SHRHMBS', 1.05, 0)
+        self.assertEqual(len(routes(paths)), 2)
+
+    def test_transfer_patterns(self):
+        db = open_test_timetable()
+        self.assertEqual(find_journeys_transfer_patterns(db, 'BTN', 'SSE', TEST_DATE), [])
+
+        # A late train makes Preston Park the busiest station, so the only hub
+        add_test_train(db, 'C00005', [('PRSTNPK', None, 2300), ('SHRHMBS', 2315, None)])
+        db.commit()
+
+        old_hub_count = config.TRANSFER_PATTERN_HUB_COUNT
+        config.TRANSFER_PATTERN_HUB_COUNT = 1
+        try:
+            compile_transfer_patterns(db, TEST_DATE)
+        finally:
+            config.TRANSFER_PATTERN_HUB_COUNT = old_hub_count
+
+        patterns = db.query(TransferPattern.from_location, TransferPattern.interchanges, TransferPattern.from_hub)\
+            .filter(TransferPattern.weekday == TEST_DATE.weekday())\
+            .all()
+        self.assertEqual({ from_location for from_location, _, from_hub in patterns if from_hub }, { 'PRSTNPK' })
+        self.assertEqual(len({ weekday for weekday, in db.query(TransferPattern.weekday).all() }), 7)
+
+        # Away from the hub, searches stop at it rather than changing there
+        self.assertFalse(any(['PRSTNPK' in interchanges.split() for _, interchanges, from_hub in patterns if not from_hub]))
+        patterns = db.query(TransferPattern.interchanges)\
+            .filter(TransferPattern.weekday == TEST_DATE.weekday())\
+            .filter(TransferPattern.from_location == 'BRGHTN', TransferPattern.to_location == 'SHRHMBS')\
+            .all()
+        self.assertEqual([interchanges for interchanges, in patterns], [''])
+
+        # Changing at the hub is joined back together when searching
+        route_journeys = find_journeys_transfer_patterns(db, 'BTN', 'SSE', TEST_DATE)
+        self.assertEqual(sorted([[segment.train.train_uid for segment in journey]
+            for _, journeys in route_journeys for journey in journeys]),
+            [['C00001', 'C00002'], ['C00003']])
+        self.assertEqual(len(find_journeys_transfer_patterns(db, 'BTN', 'WRH', TEST_DATE)), 1)
+        self.assertEqual(find_journeys_transfer_patterns(db, 'WRH', 'BTN', TEST_DATE), [])
+
+    def test_bounded_route_search(self):
+        db = open_test_timetable()
+        progress = SearchProgress(budget_seconds = None)
+        route_journeys = list(find_journeys_from_crs(db, 'BTN', 'SSE', TEST_DATE, progress))
+        self.assertTrue(progress.complete)
+        self.assertEqual(len(route_journeys), 2)
+        self.assertGreater(progress.depth, 0)
+        self.assertGreater(progress.paths_explored, 0)
+        self.assertEqual(progress.routes_searched, 2)
+        self.assertEqual(sorted(progress.phase_seconds.keys()), ['paths', 'stops', 'train_routes', 'trains'])
+
+        # Out of time before anything is searched, so nothing is found
+        progress = SearchProgress(budget_seconds = 0)
+        self.assertEqual(list(find_journeys_from_crs(db, 'BTN', 'SSE', TEST_DATE, progress)), [])
+        self.assertFalse(progress.complete)
+        self.assertEqual(progress.routes_searched, 0)
+
+        old_stats_file = config.ROUTE_SEARCH_STATS_FILE
+        config.ROUTE_SEARCH_STATS_FILE = os.path.join(tempfile.mkdtemp(), 'stats.jsonl')
+        try:
+            record_search_progress('BTN', 'SSE', TEST_DATE, progress)
+            with open(config.ROUTE_SEARCH_STATS_FILE, 'r') as f:
+                stats = [json.loads(line) for line in f]
+            self.assertEqual(len(stats), 1)
+            self.assertEqual((stats[0]['from_crs'], stats[0]['complete']), ('BTN', False))
+        finally:
+            config.ROUTE_SEARCH_STATS_FILE = old_stats_file